@@ -24,6 +24,12 @@
 # *
 # **************************************************************************
 import os
+import logging
+import shlex
+import subprocess
+import sys
+import threading
+from os.path import dirname, join, exists
 import pwem
 from pyworkflow.utils import Environ
 from .constants import *
@@ -33,25 +39,38 @@ __version__ = '3.0.0'
 _logo = "icon.png"
 _references = ['Kiewisz2024.12.19.629196', '10.1093/micmic/ozad067.485']
 
+logger = logging.getLogger(__name__)
+
 
 class Plugin(pwem.Plugin):
     _homeVar = TARDIS_HOME
     _pathVars = [TARDIS_HOME]
     _url = 'https://smlc-nysbc.github.io/TARDIS'
+    _resolvedEnv = None
+    _resolvedEnvFailed = False
+    _resolvedEnvLock = threading.Lock()
+    _verifiedWeights = set()
 
     @classmethod
     def _defineVariables(cls):
         cls._defineEmVar(TARDIS_HOME, TARDIS_FOLDER + '-' + TARDIS_VERSION)
         cls._defineVar(TARDIS_ENV_ACTIVATION, DEFAULT_ACTIVATION_CMD)
+        cls._defineVar(TARDIS_CACHE_DIR, '')  # Empty means no results cache
+        cls._defineVar(TARDIS_CACHE_MAX_SIZE, DEFAULT_CACHE_MAX_SIZE)
+        cls._defineVar(TARDIS_ARRAY_OPTION, DEFAULT_ARRAY_OPTION)
+        cls._defineEmVar(TARDIS_WEIGHTS_DIR, DEFAULT_WEIGHTS_DIR)
 
     @classmethod
-    def getEnviron(cls):
-        """ Setup the environment variables needed to launch Tardis. """
+    def getEnviron(cls, numberOfThreads=None):
+        """ Setup the environment variables needed to launch Tardis. If numberOfThreads is
+        provided, the threads used by torch (OpenMP/MKL) are limited to that number. """
         environ = Environ(os.environ)
         if 'PYTHONPATH' in environ:
             # this is required for python virtual env to work
             del environ['PYTHONPATH']
-        # environ.update({'CUDA_VISIBLE_DEVICES': gpuId})
+        if numberOfThreads:
+            environ.update({'OMP_NUM_THREADS': str(numberOfThreads),
+                            'MKL_NUM_THREADS': str(numberOfThreads)})
         return environ
 
     @classmethod
@@ -59,10 +78,124 @@ class Plugin(pwem.Plugin):
         return cls.getVar(TARDIS_ENV_ACTIVATION)
 
     @classmethod
-    def runTardis(cls, protocol, program, args, cwd=None):
-        cudaStr = f" && CUDA_VISIBLE_DEVICES=%(GPU)s {program} "
-        fullProgram = '%s %s %s' % (cls.getCondaActivationCmd(), cls.getTardisEnvActivation(), cudaStr)
-        protocol.runJob(fullProgram, args, env=cls.getEnviron(), cwd=cwd)
+    def getCacheDir(cls):
+        return cls.getVar(TARDIS_CACHE_DIR)
+
+    @classmethod
+    def getCacheMaxSize(cls):
+        """ Maximum size of the results cache, in GB. """
+        return float(cls.getVar(TARDIS_CACHE_MAX_SIZE))
+
+    @classmethod
+    def getArrayOption(cls):
+        """ Option of the queue system submission command that, followed by the number of tasks,
+        submits an array job, e.g. --array=1- for Slurm, -J 1- for PBS Pro or -t 1- for SGE. """
+        return cls.getVar(TARDIS_ARRAY_OPTION)
+
+    @classmethod
+    def getWeightsDir(cls):
+        """ Directory of the model weights cache shared by all the users (see tardis.weights). It must be
+        visible from the nodes that run Tardis, e.g. in a shared file system for the array jobs. """
+        return cls.getVar(TARDIS_WEIGHTS_DIR)
+
+    @classmethod
+    def getWeightsCheckpoint(cls, program):
+        """ Returns the value of the Tardis --checkpoint argument (CNN and DIST weight files, separated
+        by |) that points a program at its weights in the weights cache, or None if they are not there.
+        The checksum of each weight file is verified the first time it is used by the current process. """
+        from tardis.weights import WeightsCache
+        weightsDir = cls.getWeightsDir()
+        if not weightsDir:
+            return None
+        cache = WeightsCache(weightsDir)
+        models = TARDIS_WEIGHTS[program]
+        for model in models:
+            if not cache.isReady(model, checksum=model not in cls._verifiedWeights):
+                return None
+            cls._verifiedWeights.add(model)
+        return '|'.join(cache.getWeightsFile(model) for model in models)
+
+    @classmethod
+    def getActivationCmd(cls):
+        """ Returns the command that activates the Tardis environment, ended with &&. """
+        return '%s %s &&' % (cls.getCondaActivationCmd(), cls.getTardisEnvActivation())
+
+    @classmethod
+    def getResolvedEnv(cls):
+        """ Returns the Tardis environment resolved once per Tardis version (see tardis.environment),
+        so the executables can be launched without activating it, or None if it can't be resolved.
+        It is stored in the Tardis home and resolved again if it gets stale, e.g. when the environment
+        is re-installed or its activation command changes. """
+        from tardis.environment import ResolvedEnv, resolveEnv
+        activationCmd = cls.getActivationCmd()
+        with cls._resolvedEnvLock:
+            resolvedEnv = cls._resolvedEnv
+            if resolvedEnv is not None and resolvedEnv.isValid(activationCmd):
+                return resolvedEnv
+            if cls._resolvedEnvFailed:
+                return None
+            fn = cls.getHome('resolved_env_%s.json' % TARDIS_VERSION) if cls.getHome() else None
+            resolvedEnv = ResolvedEnv.load(fn) if fn and exists(fn) else None
+            if resolvedEnv is None or not resolvedEnv.isValid(activationCmd):
+                logger.info('Resolving the Tardis environment...')
+                try:
+                    resolvedEnv = resolveEnv(activationCmd, TARDIS_PROGRAMS, cls.getEnviron())
+                except Exception as e:
+                    logger.warning('Unable to resolve the Tardis environment, it will be activated '
+                                   'for each execution -> %s' % e)
+                    cls._resolvedEnvFailed = True
+                    return None
+                if fn:
+                    try:
+                        resolvedEnv.save(fn)
+                    except OSError as e:
+                        logger.warning('Unable to store the resolved Tardis environment in %s -> %s' % (fn, e))
+            cls._resolvedEnv = resolvedEnv
+            return resolvedEnv
+
+    @classmethod
+    def runTardis(cls, protocol, program, args, cwd=None, gpuId=None, numberOfThreads=None, logFile=None):
+        """ Runs a Tardis command. If gpuId is not provided, the GPU/s assigned by Scipion
+        to the current step are used. An empty gpuId hides all the GPUs (CPU execution).
+        If logFile is provided, the output of Tardis is appended to it instead of the
+        protocol log. """
+        gpuId = '%(GPU)s' if gpuId is None else gpuId
+        if logFile:
+            args = '%s >> %s 2>&1' % (args, shlex.quote(os.path.abspath(logFile)))
+        env = cls.getEnviron(numberOfThreads)
+        resolvedEnv = cls.getResolvedEnv()
+        if resolvedEnv:
+            fullProgram = 'CUDA_VISIBLE_DEVICES=%s %s' % (gpuId, resolvedEnv.getProgram(program))
+            resolvedEnv.apply(env)
+        else:
+            fullProgram = '%s CUDA_VISIBLE_DEVICES=%s %s' % (cls.getActivationCmd(), gpuId, program)
+        protocol.runJob(fullProgram, args, env=env, cwd=cwd)
+
+    @classmethod
+    def getTardisCommand(cls, program, args, numberOfThreads=None):
+        """ Returns the shell command that runs a Tardis program out of Scipion, e.g. in the nodes of a
+        cluster, activating the Tardis environment. The GPU/s used are the ones visible to it. If
+        numberOfThreads is provided, the threads used by torch (OpenMP/MKL) are limited to that number,
+        as getEnviron does. """
+        if numberOfThreads:
+            program = 'OMP_NUM_THREADS=%d MKL_NUM_THREADS=%d %s' % (numberOfThreads, numberOfThreads, program)
+        return '%s %s %s' % (cls.getActivationCmd(), program, args)
+
+    @classmethod
+    def startTardisWorker(cls, address, gpuId, logFile, env=None):
+        """ Launches, in the background, a long-lived Tardis process listening in address
+        for segmentation jobs (see tardis.worker). """
+        script = join(dirname(__file__), 'scripts', 'tardis_worker.py')
+        env = env if env is not None else cls.getEnviron()
+        resolvedEnv = cls.getResolvedEnv()
+        if resolvedEnv:
+            cmd = 'CUDA_VISIBLE_DEVICES=%s %s %s --address %s' % (gpuId, resolvedEnv.python, script, address)
+            resolvedEnv.apply(env)
+        else:
+            cmd = '%s CUDA_VISIBLE_DEVICES=%s python %s --address %s' % (
+                cls.getActivationCmd(), gpuId, script, address)
+        with open(logFile, 'a') as log:
+            return subprocess.Popen(cmd, shell=True, stdout=log, stderr=subprocess.STDOUT, env=env)
 
     @classmethod
     def getDependencies(cls):
@@ -99,6 +232,15 @@ class Plugin(pwem.Plugin):
 
         tardis_commands = [(installationCmd, TARDIS_INSTALLED)]
 
+        # Prefetch the model weights of all the targets into the shared weights cache, so Tardis does not
+        # download them on the first execution of each user (or fail to, in nodes without internet access)
+        weightsDir = cls.getWeightsDir()
+        if weightsDir:
+            WEIGHTS_FETCHED = 'tardis_%s_weights_fetched' % version
+            models = ' '.join(sorted({model for models in TARDIS_WEIGHTS.values() for model in models}))
+            fetchCmd = f'{sys.executable} -m tardis.weights --dir {weightsDir} {models} && touch {WEIGHTS_FETCHED}'
+            tardis_commands.append((fetchCmd, WEIGHTS_FETCHED))
+
         env.addPackage(TARDIS_FOLDER,
                        version=TARDIS_VERSION,
                        tar='void.tgz',
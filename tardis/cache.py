@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from os.path import join, exists, isdir, getsize
+from typing import Dict, Union
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 16 * 1024 * 1024  # Bytes
+COMPLETE_FLAG = '.complete'
+LOCK_FILE = '.lock'
+
+
+class ResultsCache:
+    """Content-addressed cache of Tardis results. Each entry is a directory named after a key that
+    depends on the contents of the input tomogram, the Tardis command and arguments and the Tardis
+    version, so the same segmentation is not computed twice. The entries are evicted in least
+    recently used order once the size of the cache exceeds maxSize."""
+
+    def __init__(self, cacheDir: str, maxSize: Union[int, float]):
+        """
+        :param cacheDir: directory in which the cache entries are stored.
+        :param maxSize: maximum size of the cache, in GB.
+        """
+        self.cacheDir = cacheDir
+        self.maxSize = int(maxSize * 1024 ** 3)
+        os.makedirs(cacheDir, exist_ok=True)
+
+    @staticmethod
+    def hashTomogram(tomoFile: str) -> 'hashlib._Hash':
+        """Returns the hash of the contents of a tomogram file, read in chunks so it is never loaded
+        completely in memory. It is the part of the key that takes long, so it can be computed once and
+        passed to computeKey for each segmentation of the same tomogram."""
+        digest = hashlib.sha256()
+        with open(tomoFile, 'rb') as f:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            while chunk:
+                digest.update(chunk)
+                chunk = f.read(HASH_CHUNK_SIZE)
+        return digest
+
+    @staticmethod
+    def computeKey(tomoHash: 'hashlib._Hash', program: str, args: str, version: str) -> str:
+        """Returns the key of a segmentation: the hash of the contents of the tomogram (see hashTomogram)
+        plus the command, its arguments and the Tardis version."""
+        digest = tomoHash.copy()
+        digest.update(f'{program} {args} {version}'.encode())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Union[str, None]:
+        """Returns the directory of the entry with the given key or None if it is not cached."""
+        entryDir = join(self.cacheDir, key)
+        if not exists(join(entryDir, COMPLETE_FLAG)):
+            return None
+        try:
+            os.utime(entryDir)  # Mark it as recently used
+        except FileNotFoundError:  # Evicted meanwhile
+            return None
+        return entryDir
+
+    def put(self, key: str, files: Dict[str, str]):
+        """Stores a new entry.
+
+        :param key: key of the entry.
+        :param files: dictionary of {name in the cache: file to store}.
+        """
+        entryDir = join(self.cacheDir, key)
+        if exists(join(entryDir, COMPLETE_FLAG)):
+            return
+        tmpDir = tempfile.mkdtemp(prefix='.tmp-', dir=self.cacheDir)
+        try:
+            for name, fn in files.items():
+                linkOrCopy(fn, join(tmpDir, name))
+            open(join(tmpDir, COMPLETE_FLAG), 'w').close()
+            with self._locked():
+                if exists(entryDir):  # Stored by a concurrent run
+                    shutil.rmtree(tmpDir)
+                else:
+                    os.rename(tmpDir, entryDir)
+                self._evict()
+        except Exception:
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def fetch(entryDir: str, name: str, outFile: str):
+        """Brings a file from a cache entry to outFile."""
+        linkOrCopy(join(entryDir, name), outFile)
+
+    def _evict(self):
+        """Removes the least recently used entries until the cache fits in its maximum size."""
+        entries = []
+        for name in os.listdir(self.cacheDir):
+            entryDir = join(self.cacheDir, name)
+            if isdir(entryDir) and not name.startswith('.'):
+                size = sum(getsize(join(entryDir, fn)) for fn in os.listdir(entryDir))
+                entries.append((os.stat(entryDir).st_mtime, size, entryDir))
+        totalSize = sum(entry[1] for entry in entries)
+        for _, size, entryDir in sorted(entries):
+            if totalSize <= self.maxSize:
+                break
+            logger.info(f'Evicting the Tardis cache entry {entryDir}')
+            shutil.rmtree(entryDir, ignore_errors=True)
+            totalSize -= size
+
+    @contextmanager
+    def _locked(self):
+        """Serializes the modifications of the cache among the runs that share it."""
+        with open(join(self.cacheDir, LOCK_FILE), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+def linkOrCopy(src: str, dst: str):
+    """Hard links src into dst, so the file outlives the eviction of the cache entry, or copies
+    it if both are in different file systems."""
+    if exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import os
+import re
+import shlex
+import subprocess
+import time
+from os.path import join, exists
+from typing import List, Dict, Union
+
+logger = logging.getLogger(__name__)
+
+# Variables in which the queue systems pass the index of the task: Slurm, PBS Pro, Torque, SGE and LSF
+ARRAY_TASK_ID_VARS = ('SLURM_ARRAY_TASK_ID', 'PBS_ARRAY_INDEX', 'PBS_ARRAYID', 'SGE_TASK_ID', 'LSB_JOBINDEX')
+ARRAY_CHECK_SECS = 30
+JOB_ID_REGEX = re.compile(r'(\d+)')
+
+
+class ArrayTask:
+    """Task of an array job: a shell command run in a directory, with its output appended to a log file,
+    and the files it is expected to generate."""
+
+    def __init__(self, command: str, cwd: str, logFile: str, outputs: List[str]):
+        self.command = command
+        self.cwd = cwd
+        self.logFile = logFile
+        self.outputs = outputs
+
+
+class ArrayJob:
+    """Queue-system array job with a task per ArrayTask, built from the queue configuration of a Scipion
+    host: its submission template and command and its check command. The array option, followed by the
+    number of tasks, is added to the submission command. Each task writes its exit code
+    in the job directory once finished, and it is considered successful if it exited with 0 and generated
+    all its output files. The tasks never finished, e. g. killed by the queue system, are failed once the
+    queue reports that the job is no longer running.
+
+    Usage::
+
+        job = ArrayJob(jobDir, tasks)
+        job.submit(hostConfig, submitDict, '--array=1-')
+        succeeded = job.wait(hostConfig)  # A bool per task
+    """
+
+    def __init__(self, jobDir: str, tasks: List[ArrayTask]):
+        self.jobDir = jobDir
+        self.tasks = tasks
+        self.jobId = None
+
+    def submit(self, hostConfig, submitDict: Dict, arrayOption: str) -> str:
+        """Submits the job. Returns its id.
+
+        :param hostConfig: Scipion host configuration (pyworkflow.protocol.hosts.HostConfig).
+        :param submitDict: values of the variables of the submission template, e. g. the ones of
+            Protocol.getSubmitDict. JOB_COMMAND, JOB_SCRIPT and JOB_TASKS are set here.
+        :param arrayOption: option of the submission command that, followed by the number of tasks, makes
+            the job an array, e. g. --array=1- for Slurm, -J 1- for PBS Pro or -t 1- for SGE and Torque.
+        """
+        os.makedirs(self.jobDir, exist_ok=True)
+        for taskId in self._getTaskIds():  # From a previous submission
+            if exists(self._getExitFile(taskId)):
+                os.remove(self._getExitFile(taskId))
+        submitDict = dict(submitDict,
+                          JOB_COMMAND=f'bash {shlex.quote(self._writeTasksScript())}',
+                          JOB_SCRIPT=join(self.jobDir, 'array.job'),
+                          JOB_TASKS=len(self.tasks))
+        with open(submitDict['JOB_SCRIPT'], 'w') as f:
+            # Some queue systems do not accept scripts without an ending line break
+            f.write(hostConfig.getSubmitTemplate() % submitDict + '\n\n')
+        program, _, args = (hostConfig.getSubmitCommand() % submitDict).partition(' ')
+        command = f'{program} {arrayOption}{len(self.tasks)} {args}'
+        logger.info(f'Submitting an array job of {len(self.tasks)} tasks: {command}')
+        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        match = JOB_ID_REGEX.search(result.stdout)
+        if result.returncode != 0 or match is None:
+            raise RuntimeError(f'Unable to submit the array job -> {result.stderr.strip() or result.stdout.strip()}')
+        self.jobId = match.group(1)
+        logger.info(f'Array job {self.jobId} submitted')
+        return self.jobId
+
+    def wait(self, hostConfig, checkSecs: float = ARRAY_CHECK_SECS) -> List[bool]:
+        """Waits until all the tasks have finished or the job is no longer in the queue. Returns if each
+        task succeeded."""
+        while True:
+            statuses = self.getTaskStatuses()
+            if all(status is not None for status in statuses):
+                return statuses
+            if self._isQueueDone(hostConfig):
+                # The files of the last tasks may have been written after the previous reading
+                return [status is True for status in self.getTaskStatuses()]
+            time.sleep(checkSecs)
+
+    def cancel(self, hostConfig):
+        cancelCommand = hostConfig.getCancelCommand()
+        if self.jobId is not None and cancelCommand:
+            subprocess.run(cancelCommand % {'JOB_ID': self.jobId}, shell=True, capture_output=True)
+
+    def getTaskStatuses(self) -> List[Union[bool, None]]:
+        """Returns, for each task, None if it has not finished yet or if it succeeded otherwise."""
+        statuses = []
+        for taskId, task in zip(self._getTaskIds(), self.tasks):
+            exitFile = self._getExitFile(taskId)
+            if not exists(exitFile):
+                statuses.append(None)
+                continue
+            with open(exitFile) as f:
+                exitCode = f.read().strip()
+            statuses.append(exitCode == '0' and all(exists(fn) for fn in task.outputs))
+        return statuses
+
+    def _isQueueDone(self, hostConfig) -> bool:
+        """Tells if the queue system no longer runs the job, the same way Scipion checks its jobs: an
+        empty answer of the check command or one matching the JOB_DONE_REGEX of the host."""
+        checkCommand = hostConfig.getCheckCommand()
+        if not checkCommand:
+            return False  # Only the files of the tasks can tell
+        result = subprocess.run(checkCommand % {'JOB_ID': self.jobId}, shell=True, capture_output=True,
+                                text=True)
+        output = result.stdout.strip()
+        jobDoneRegex = hostConfig.getJobDoneRegex()
+        return output == '' or (jobDoneRegex is not None and re.search(jobDoneRegex, output) is not None)
+
+    def _writeTasksScript(self) -> str:
+        """Writes the script run by every task of the job, which runs the command of the task given by the
+        index the queue system passes in its environment (or the first argument)."""
+        jobDir = shlex.quote(os.path.abspath(self.jobDir))  # The tasks may not start in the current directory
+        taskIdExpr = '$1'
+        for var in reversed(ARRAY_TASK_ID_VARS):
+            taskIdExpr = f'${{{var}:-{taskIdExpr}}}'
+        lines = ['#!/bin/bash',
+                 f'TASK_ID={taskIdExpr}',
+                 'case "$TASK_ID" in']
+        for taskId, task in zip(self._getTaskIds(), self.tasks):
+            lines.append(f'  {taskId}) (cd {shlex.quote(os.path.abspath(task.cwd))} && {task.command}) '
+                         f'>> {shlex.quote(os.path.abspath(task.logFile))} 2>&1 ;;')
+        lines.extend(['  *) echo "Unknown task $TASK_ID" >&2; exit 1 ;;',
+                      'esac',
+                      'EXIT_CODE=$?',
+                      # Written and renamed, so an exit file is never read incomplete
+                      f'echo $EXIT_CODE > {jobDir}/task_$TASK_ID.exit.tmp',
+                      f'mv {jobDir}/task_$TASK_ID.exit.tmp {jobDir}/task_$TASK_ID.exit',
+                      'exit $EXIT_CODE'])
+        fn = join(self.jobDir, 'tasks.sh')
+        with open(fn, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return fn
+
+    def _getTaskIds(self) -> range:
+        return range(1, len(self.tasks) + 1)
+
+    def _getExitFile(self, taskId: int) -> str:
+        return join(self.jobDir, f'task_{taskId}.exit')
@@ -37,4 +37,22 @@ TARDIS_VERSION = '0.3.10'
 TARDIS_FOLDER = 'tardis'
 DEFAULT_ENV_NAME = f'{TARDIS}-{TARDIS_VERSION}'
 DEFAULT_ACTIVATION_CMD = f'conda activate {DEFAULT_ENV_NAME}'
-TARDIS_ENV_ACTIVATION = 'TARDIS_ENV_ACTIVATION'
\ No newline at end of file
+TARDIS_ENV_ACTIVATION = 'TARDIS_ENV_ACTIVATION'
+TARDIS_CACHE_DIR = 'TARDIS_CACHE_DIR'
+TARDIS_CACHE_MAX_SIZE = 'TARDIS_CACHE_MAX_SIZE'
+DEFAULT_CACHE_MAX_SIZE = 100  # GB
+TARDIS_ARRAY_OPTION = 'TARDIS_ARRAY_OPTION'
+DEFAULT_ARRAY_OPTION = '--array=1-'  # Slurm
+TARDIS_WEIGHTS_DIR = 'TARDIS_WEIGHTS_DIR'
+DEFAULT_WEIGHTS_DIR = 'tardis-weights'  # In the software directory of Scipion, next to the Tardis home
+# Tardis programs, one per target
+TARDIS_MEM = 'tardis_mem'
+TARDIS_MT = 'tardis_mt'
+TARDIS_ACTIN = 'tardis_actin'
+TARDIS_PROGRAMS = [TARDIS_MEM, TARDIS_MT, TARDIS_ACTIN]
+# Model weights (CNN and DIST) used by each Tardis program, as <network>_<subtype>/<dataset>
+TARDIS_WEIGHTS = {
+    TARDIS_MEM: ('fnet_attn_32/membrane_3d', 'dist_triang/3d'),
+    TARDIS_MT: ('fnet_attn_32/microtubules_3d', 'dist_triang/2d'),
+    TARDIS_ACTIN: ('fnet_attn_32/actin_3d', 'dist_triang/2d'),
+}
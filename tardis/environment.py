@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+from typing import Dict, List, Union
+
+logger = logging.getLogger(__name__)
+
+# Variables whose entries added by the activation are prepended to the current ones
+PATH_VARS = ('PATH', 'LD_LIBRARY_PATH')
+# Variables that change on each shell and are not part of the environment
+IGNORED_VARS = ('SHLVL', '_', 'PWD', 'OLDPWD', 'PS1')
+OUTPUT_MARKER = '@@TARDIS_ENV@@'
+RESOLVE_CODE = ('import json, os, sys; '
+                f'print("{OUTPUT_MARKER}" + json.dumps({{"python": sys.executable, "env": dict(os.environ)}}))')
+RESOLVE_TIMEOUT = 300  # Seconds
+
+
+class ResolvedEnv:
+    """Result of activating the Tardis environment once: the absolute paths of its python and
+    executables and the changes the activation makes in the environment variables. It allows to
+    launch the Tardis executables directly, without activating the environment for each execution."""
+
+    def __init__(self, activationCmd: str, python: str, programs: Dict[str, str],
+                 pathEntries: Dict[str, List[str]], variables: Dict[str, str]):
+        """
+        :param activationCmd: command used to activate the environment.
+        :param python: absolute path of the python of the environment.
+        :param programs: dictionary of {program name: absolute path}.
+        :param pathEntries: dictionary of {variable in PATH_VARS: entries added by the activation}.
+        :param variables: other variables set or modified by the activation.
+        """
+        self.activationCmd = activationCmd
+        self.python = python
+        self.programs = programs
+        self.pathEntries = pathEntries
+        self.variables = variables
+
+    def isValid(self, activationCmd: str) -> bool:
+        """Tells if the environment was resolved with the given activation command and all its
+        executables are still there."""
+        return (activationCmd == self.activationCmd and
+                all(os.access(fn, os.X_OK) for fn in [self.python] + list(self.programs.values())))
+
+    def getProgram(self, program: str) -> str:
+        return self.programs[program]
+
+    def apply(self, environ: Dict[str, str]) -> Dict[str, str]:
+        """Applies the changes of the activation to the given environment, in place, and returns it."""
+        for var, entries in self.pathEntries.items():
+            current = environ.get(var, '')
+            environ[var] = os.pathsep.join(entries + ([current] if current else []))
+        environ.update(self.variables)
+        return environ
+
+    def save(self, fn: str):
+        tmpFn = f'{fn}.{os.getpid()}.tmp'
+        with open(tmpFn, 'w') as f:
+            json.dump(vars(self), f, indent=2)
+        os.replace(tmpFn, fn)  # Atomic, for concurrent protocols
+
+    @classmethod
+    def load(cls, fn: str) -> Union['ResolvedEnv', None]:
+        try:
+            with open(fn) as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f'Unable to read the resolved Tardis environment {fn} -> {e}')
+            return None
+
+
+def resolveEnv(activationCmd: str, programs: List[str], baseEnv: Dict[str, str]) -> ResolvedEnv:
+    """Activates the environment once, in a shell launched with baseEnv, and returns what the
+    activation changed.
+
+    :param activationCmd: command that activates the environment. It must end with && or ;
+    :param programs: names of the executables to be located in the environment.
+    :param baseEnv: environment in which the executables will be launched.
+    """
+    cmd = f'{activationCmd} python -c {shlex.quote(RESOLVE_CODE)}'
+    output = subprocess.run(cmd, shell=True, env=baseEnv, capture_output=True, text=True,
+                            check=True, timeout=RESOLVE_TIMEOUT).stdout
+    resolved = None
+    for line in output.splitlines():
+        if line.startswith(OUTPUT_MARKER):
+            resolved = json.loads(line[len(OUTPUT_MARKER):])
+    if resolved is None:
+        raise ValueError(f'Unexpected output of the environment activation: {output}')
+
+    env = resolved['env']
+    pathEntries = {}
+    for var in PATH_VARS:
+        baseEntries = baseEnv.get(var, '').split(os.pathsep)
+        added = [entry for entry in env.get(var, '').split(os.pathsep) if entry and entry not in baseEntries]
+        if added:
+            pathEntries[var] = added
+    variables = {var: value for var, value in env.items()
+                 if var not in PATH_VARS and var not in IGNORED_VARS and baseEnv.get(var) != value}
+    programPaths = {}
+    for program in programs:
+        programPath = shutil.which(program, path=env.get('PATH', ''))
+        if programPath is None:
+            raise ValueError(f'{program} not found in the environment')
+        programPaths[program] = programPath
+    return ResolvedEnv(activationCmd, resolved['python'], programPaths, pathEntries, variables)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import logging
+import os
+from os.path import dirname, join, relpath, getsize, exists, abspath
+from typing import Dict, List, Union
+import mrcfile
+
+logger = logging.getLogger(__name__)
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class CompletionMarker:
+    """Record of a finished piece of work, e. g. the segmentation of a tomogram, stored in a JSON file
+    next to its results. Besides the status, it keeps the information needed to resume the work (the
+    parameters it was done with) and the integrity data of the result files: their size, the rows of the
+    CSV files and the validity of the MRC headers. A marker is only trusted if the files are still as
+    they were when it was written, so the results of an execution that died while writing them, or
+    modified afterwards, are not taken as finished."""
+
+    def __init__(self, status: str, info: Dict, files: Dict[str, Dict]):
+        """
+        :param status: STATUS_DONE or STATUS_FAILED.
+        :param info: information of the work, e. g. its parameters.
+        :param files: dictionary of {file path, relative to the marker: integrity data}.
+        """
+        self.status = status
+        self.info = info
+        self.files = files
+
+    @classmethod
+    def create(cls, markerFile: str, status: str, info: Dict, files: List[str] = ()) -> 'CompletionMarker':
+        """Creates the marker of a piece of work and saves it in markerFile.
+
+        :param markerFile: path of the marker.
+        :param status: STATUS_DONE or STATUS_FAILED.
+        :param info: information of the work, e. g. its parameters.
+        :param files: result files of the work.
+        """
+        markerDir = dirname(markerFile)
+        marker = cls(status, info, {relpath(fn, markerDir): getIntegrity(fn) for fn in files})
+        marker.save(markerFile)
+        return marker
+
+    def isDone(self) -> bool:
+        return self.status == STATUS_DONE
+
+    def checkFiles(self, markerFile: str) -> bool:
+        """Tells if the result files are still as they were when the marker was written."""
+        markerDir = dirname(markerFile)
+        for fn, integrity in self.files.items():
+            fn = join(markerDir, fn)
+            if not exists(fn) or getIntegrity(fn) != integrity:
+                logger.info(f'{fn} is missing or incomplete')
+                return False
+        return True
+
+    def save(self, markerFile: str):
+        tmpFn = f'{markerFile}.tmp'
+        with open(tmpFn, 'w') as f:
+            json.dump(vars(self), f, indent=2)
+        os.replace(tmpFn, markerFile)  # A marker is never left incomplete
+
+    @classmethod
+    def load(cls, markerFile: str) -> Union['CompletionMarker', None]:
+        """Returns the marker stored in markerFile, or None if there is none or it can't be read."""
+        if not exists(markerFile):
+            return None
+        try:
+            with open(markerFile) as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f'Unable to read the completion marker {markerFile} -> {e}')
+            return None
+
+
+def getIntegrity(fn: str) -> Dict:
+    """Returns the integrity data of a file: its size plus, for the CSV files, the number of rows and,
+    for the MRC files, whether its header is valid and matches the size of the file."""
+    integrity = {'size': getsize(fn)}
+    if fn.endswith('.csv'):
+        with open(fn, 'rb') as f:
+            integrity['rows'] = sum(1 for line in f if line.strip())
+    elif fn.endswith('.mrc'):
+        integrity['validHeader'] = _isValidMrcHeader(fn)
+    return integrity
+
+
+def getFileIdentity(fn: str) -> Dict:
+    """Returns the identity of an input file: its absolute path, size and modification time, so a marker
+    can tell if the file it was written from has been replaced or modified since then."""
+    stat = os.stat(fn)
+    return {'path': abspath(fn), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _isValidMrcHeader(fn: str) -> bool:
+    try:
+        with mrcfile.open(fn, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            if header.map != mrcfile.constants.MAP_ID:
+                return False
+            itemSize = mrcfile.utils.dtype_from_mode(header.mode).itemsize
+            dataSize = int(header.nx) * int(header.ny) * int(header.nz) * itemSize
+            return getsize(fn) == header.nbytes + int(header.nsymbt) + dataSize
+    except (OSError, ValueError):
+        return False
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from typing import Iterator, Tuple, TYPE_CHECKING
+from pwem.objects import EMFile, EMSet
+from pyworkflow.object import String, Integer, Float, Pointer
+
+# Scipion imports this module at startup to discover the objects of the plugin, so numpy (tardis.points)
+# and tardis.utils are imported where they are used.
+if TYPE_CHECKING:
+    import numpy as np
+    from tomo.objects import SetOfMeshes, SetOfTomograms
+
+
+class TomoPoints(EMFile):
+    """Points of the instances segmented in a tomogram, stored in a NumPy .npy file (see tardis.points)
+    instead of as a MeshPoint per row of the sqlite of a set of meshes. The coordinates are the same
+    as the ones of the meshes, in single precision, in pixels and referred to the Scipion convention."""
+
+    TS_ID_ATTR = '_tsId'
+
+    def __init__(self, filename=None, tsId=None, **kwargs):
+        super().__init__(filename=filename, **kwargs)
+        self._tsId = String(tsId)
+        self._volName = String()
+        self._numberOfPoints = Integer()
+        self._numberOfInstances = Integer()
+
+    def getTsId(self) -> str:
+        return self._tsId.get()
+
+    def setTsId(self, tsId: str):
+        self._tsId.set(tsId)
+
+    def getVolName(self) -> str:
+        """Returns the file name of the tomogram the points belong to."""
+        return self._volName.get()
+
+    def setVolName(self, volName: str):
+        self._volName.set(volName)
+
+    def getNumberOfPoints(self) -> int:
+        return self._numberOfPoints.get()
+
+    def setNumberOfPoints(self, n: int):
+        self._numberOfPoints.set(n)
+
+    def getNumberOfInstances(self) -> int:
+        return self._numberOfInstances.get()
+
+    def setNumberOfInstances(self, n: int):
+        self._numberOfInstances.set(n)
+
+    def getPoints(self, mmap: bool = True) -> 'np.ndarray':
+        """Returns the points, memory-mapped by default (see tardis.points.loadPoints):
+        points['coords'] are the N x 3 coordinates and points['groupId'] the group ids."""
+        from tardis.points import loadPoints
+        return loadPoints(self.getFileName(), mmap=mmap)
+
+    def __str__(self):
+        return f'{self.getClassName()} ({self.getTsId()}, {self.getNumberOfPoints()} points, ' \
+               f'{self.getNumberOfInstances()} instances)'
+
+
+class SetOfTomoPoints(EMSet):
+    """Set of the points of the instances segmented in a set of tomograms, with an item per tomogram
+    pointing to its .npy file. It is a compact alternative to a set of meshes: its sqlite only has a
+    row per tomogram and the points are read, memory-mapped, when they are iterated. The classic set
+    of meshes can be generated from it with toMeshes."""
+
+    ITEM_TYPE = TomoPoints
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._boxSize = Integer()
+        self._samplingRate = Float()
+        self._precedentsPointer = Pointer()
+
+    def getBoxSize(self) -> int:
+        return self._boxSize.get()
+
+    def setBoxSize(self, boxSize: int):
+        self._boxSize.set(boxSize)
+
+    def getSamplingRate(self) -> float:
+        return self._samplingRate.get()
+
+    def setSamplingRate(self, sampling: float):
+        self._samplingRate.set(sampling)
+
+    def getPrecedents(self) -> 'SetOfTomograms':
+        """Returns the set of tomograms the points belong to."""
+        return self._precedentsPointer.get()
+
+    def setPrecedents(self, precedents):
+        """:param precedents: the set of tomograms the points belong to or a pointer to it."""
+        if precedents.isPointer():
+            self._precedentsPointer.copy(precedents)
+        else:
+            self._precedentsPointer.set(precedents)
+
+    def copyInfo(self, other):
+        self.setBoxSize(other.getBoxSize())
+        self.setSamplingRate(other.getSamplingRate())
+        self.setPrecedents(other.getPrecedents())
+
+    def getNumberOfPoints(self) -> int:
+        return sum(item.getNumberOfPoints() for item in self.iterItems())
+
+    def iterPoints(self) -> Iterator[Tuple[str, 'np.ndarray']]:
+        """Iterates over the tomograms, yielding their tsId and their points, memory-mapped, so they are
+        not copied nor read until they are accessed (see TomoPoints.getPoints)."""
+        for item in self.iterItems():
+            yield item.getTsId(), item.getPoints()
+
+    def toMeshes(self, meshes: 'SetOfMeshes') -> 'SetOfMeshes':
+        """Appends all the points to a set of meshes, e. g. a new one created with SetOfMeshes.create,
+        for the protocols and viewers that require them. The points of each tomogram are appended in
+        blocks, so they are never loaded completely in memory.
+
+        :param meshes: set of meshes in which the points will be appended.
+        :return: the set of meshes, with the same box size, sampling rate and precedents as this set.
+        """
+        from tardis.utils import appendPointsToMeshes
+        meshes.copyInfo(self)
+        tomos = {tomo.getTsId(): tomo.clone() for tomo in self.getPrecedents()}
+        for tsId, points in self.iterPoints():
+            appendPointsToMeshes(meshes, tomos[tsId], points)
+            meshes.write(properties=False)
+        meshes.write()
+        return meshes
+
+    def __str__(self):
+        sRate = f'{self.getSamplingRate():.2f}' if self.getSamplingRate() is not None else 'None!!!'
+        return f'{self.getClassName()} ({self.getSize()} items, {sRate} Å/px{self._appendStreamState()})'
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+from typing import Union
+import numpy as np
+
+# One record per point: its coordinates (x, y, z) and its group id, 16 bytes per point
+POINTS_DTYPE = np.dtype([('coords', '<f4', (3,)), ('groupId', '<i4')])
+# The same record with the coordinates in double precision, 28 bytes per point. It is only used to hand the
+# points over to a set of meshes, which stores them in double precision, without rounding them
+PRECISE_POINTS_DTYPE = np.dtype([('coords', '<f8', (3,)), ('groupId', '<i4')])
+
+
+def savePoints(fn: str, groupIds: Union[list, np.ndarray], coords: Union[list, np.ndarray],
+               precise: bool = False) -> int:
+    """Writes the points of a tomogram in a NumPy .npy file of POINTS_DTYPE records. It is written in a
+    temporary file that is then renamed, so a file is never left incomplete.
+
+    :param fn: path of the .npy file.
+    :param groupIds: N group ids.
+    :param coords: N x 3 coordinates.
+    :param precise: if True, the records are PRECISE_POINTS_DTYPE ones.
+    :return: the number of points written.
+    """
+    dtype = PRECISE_POINTS_DTYPE if precise else POINTS_DTYPE
+    coords = np.asarray(coords, dtype=dtype['coords'].base).reshape(-1, 3)
+    points = np.empty(len(coords), dtype=dtype)
+    points['coords'] = coords
+    points['groupId'] = np.asarray(groupIds).reshape(-1)
+    tmpFn = f'{fn}.tmp'
+    with open(tmpFn, 'wb') as f:  # Through a file object, so numpy does not add the .npy extension
+        np.save(f, points)
+    os.replace(tmpFn, fn)
+    return len(points)
+
+
+def loadPoints(fn: str, mmap: bool = True) -> np.ndarray:
+    """Returns the points stored in a .npy file, as an array of POINTS_DTYPE (or PRECISE_POINTS_DTYPE)
+    records: points['coords'] is an N x 3 view of the coordinates and points['groupId'] one of the group
+    ids. With mmap, the file is memory-mapped read-only, so nothing is read until the points are accessed
+    and only the pages accessed are."""
+    points = np.load(fn, mmap_mode='r' if mmap else None)
+    if points.dtype not in (POINTS_DTYPE, PRECISE_POINTS_DTYPE):
+        raise ValueError(f'{fn} does not contain points: unexpected data type {points.dtype}')
+    return points
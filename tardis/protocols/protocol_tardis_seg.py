@@ -25,29 +25,91 @@
 # *
 # **************************************************************************
 import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
 from enum import Enum
-from os.path import join
-from typing import Union
-import numpy as np
+from os.path import join, exists, getsize, basename, realpath
+from typing import Union, List, Tuple, Dict, Iterator, TYPE_CHECKING
 from pwem.protocols import EMProtocol
 from pyworkflow import BETA
 from pyworkflow.object import Pointer, Set, Integer
-from pyworkflow.protocol import STEPS_PARALLEL, FloatParam, StringParam, LEVEL_ADVANCED, GE, \
-    LE, GPU_LIST, PointerParam, EnumParam, IntParam
-from pyworkflow.utils import Message, makePath, createLink, cyanStr, redStr
+from pyworkflow.protocol import ProtStreamingBase, STEPS_PARALLEL, FloatParam, StringParam, LEVEL_ADVANCED, GE, \
+    LE, GPU_LIST, PointerParam, EnumParam, IntParam, BooleanParam
+from pyworkflow.utils import Message, makePath, createLink, cyanStr, redStr, moveFile, cleanPath
 from tardis import Plugin
+from tardis.constants import TARDIS_VERSION, TARDIS_MEM, TARDIS_MT, TARDIS_ACTIN
+from tardis.objects import SetOfTomoPoints, TomoPoints
+from tardis.scheduler import DeviceScheduler
 from tomo.constants import BOTTOM_LEFT_CORNER
-from tomo.objects import SetOfTomoMasks, SetOfMeshes, TomoMask, MeshPoint, SetOfTomograms
+from tomo.objects import SetOfTomoMasks, SetOfMeshes, TomoMask, SetOfTomograms
+
+# Scipion imports this module at startup to discover the protocol, so the modules only needed to run it
+# (tardis.utils, with numpy and mrcfile, tardis.cache, tardis.worker, tardis.spatial, tardis.markers,
+# tardis.points and tardis.cluster) are imported where they are used.
+# tardis/tests/tests_import.py guards it.
+if TYPE_CHECKING:
+    from tardis.cluster import ArrayTask
+    from concurrent.futures import Future, ProcessPoolExecutor
+    import hashlib
+    import numpy as np
+    from tardis.cache import ResultsCache
+    from tardis.markers import CompletionMarker
+    from tardis.utils import Roi
+    from tardis.spatial import PointsIndex
+    from tardis.worker import TardisWorker
 
 logger = logging.getLogger(__name__)
 
 # Inputs
 IN_TOMOS = 'inputSetOfTomograms'
 SEG_TARGET = 'segmentationTarget'
+MULTI_TARGET = 'multiTarget'
 SEG_MODE = 'segmentationType'
+USE_WORKER = 'useWorker'
+BATCH_SIZE = 'batchSize'
+USE_CACHE = 'useCache'
+JOBS_PER_GPU = 'jobsPerGpu'
+DEVICE = 'computingDevice'
+CPU_THREADS_PER_JOB = 'cpuThreadsPerJob'
+COMPACT_MASKS = 'compactMasks'
+AUTO_BIN = 'autoBinning'
+MAX_MEMORY = 'maxMemoryPerJob'
+OOM_RETRIES = 'oomRetries'
+OOM_FALLBACKS = 'oomFallbacks'
+USE_ROI = 'useRoi'
+ROI_MASKS = 'roiMasks'
+ROI_MASK_MARGIN = 'roiMaskMargin'
+SWEEP = 'thresholdSweep'
+SWEEP_THRESHOLDS = 'sweepThresholds'
+POINTS_FILES = 'pointsFiles'
+USE_ARRAY_JOB = 'useArrayJob'
+PREVIEW = 'preview'
+PREVIEW_SIZE = 'previewSize'
+PREVIEW_TSIDS = 'previewTsIds'
+PREVIEW_BIN = 'previewBinning'
+PREVIEW_FRACTION = 'previewFraction'
+# First and last pixel of the region of interest along each axis
+ROI_PARAMS = {axis: (f'roi{axis}First', f'roi{axis}Last') for axis in 'XYZ'}
 
 # Other variables
 OUTPUT_TOMOS_FAILED_NAME = "FailedTomos"
+STREAMING_CHECK_SECS = 10
+CPU_SLOT_PREFIX = 'cpu'
+PREVIEW_DIR = 'preview'  # In the extra directory, so a full segmentation never reuses the results of a preview
+# The output sets are stored every OUTPUT_COMMIT_TOMOS tomograms or OUTPUT_COMMIT_SECS seconds
+OUTPUT_COMMIT_TOMOS = 10
+OUTPUT_COMMIT_SECS = 60
+# Fallback configurations of the executions that run out of memory
+FALLBACK_CPU = 'cpu'
+FALLBACK_BIN_REGEX = re.compile(r'^bin(\d+)$')
+DEVICE_ARG_REGEX = re.compile(r' ?--device \S+')
+# Probability map saved by Tardis when it is executed with a CNN threshold of 0
+PROBABILITY_MAP = ('CNN', 'tif')
+# Completion marker of the segmentation of a tomogram, in the directory of each target
+SEGMENTATION_MARKER = '.segmentation.json'
 
 # Segmentation targets
 class TardisSegTargets(Enum):
@@ -55,21 +117,45 @@ class TardisSegTargets(Enum):
     membranes = 1
     microtubules = 2
 
+# Tardis command of each target
+TARGET_PROGRAMS = {
+    TardisSegTargets.actin: TARDIS_ACTIN,
+    TardisSegTargets.membranes: TARDIS_MEM,
+    TardisSegTargets.microtubules: TARDIS_MT,
+}
+
+# Pixel size (Å/px) at which Tardis segments the tomograms of each target
+TARDIS_PIXEL_SIZES = {
+    TardisSegTargets.actin: 25,
+    TardisSegTargets.membranes: 15,
+    TardisSegTargets.microtubules: 25,
+}
+
+# Parameters to select each target when several of them are segmented
+MULTI_TARGET_PARAMS = {target: f'segment{target.name.capitalize()}' for target in TardisSegTargets}
+
 # Segmentation modes
 class TardisSegModes(Enum):
     instances = 0
     semantic = 1
     both = 2
 
+# Computing devices
+class TardisDevices(Enum):
+    gpu = 0
+    cpu = 1
+
 # Protocol outputs
 class TardisOutputs(Enum):
     segmentations = SetOfTomoMasks
     meshes = SetOfMeshes
+    points = SetOfTomoPoints
 
 
-class ProtTardisSeg(EMProtocol):
+class ProtTardisSeg(EMProtocol, ProtStreamingBase):
     """Semantic or instance segmentation of microtubules, membranes, or actin filaments
-    in tomograms. More info in https://smlc-nysbc.github.io/TARDIS/index.html."""
+    in tomograms. More info in https://smlc-nysbc.github.io/TARDIS/index.html.
+    It works in streaming: the tomograms are segmented as they arrive to the input set."""
 
     _label = 'tomogram segmentation'
     _devStatus = BETA
@@ -80,6 +166,29 @@ class ProtTardisSeg(EMProtocol):
         super().__init__(**kwargs)
         self.inTomosDict = None
         self.failedItems = []
+        self._workers = {}
+        self._busyWorkers = set()
+        self._postprocessingPool = None
+        self._cacheKeys = {}
+        self._tomoHashes = {}
+        self._binFactors = {}
+        self._autoBinFactors = {}
+        self._cpuFallbacks = set()
+        self._deferredFallbacks = {}
+        self._rois = {}
+        self._previewTsIds = set()
+        self._resumedItems = set()
+        self._processedItems = {}
+        self._workersLock = threading.Lock()
+        self._deviceScheduler = None
+        self._appendEnabledOutputs = set()
+        self._uncommittedOutputs = set()
+        self._nUncommittedTomos = 0
+        self._lastCommitTime = time.time()
+
+    @classmethod
+    def worksInStreaming(cls):
+        return True
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -91,14 +200,31 @@ class ProtTardisSeg(EMProtocol):
                       label='Tomograms',
                       help='Set of tomogram to be segmented.')
 
+        form.addParam(MULTI_TARGET, BooleanParam,
+                      label='Segment several targets?',
+                      default=False,
+                      help='If set to Yes, several targets can be segmented in the same execution. Each tomogram '
+                           'is prepared once and the segmentations of all the targets selected are executed one '
+                           'after the other on the same GPU, while the tomogram is still cached in memory by the '
+                           'operating system. There will be an output set per target and kind of output, e. g. '
+                           'segmentationsMembranes or meshesMicrotubules. The thresholds and the rest of '
+                           'parameters introduced are applied to all the targets.')
+
         form.addParam(SEG_TARGET, EnumParam,
                       choices=[TardisSegTargets.actin.name,
                                TardisSegTargets.membranes.name,
                                TardisSegTargets.microtubules.name],
                       default=TardisSegTargets.membranes.value,
+                      condition=f'not {MULTI_TARGET}',
                       label='Select segmentation target',
                       display=EnumParam.DISPLAY_HLIST)
 
+        line = form.addLine('Segmentation targets', condition=MULTI_TARGET)
+        for target in TardisSegTargets:
+            line.addParam(MULTI_TARGET_PARAMS[target], BooleanParam,
+                          label=target.name,
+                          default=target == TardisSegTargets.membranes)
+
         form.addParam(SEG_MODE, EnumParam,
                       choices=[TardisSegModes.instances.name,
                                TardisSegModes.semantic.name,
@@ -117,7 +243,8 @@ class ProtTardisSeg(EMProtocol):
 
         form.addParam('cnnThreshold', FloatParam,
                       default=0.5,
-                      condition=f'{SEG_MODE} in [{TardisSegModes.semantic.value}, {TardisSegModes.both.value}]',
+                      condition=f'not {SWEEP} and '
+                                f'{SEG_MODE} in [{TardisSegModes.semantic.value}, {TardisSegModes.both.value}]',
                       label='Threshold for semantic prediction',
                       validators=[GE(0),LE(1)],
                       help='Float value between 0.0 and 1.0.\n\n'
@@ -129,7 +256,8 @@ class ProtTardisSeg(EMProtocol):
 
         form.addParam('distThreshold', FloatParam,
                       default=0.9,
-                      condition=f'{SEG_MODE} in [{TardisSegModes.instances.value}, {TardisSegModes.both.value}]',
+                      condition=f'not {SWEEP} and '
+                                f'{SEG_MODE} in [{TardisSegModes.instances.value}, {TardisSegModes.both.value}]',
                       label='Threshold for instance prediction',
                       validators=[GE(0),LE(1)],
                       help='Float value between 0.0 and 1.0.\n\n'
@@ -139,7 +267,30 @@ class ProtTardisSeg(EMProtocol):
                            'of the predicted instances, a lower value will increase the number of '
                            'predicted instances.')
 
-        notMembraneSeg = f'{SEG_TARGET} != {TardisSegTargets.membranes.value}'
+        form.addParam(SWEEP, BooleanParam,
+                      label='Sweep several thresholds?',
+                      default=False,
+                      help='If set to Yes, the neural network is executed once per tomogram, keeping its '
+                           'probability map, and the segmentations are obtained from it for each of the thresholds '
+                           'introduced below, without executing the network again. It allows to tune the '
+                           'thresholds at about the cost of a single segmentation. The instances still require a '
+                           'Tardis execution per threshold pair, which skips the semantic segmentation and is much '
+                           'faster. There will be an output set per pair of thresholds and kind of output, '
+                           'e. g. segmentationsSweep1, meshesSweep1, segmentationsSweep2, and so on.')
+
+        form.addParam(SWEEP_THRESHOLDS, StringParam,
+                      label='Thresholds to sweep',
+                      condition=SWEEP,
+                      default='0.25,0.5 0.5,0.9',
+                      help='Space-separated list of pairs "semantic threshold,instance threshold", e. g. '
+                           '"0.25,0.5 0.5,0.9". Each pair generates the outputs with the same number (Sweep1, '
+                           'Sweep2...). The values are between 0 and 1 and the semantic one must be greater than 0. '
+                           'See the help of the thresholds above.')
+
+        filamentTargetParams = [MULTI_TARGET_PARAMS[TardisSegTargets.microtubules],
+                                MULTI_TARGET_PARAMS[TardisSegTargets.actin]]
+        notMembraneSeg = (f'({MULTI_TARGET} and ({" or ".join(filamentTargetParams)})) or '
+                          f'(not {MULTI_TARGET} and {SEG_TARGET} != {TardisSegTargets.membranes.value})')
         filamentStr = f'{TardisSegTargets.microtubules.name}/{TardisSegTargets .actin.name} filaments'
         group = form.addGroup(f'{filamentStr}', condition=notMembraneSeg)
         group.addParam('lenFilter', IntParam,
@@ -170,6 +321,79 @@ class ProtTardisSeg(EMProtocol):
                            f'same direction. The ends of these filaments must be located within this cylinder to '
                            f'be considered connected.')
 
+        form.addParam(USE_ROI, BooleanParam,
+                      label='Segment only a region of the tomograms?',
+                      default=False,
+                      help='If set to Yes, only the region of each tomogram delimited by the ranges below and, '
+                           'optionally, the bounding box of a mask is segmented, e. g. to skip the vacuum above '
+                           'and below the lamella. The segmentation time is roughly proportional to the volume '
+                           'segmented. The region is extracted before the segmentation and the semantic masks and '
+                           'the coordinates of the instances are referred back to the whole tomogram.')
+        group = form.addGroup('Region of interest', condition=USE_ROI)
+        for axis, (firstParam, lastParam) in ROI_PARAMS.items():
+            line = group.addLine(f'{axis} range (px)',
+                                 help=f'First and last {axis} pixel of the region, starting from 0. A negative last '
+                                      f'pixel means the last one of the tomogram.')
+            line.addParam(firstParam, IntParam, label='First', default=0, validators=[GE(0)])
+            line.addParam(lastParam, IntParam, label='Last', default=-1)
+        group.addParam(ROI_MASKS, PointerParam,
+                       pointerClass='SetOfTomoMasks',
+                       allowsNull=True,
+                       label='Masks (opt.)',
+                       help='If provided, the region is also limited to the bounding box of the non-zero voxels of '
+                            'the mask with the same tsId as each tomogram, e. g. a mask of the lamella. The masks '
+                            'may have a different sampling rate than the tomograms. The tomograms without a mask are '
+                            'segmented within the ranges above.')
+        group.addParam(ROI_MASK_MARGIN, IntParam,
+                       label='Margin around the masks (px)',
+                       condition=ROI_MASKS,
+                       default=20,
+                       validators=[GE(0)],
+                       help='The bounding box of each mask is enlarged by this number of pixels of the tomograms, '
+                            'so the objects at its border are not cut.')
+
+        form.addParam(PREVIEW, BooleanParam,
+                      label='Preview on a sample of the tomograms?',
+                      default=False,
+                      help='If set to Yes, only a sample of the tomograms is segmented, binned and limited to the '
+                           'central region of the XY plane, to check in a fraction of the time whether the target '
+                           'and thresholds are right for the dataset. The threshold sweep can be used to compare '
+                           'several thresholds at once. The output sets are named with the suffix Preview, e. g. '
+                           'segmentationsPreview. Once the parameters are chosen, set this to No and continue the '
+                           'protocol (or duplicate it) to segment all the tomograms: the preview outputs and their '
+                           'files (in extra/preview) are kept and the full outputs are created next to them.')
+        group = form.addGroup('Preview', condition=PREVIEW)
+        group.addParam(PREVIEW_SIZE, IntParam,
+                       label='Number of tomograms',
+                       condition=f'not {PREVIEW_TSIDS}',
+                       default=5,
+                       validators=[GE(1)],
+                       help='If the input set is closed, the sample is spread evenly over the tomograms sorted by '
+                            'tsId. If it is being populated (streaming), it is made of the first tomograms that '
+                            'arrive. If a preview is continued with a larger number, the tomograms already '
+                            'previewed are kept and the sample is topped up with the rest of them (spread over '
+                            'the ones not previewed yet), instead of choosing a new sample.')
+        group.addParam(PREVIEW_TSIDS, StringParam,
+                       label='tsIds to preview (opt.)',
+                       default='',
+                       help='Space-separated tsIds of the tomograms to be previewed, instead of a sample of them.')
+        group.addParam(PREVIEW_BIN, IntParam,
+                       label='Binning factor',
+                       default=2,
+                       validators=[GE(1)],
+                       help='The tomograms are binned by this factor before segmenting them. Tardis rescales the '
+                            'tomograms to its own pixel size (15 Å/px for membranes, 25 Å/px for microtubules and '
+                            'actin), so binning beyond it would not be faster and the factor is limited to not '
+                            'exceed that pixel size.')
+        group.addParam(PREVIEW_FRACTION, FloatParam,
+                       label='Fraction of the XY plane segmented',
+                       default=0.5,
+                       validators=[GE(0.05), LE(1)],
+                       help='Only the central region of each tomogram whose X and Y sizes are this fraction of the '
+                            'ones of the tomogram (or of the region of interest, if any) is segmented, so 0.5 '
+                            'segments a quarter of the tomogram. The whole Z range is kept, so the lamella is not '
+                            'cut. 1 segments the whole XY plane.')
+
         form.addParam('boxSize', IntParam,
                       label='Meshes box size (px)',
                       expertLevel=LEVEL_ADVANCED,
@@ -177,98 +401,530 @@ class ProtTardisSeg(EMProtocol):
                       help='The box size is required at coordinates or meshes level by some visualization tools, '
                            'such as Napari or Eman.')
 
+        form.addParam(POINTS_FILES, BooleanParam,
+                      label='Store the instances as point files?',
+                      condition=f'{SEG_MODE} in [{TardisSegModes.instances.value}, {TardisSegModes.both.value}]',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=False,
+                      help='If set to Yes, the output of the instance segmentation is a set of points instead of a '
+                           'set of meshes. The points of each tomogram are stored in a NumPy .npy file, 16 bytes '
+                           'per point (x, y, z and group id), and the set only has an item per tomogram, while a '
+                           'set of meshes stores each point in a row of its sqlite file, which for membranes means '
+                           'tens of millions of rows and several GB. The files are memory-mapped when read, so the '
+                           'points are not loaded until they are used. The classic set of meshes can be generated '
+                           'from the set of points when a protocol or viewer requires it (SetOfTomoPoints.toMeshes).')
+
+        form.addParam(COMPACT_MASKS, BooleanParam,
+                      label='Store the semantic masks as 8-bit?',
+                      condition=f'{SEG_MODE} in [{TardisSegModes.semantic.value}, {TardisSegModes.both.value}]',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=False,
+                      help='If set to Yes, the semantic masks generated by Tardis are re-written as 8-bit MRC '
+                           'files (one byte per voxel), which are up to 4 times smaller than 32-bit ones and so '
+                           'faster to read and write by the downstream protocols and viewers. The conversion is '
+                           'done in chunks of slices, so the masks are never loaded completely in memory.')
+
+        form.addParam(AUTO_BIN, BooleanParam,
+                      label='Bin the tomograms that do not fit in memory?',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=False,
+                      help='If set to Yes, the memory required to segment each tomogram is estimated from its '
+                           'dimensions and sampling rate before launching Tardis. If it exceeds the maximum '
+                           'introduced, the tomogram is binned by the lowest integer factor that makes it fit. '
+                           'Tardis rescales the tomograms to its own pixel size (15 Å/px for membranes, 25 Å/px '
+                           'for microtubules and actin), so the tomograms are never binned beyond that. The '
+                           'semantic masks and the coordinates of the instances are referred back to the '
+                           'original sampling rate of the tomograms.')
+
+        form.addParam(MAX_MEMORY, FloatParam,
+                      label='Memory available per Tardis execution (GB)',
+                      condition=AUTO_BIN,
+                      expertLevel=LEVEL_ADVANCED,
+                      default=16,
+                      validators=[GE(1)],
+                      help='Memory the segmentation of a single tomogram is allowed to use.')
+
+        form.addParam(OOM_RETRIES, IntParam,
+                      label='Retries of the executions that run out of memory',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=2,
+                      validators=[GE(0)],
+                      help='When a Tardis execution fails, its log is inspected. If it ran out of memory, the '
+                           'tomogram is segmented again with the next configuration of the fallback ladder, up '
+                           'to this number of times. Other failures are not retried. 0 disables the retries.')
+
+        form.addParam(OOM_FALLBACKS, StringParam,
+                      label='Fallback ladder',
+                      condition=f'{OOM_RETRIES} > 0',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=f'bin2 {FALLBACK_CPU}',
+                      help='Space-separated configurations tried, in order, when a Tardis execution runs out of '
+                           'memory. Each one is applied on top of the previous ones:\n'
+                           '  - *binN*: the tomogram is binned by N (an integer >= 2). The results are referred '
+                           'back to the original sampling rate.\n'
+                           f'  - *{FALLBACK_CPU}*: Tardis is executed on CPU, using the threads per execution '
+                           'introduced for the CPU execution.\n'
+                           'E. g. "bin2 bin2 cpu" bins by 2, then by 4 and finally runs the latter on CPU.')
+
+        form.addParam(BATCH_SIZE, IntParam,
+                      label='Tomograms per Tardis execution',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=1,
+                      validators=[GE(1)],
+                      help='Number of tomograms segmented by each Tardis execution. If greater than 1, the '
+                           'tomograms are grouped in batches and each batch is segmented by a single Tardis '
+                           'execution, so the process start and the model loading are paid once per batch '
+                           'instead of once per tomogram. The results are split back per tomogram once the '
+                           'batch has been segmented. When the input set is being populated (streaming), a batch '
+                           'is launched once it is complete or when the input set is closed.')
+
+        form.addParam(USE_ARRAY_JOB, BooleanParam,
+                      label='Submit the segmentations as a cluster array job?',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=False,
+                      help='If set to Yes, the Tardis executions are not run in the computer of the protocol but '
+                           'submitted to the queue system of its host, as configured in Scipion (hosts.conf), as '
+                           'a single array job with a task per tomogram, or per batch of tomograms, and target. '
+                           'Each task runs on the node and GPU the queue system assigns to it, so the segmentation '
+                           'is spread over all the nodes available. The protocol follows the tasks through the '
+                           'results they generate and creates the outputs as usual. When the input set is being '
+                           'populated (streaming), an array job is submitted with the tomograms found in each '
+                           'check. The option of the submission command that makes the job an array is taken '
+                           'from the variable TARDIS_ARRAY_OPTION of the Scipion configuration, followed by the '
+                           'number of tasks (--array=1- by default, for Slurm). The executions that run out of '
+                           'memory are not retried and the threshold sweep is not available in this mode.')
+
+        form.addParam(USE_WORKER, BooleanParam,
+                      label='Keep the model loaded between tomograms?',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=False,
+                      help='If set to Yes, a Tardis process is launched per GPU (one per concurrent execution if '
+                           'there are several per GPU) and kept alive during the whole execution, so the tomograms are sent to it instead of launching a new Tardis execution '
+                           'for each of them. This saves the environment activation, the libraries import and the '
+                           'model loading for each tomogram. The output of Tardis is written in a file named '
+                           'tardis.log in the directory of each tomogram.')
+
+        form.addParam(USE_CACHE, BooleanParam,
+                      label='Use the results cache?',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=True,
+                      help='Only used if the variable TARDIS_CACHE_DIR is defined in the Scipion configuration. '
+                           'If set to Yes, the results of each tomogram are stored in that directory, identified '
+                           'by the contents of the tomogram, the segmentation target and parameters and the '
+                           'Tardis version. Any later segmentation of the same tomogram with the same parameters '
+                           'will take the results from there instead of running Tardis again. The least recently '
+                           'used results are removed when the cache exceeds TARDIS_CACHE_MAX_SIZE (GB).')
+
+        form.addParam(DEVICE, EnumParam,
+                      choices=[TardisDevices.gpu.name.upper(),
+                               TardisDevices.cpu.name.upper()],
+                      default=TardisDevices.gpu.value,
+                      label='Run Tardis on',
+                      display=EnumParam.DISPLAY_HLIST,
+                      help='CPU execution is much slower than the GPU one, but it allows to segment the '
+                           'tomograms in computers without GPUs.')
+
+        form.addParam(CPU_THREADS_PER_JOB, IntParam,
+                      label='Threads per Tardis execution',
+                      condition=f'{DEVICE} == {TardisDevices.cpu.value}',
+                      default=4,
+                      validators=[GE(1)],
+                      help='Number of threads used by each Tardis execution on CPU. Several tomograms are '
+                           'segmented simultaneously, as many as fit in the threads of the protocol (one of them '
+                           'is reserved to generate the steps), so the cores are never oversubscribed. If the '
+                           'protocol has fewer threads, each execution uses all the available ones.')
+
         form.addHidden(GPU_LIST, StringParam,
                        default='0',
                        label="Choose GPU IDs")
-        form.addParallelSection(threads=2, mpi=0)
+
+        form.addParam(JOBS_PER_GPU, IntParam,
+                      label='Concurrent Tardis executions per GPU',
+                      condition=f'{DEVICE} == {TardisDevices.gpu.value}',
+                      expertLevel=LEVEL_ADVANCED,
+                      default=1,
+                      validators=[GE(1)],
+                      help='The segmentations are distributed among the GPUs introduced, launching each one in the '
+                           'least loaded GPU, with up to this number of simultaneous executions per GPU. To keep '
+                           'all the GPUs busy, the number of threads should be at least the number of GPUs times '
+                           'this value plus one (the thread that generates the steps).')
+        form.addParallelSection(threads=3, mpi=0)
 
     # --------------------------- STEPS functions ------------------------------
-    def _insertAllSteps(self):
-        closeSetDeps = []
+    def stepsGeneratorStep(self) -> None:
+        """Inserts the steps of the tomograms as they arrive to the input set, grouped in batches of the
+        size introduced. The output sets are closed once the input set is closed and all its tomograms
+        have been processed."""
         self._initialize()
-        for tsId in self.inTomosDict.keys():
-            cId = self._insertFunctionStep(self.convertInputStep, tsId,
-                                           prerequisites=[],
-                                           needsGPU=False)
-            segId = self._insertFunctionStep(self.segmentStep, tsId,
-                                             prerequisites=cId,
-                                             needsGPU=True)
-            cOutId = self._insertFunctionStep(self.createOutputStep, tsId,
-                                              prerequisites=segId,
-                                              needsGPU=False)
-            closeSetDeps.append(cOutId)
-        self._insertFunctionStep(self.closeOutputSetStep)
+        batchSize = getattr(self, BATCH_SIZE).get()
+        inTomos = self._getInTomos()
+        # A tomogram is skipped if it is in the outputs of all the targets
+        processedTsIds = set.intersection(*self._processedItems.values())
+        self._previewTsIds = set(processedTsIds)  # The outputs of a preview only have the tomograms of its sample
+        pendingTsIds = []
+        closeSetDeps = []
+        batchId = 0
+        while True:
+            with self._lock:
+                streamOpen = inTomos.isStreamOpen()  # Before reading the items, so the last ones are not missed
+                newTomos = [tomo.clone() for tomo in inTomos.iterItems()
+                            if tomo.getTsId() not in self.inTomosDict and tomo.getTsId() not in processedTsIds]
+            if self._isPreview():
+                newTomos = self._selectPreviewTomos(newTomos, streamOpen)
+            # A preview does not wait for the rest of the input set once its sample is complete
+            inputDone = not streamOpen or (self._isPreview() and self._isPreviewComplete())
+            for tomo in newTomos:
+                tsId = tomo.getTsId()
+                self.inTomosDict[tsId] = tomo
+                pendingTsIds.append(tsId)
+                logger.info(cyanStr(f'tsId = {tsId}: new tomogram to segment'))
+            # The last batch may be incomplete if the input set is closed
+            arrayBatches = []
+            while len(pendingTsIds) >= batchSize or (pendingTsIds and inputDone):
+                batchId += 1
+                tsIds, pendingTsIds = pendingTsIds[:batchSize], pendingTsIds[batchSize:]
+                if self._useArrayJob():
+                    arrayBatches.append((batchId, tsIds))
+                else:
+                    closeSetDeps.extend(self._insertSegmentationSteps(batchId, tsIds))
+            if arrayBatches:  # The batches found in this check are segmented by the same array job
+                closeSetDeps.extend(self._insertArrayJobSteps(arrayBatches))
+            if inputDone:
+                logger.info(cyanStr('Input set closed.' if not streamOpen else 'Preview sample complete.'))
+                break
+            time.sleep(STREAMING_CHECK_SECS)
+            with self._lock:
+                inTomos.loadAllProperties()  # Refresh the stream state
+                # The tomograms already appended are not kept out of the outputs until the next one finishes
+                self._commitOutputs()
+        self._insertFunctionStep(self.closeOutputSetStep,
+                                 prerequisites=closeSetDeps,
+                                 needsGPU=False)
+
+    def _insertSegmentationSteps(self, batchId: int, tsIds: List[str]) -> List[int]:
+        """Inserts the steps to segment a batch of tomograms. Returns the ids of their output steps."""
+        cIds = [self._insertFunctionStep(self.convertInputStep, tsId,
+                                         prerequisites=[],
+                                         needsGPU=False) for tsId in tsIds]
+        if getattr(self, BATCH_SIZE).get() == 1:
+            segId = self._insertFunctionStep(self.segmentStep, tsIds[0],
+                                             prerequisites=cIds,
+                                             needsGPU=False)  # The GPUs are handed out by the device scheduler
+        else:
+            segId = self._insertFunctionStep(self.segmentBatchStep, batchId, tsIds,
+                                             prerequisites=cIds,
+                                             needsGPU=False)
+        return [self._insertFunctionStep(self.createOutputStep, tsId,
+                                         prerequisites=segId,
+                                         needsGPU=False) for tsId in tsIds]
+
+    def _insertArrayJobSteps(self, batches: List[Tuple[int, List[str]]]) -> List[int]:
+        """Inserts the steps to segment several batches of tomograms in a cluster array job. Returns the ids
+        of their output steps."""
+        tsIds = [tsId for _, batchTsIds in batches for tsId in batchTsIds]
+        cIds = [self._insertFunctionStep(self.convertInputStep, tsId,
+                                         prerequisites=[],
+                                         needsGPU=False) for tsId in tsIds]
+        segId = self._insertFunctionStep(self.segmentArrayStep, batches,
+                                         prerequisites=cIds,
+                                         needsGPU=False)  # The GPUs are assigned by the queue system
+        return [self._insertFunctionStep(self.createOutputStep, tsId,
+                                         prerequisites=segId,
+                                         needsGPU=False) for tsId in tsIds]
 
     def _initialize(self):
-        self.inTomosDict = {tomo.getTsId(): tomo.clone() for tomo in self._getInTomos()}
-        target = getattr(self, SEG_TARGET).get()
-        if target == TardisSegTargets.actin.value:
-            self.program = 'tardis_actin'
-        elif target == TardisSegTargets.membranes.value:
-            self.program = 'tardis_mem'
-        else:  # Microtubules
-            self.program = 'tardis_mt'
+        self.inTomosDict = {}
+        if self._useCpu():
+            # The thread that generates the steps is not available for the Tardis executions
+            nJobs = max(1, (self.numberOfThreads.get() - 1) // self._getCpuThreadsPerJob())
+            self._deviceScheduler = DeviceScheduler([f'{CPU_SLOT_PREFIX}{i}' for i in range(nJobs)])
+        else:
+            self._deviceScheduler = DeviceScheduler(self.getGpuList() or ['0'], getattr(self, JOBS_PER_GPU).get())
+        self._processedItems = self._getProcessedItems()
 
     def convertInputStep(self, tsId):
         logger.info(cyanStr(f'===> tsId = {tsId}: creating the files/folders needed...'))
-        tomo = self.inTomosDict[tsId]
-        tomoPath = self._getExtraPath(tsId)
+        if all(self._loadSegmentationMarker(tsId, target) for target in self._getTargets()):
+            logger.info(cyanStr(f'tsId = {tsId}: already segmented by a previous execution'))
+            return
+        tomoPath = self._getCurrentTomoDir(tsId)
         makePath(tomoPath)
-        createLink(tomo.getFileName(), self._getCurrentTomoFile(tsId))
+        tomoFile = self._getCurrentTomoFile(tsId)
+        from tardis.utils import binMrc
+        cleanPath(tomoFile)  # It may come from a previous execution
+        self._convertInputTomo(tsId)
+        factor = self._getAutoBinningFactor(tsId)
+        if factor > 1:
+            logger.info(cyanStr(f'tsId = {tsId}: binning the tomogram by {factor}...'))
+            binMrc(self._getInputTomoFile(tsId), tomoFile, factor)
+        else:
+            createLink(self._getInputTomoFile(tsId), tomoFile)
+        for target in self._getTargets():
+            targetTomoFile = self._getTargetTomoFile(tsId, target)
+            if targetTomoFile != tomoFile:  # All the targets share the same prepared tomogram
+                makePath(self._getTargetDir(tsId, target))
+                cleanPath(targetTomoFile)
+                createLink(tomoFile, targetTomoFile)
+            if self._getResultsCache():
+                self._getCacheKey(tsId, target)  # Hash it here to keep it out of the GPU steps
 
     def segmentStep(self, tsId: str):
         logger.info(cyanStr(f'===> tsId = {tsId}: segmenting...'))
-        logger.info(cyanStr('NOTE: The first time Tardis is executed for each segmentation target, it '
-                            'automatically downloads some model_weights file and place them into a hidden '
-                            'directory named .tardis_em and located in /home/username'))
+        pendingTargets = [target for target in self._getTargets() if not self._loadSegmentationMarker(tsId, target)]
+        targets = [target for target in pendingTargets if not self._loadFromCache(tsId, target)]
+        if targets or (self._isSweep() and pendingTargets):
+            self._logModelWeightsNote()
+            # The targets are segmented one after the other on the same device, while the prepared tomogram is
+            # still cached in memory
+            with self._deviceScheduler.acquire() as device:
+                for target in targets:
+                    ok, outOfMemory = self._segmentOnce(tsId, target, device)
+                    if not ok and outOfMemory:
+                        ok = self._retryWithFallbacks(tsId, target, device)
+                    self._registerSegmentation(tsId, target, ok)
+                self._sweepThresholds([(tsId, target) for target in pendingTargets], device)
+            self._retryOnCpu([(tsId, target) for target in targets])
+        for target in pendingTargets:
+            self._saveSegmentationMarker(tsId, target)
+
+    def segmentBatchStep(self, batchId: int, tsIds: List[str]):
+        logger.info(cyanStr(f'===> batch {batchId}: segmenting tsIds {tsIds}...'))
+        pendingItems = [(tsId, target) for target in self._getTargets() for tsId in tsIds
+                        if not self._loadSegmentationMarker(tsId, target)]
+        pendingTsIds = {target: [tsId for tsId, itemTarget in pendingItems
+                                 if itemTarget == target and not self._loadFromCache(tsId, target)]
+                        for target in self._getTargets()}
+        if any(pendingTsIds.values()) or (self._isSweep() and pendingItems):
+            self._logModelWeightsNote()
+            # The whole batch, with all its targets, is segmented on the same device
+            with self._deviceScheduler.acquire() as device:
+                for target, targetTsIds in pendingTsIds.items():
+                    # Tardis applies the same pixel size to all the tomograms of an execution, so the tomograms
+                    # binned by different factors are segmented separately
+                    groups = {}
+                    for tsId in targetTsIds:
+                        groups.setdefault(self._getBinningFactor(tsId, target), []).append(tsId)
+                    for factor, groupTsIds in groups.items():
+                        self._segmentBatchGroup(batchId, target, factor, groupTsIds, device)
+                    for tsId in targetTsIds:
+                        item = (tsId, target)
+                        if item not in self.failedItems and item not in self._deferredFallbacks:
+                            self._saveInCache(tsId, target)
+                self._sweepThresholds(pendingItems, device)
+            self._retryOnCpu(pendingItems)
+        for tsId, target in pendingItems:
+            self._saveSegmentationMarker(tsId, target)
+
+    def segmentArrayStep(self, batches: List[Tuple[int, List[str]]]):
+        arrayId = batches[0][0]
+        logger.info(cyanStr(f'===> array job {arrayId}: segmenting tsIds '
+                            f'{[tsId for _, tsIds in batches for tsId in tsIds]}...'))
+        pendingItems = []
+        tasks = []
+        taskItems = []  # (batchId, batch directory, target, tsIds) of each task
+        for batchId, tsIds in batches:
+            batchItems = [(tsId, target) for target in self._getTargets() for tsId in tsIds
+                          if not self._loadSegmentationMarker(tsId, target)]
+            pendingItems.extend(batchItems)
+            for target in self._getTargets():
+                targetTsIds = [tsId for tsId, itemTarget in batchItems
+                               if itemTarget == target and not self._loadFromCache(tsId, target)]
+                if getattr(self, BATCH_SIZE).get() == 1:
+                    for tsId in targetTsIds:
+                        tasks.append(self._getArrayTask(target, self._getCmdArgs(tsId, target),
+                                                        self._getTargetDir(tsId, target),
+                                                        self._getTardisLogFile(tsId, target),
+                                                        [self._getOutputFileName(tsId, target, suffix, ext)
+                                                         for suffix, ext in self._getExpectedOutputs()]))
+                        taskItems.append((batchId, None, target, [tsId]))
+                    continue
+                groups = {}  # By binning factor, as in segmentBatchStep
+                for tsId in targetTsIds:
+                    groups.setdefault(self._getBinningFactor(tsId, target), []).append(tsId)
+                for factor, groupTsIds in groups.items():
+                    batchDir = self._prepareBatchDir(batchId, target, factor, groupTsIds)
+                    tasks.append(self._getArrayTask(target, self._getCmdArgs(groupTsIds[0], target, path='.'),
+                                                    batchDir, join(batchDir, 'tardis.log'),
+                                                    [join(batchDir, 'Predictions', f'{tsId}_{suffix}.{ext}')
+                                                     for tsId in groupTsIds
+                                                     for suffix, ext in self._getExpectedOutputs()]))
+                    taskItems.append((batchId, batchDir, target, groupTsIds))
+        if tasks:
+            self._logModelWeightsNote()
+            try:
+                succeeded = self._runArrayJob(arrayId, tasks)
+            except Exception as e:
+                logger.error(redStr(f'Array job {arrayId} failed -> {e}'))
+                succeeded = [False] * len(tasks)
+            for ok, (batchId, batchDir, target, tsIds) in zip(succeeded, taskItems):
+                if batchDir is not None:
+                    self._splitBatchResults(batchId, batchDir, target, tsIds)
+                elif not ok:
+                    logger.error(redStr(f'tsId = {tsIds[0]}: Tardis execution failed in array job {arrayId} '
+                                        f'({target.name})'))
+                    self.failedItems.append((tsIds[0], target))
+                for tsId in tsIds:
+                    if (tsId, target) not in self.failedItems:
+                        self._saveInCache(tsId, target)
+        for tsId, target in pendingItems:
+            self._saveSegmentationMarker(tsId, target)
+
+    def _prepareBatchDir(self, batchId: int, target: TardisSegTargets, factor: int, tsIds: List[str]) -> str:
+        """Creates the directory of a Tardis execution that segments several tomograms, with a link to each
+        of them. Returns its path. Tardis segments all the tomograms of the directory, so the ones linked for a
+        previous batch with the same id (the batch ids start from 1 in each execution of the protocol) and its
+        results are removed first."""
+        batchDir = self._getBatchDir(batchId, target, factor)
+        if exists(batchDir):
+            for fn in os.listdir(batchDir):
+                if fn.endswith('.mrc'):
+                    os.remove(join(batchDir, fn))  # Also the broken links, which cleanPath skips
+            cleanPath(join(batchDir, 'Predictions'))
+        makePath(batchDir)
+        for tsId in tsIds:
+            createLink(self._getTargetTomoFile(tsId, target), join(batchDir, f'{tsId}.mrc'))
+        return batchDir
+
+    def _segmentBatchGroup(self, batchId: int, target: TardisSegTargets, factor: int, tsIds: List[str],
+                           device: str):
+        from tardis.utils import isOutOfMemoryError
+        batchDir = self._prepareBatchDir(batchId, target, factor, tsIds)
+        logFile = join(batchDir, 'tardis.log')
+        logOffset = getsize(logFile) if exists(logFile) else 0
+        outOfMemory = False
         try:
-            args = self._getCmdArgs(tsId)
-            Plugin.runTardis(self, self.program, args, cwd=self._getCurrentTomoDir(tsId))
+            # All the tomograms of the set share the sampling rate, so the arguments of any of them are valid
+            args = self._getCmdArgs(tsIds[0], target, path='.')
+            self._runTardis(target, args, batchDir, logFile, device)
         except Exception as e:
-            self.failedItems.append(tsId)
-            logger.error(redStr(f'Tardis execution failed for tsId {tsId} -> {e}'))
+            logger.error(redStr(f'Tardis execution failed for batch {batchId} ({target.name}) -> {e}'))
+            outOfMemory = isOutOfMemoryError(logFile, logOffset, str(e))
+        self._splitBatchResults(batchId, batchDir, target, tsIds)
+        if outOfMemory:
+            # The tomograms without results are retried one by one
+            for tsId in [tsId for tsId in tsIds if (tsId, target) in self.failedItems]:
+                self.failedItems.remove((tsId, target))
+                ok = self._retryWithFallbacks(tsId, target, device)
+                if not ok and (tsId, target) not in self._deferredFallbacks:
+                    self.failedItems.append((tsId, target))
 
     def createOutputStep(self, tsId: str):
         logger.info(cyanStr(f'===> tsId = {tsId}: Creating the results...'))
+        segMode = self._getSegmentationMode()
+        # The results are prepared in the post-processing pool, all of them at once, and out of the lock, so
+        # it is only held to register them
+        pending = []
+        failedTargets = []
+        for target in self._getTargets():
+            if tsId in self._processedItems[target]:  # Registered by a previous execution
+                continue
+            if (tsId, target) in self.failedItems:
+                failedTargets.append(target)
+                continue
+            try:
+                for sweepId in self._getSweepIds():
+                    semanticJob = None if segMode == TardisSegModes.instances.value else (
+                        self._submitSemanticPreparation(tsId, target, sweepId))
+                    instancesJob = None if segMode == TardisSegModes.semantic.value else (
+                        self._submitInstancesPreparation(tsId, target, sweepId))
+                    pending.append((target, sweepId, semanticJob, instancesJob))
+            except Exception as e:
+                logger.error(redStr(f'tsId =  {tsId}: Output creation failed ({target.name}) -> {e}'))
+                failedTargets.append(target)
+        results = []
+        for target, sweepId, semanticJob, instancesJob in pending:
+            try:
+                tomoMask = None if semanticJob is None else (
+                    self._prepareSemanticOutput(tsId, target, semanticJob.result(), sweepId))
+                points = None if instancesJob is None else (
+                    self._prepareInstanceOutput(tsId, target, instancesJob.result(), sweepId))
+                results.append((target, sweepId, tomoMask, points))
+            except Exception as e:
+                logger.error(redStr(f'tsId =  {tsId}: Output creation failed ({target.name}) -> {e}'))
+                failedTargets.append(target)
+        for target in {target for target, _, _, _ in results if target not in failedTargets}:
+            # The semantic masks are modified in place, so it must be known if it was already done
+            self._saveSegmentationMarker(tsId, target, prepared=True)
         with self._lock:
-            if tsId in self.failedItems:
-                self._createFailedOutput(tsId)
-            else:
+            for target, sweepId, tomoMask, points in results:
+                if target in failedTargets:
+                    continue
                 try:
-                    segMode = self._getSegmentationMode()
-                    if segMode == TardisSegModes.both.value:
-                        self._createSemanticOutput(tsId)
-                        self._createInstanceOutput(tsId)
-                    elif segMode == TardisSegModes.semantic.value:
-                        self._createSemanticOutput(tsId)
-                    else:  # instance
-                        self._createInstanceOutput(tsId)
+                    if tomoMask is not None:
+                        self._createSemanticOutput(tomoMask, target, sweepId)
+                    if points is not None:
+                        self._createInstanceOutput(tsId, target, points, sweepId)
                 except Exception as e:
-                    logger.error(redStr(f'tsId =  {tsId}: Output creation failed -> {e}'))
-                    self._createFailedOutput(tsId)
+                    logger.error(redStr(f'tsId =  {tsId}: Output creation failed ({target.name}) -> {e}'))
+                    failedTargets.append(target)
+            for target in failedTargets:
+                self._createFailedOutput(tsId, target)
+            self._nUncommittedTomos += 1
+            self._commitOutputs()
 
     def closeOutputSetStep(self):
-        segMode = self._getSegmentationMode()
-        outputSegs = getattr(self, self._possibleOutputs.segmentations.name, None)
-        outputMeshes = getattr(self, self._possibleOutputs.meshes.name, None)
-        noOutputCheckVal = None
-        if segMode == TardisSegModes.both.value:
-            output = [outputSegs, outputMeshes]
-            noOutputCheckVal = [None, None]
-        elif segMode == TardisSegModes.semantic.value:
-            output = outputSegs
-        else:  # instance
-            output = outputMeshes
-
-        if output == noOutputCheckVal:
+        self._stopWorkers()
+        self._stopPostprocessingPool()
+        with self._lock:
+            self._commitOutputs(force=True)
+        outputs = [getattr(self, self._getOutputName(output.name, target, sweepId), None)
+                   for target in self._getTargets()
+                   for sweepId in self._getSweepIds()
+                   for output in self._getExpectedOutputSets()]
+        if not any(output is not None for output in outputs):
             raise Exception('No Tardis results were generated. Maybe the tomograms are too large '
-                            'for the GPU/s used. Consider to bin them before.')
+                            'for the GPU/s used. Consider to bin them before or to enable the automatic '
+                            'binning in the advanced parameters.')
         else:
             self._closeOutputSet()
 
     # --------------------------- INFO functions ------------------------------------
+    def _validate(self):
+        errors = []
+        self._validateThreads(errors)
+        if getattr(self, MULTI_TARGET).get() and not self._getTargets():
+            errors.append('Select at least one segmentation target.')
+        if getattr(self, OOM_RETRIES).get() > 0:
+            for fallback in self._getOomFallbacks():
+                match = FALLBACK_BIN_REGEX.match(fallback)
+                if fallback != FALLBACK_CPU and (match is None or int(match.group(1)) < 2):
+                    errors.append(f'Unknown fallback configuration "{fallback}". The valid ones are '
+                                  f'{FALLBACK_CPU} and binN, with N an integer >= 2.')
+        if self._isSweep():
+            try:
+                thresholds = self._getSweepThresholds()
+            except ValueError:
+                thresholds = None
+            if (not thresholds or any(len(pair) != 2 for pair in thresholds) or
+                    any(not (0 < cnn <= 1 and 0 <= dist <= 1) for cnn, dist in thresholds)):
+                errors.append('The thresholds to sweep must be space-separated pairs "semantic threshold,instance '
+                              'threshold", with values between 0 and 1, the semantic ones greater than 0.')
+        if self._useArrayJob():
+            hostConfig = self.getHostConfig()
+            if hostConfig is not None and not hostConfig.getQueueSystem().hasName():
+                errors.append('Submitting the segmentations as an array job requires a queue system configured '
+                              'for the host of the protocol (hosts.conf).')
+            if self._isSweep():
+                errors.append('The threshold sweep is not available when the segmentations are submitted as an '
+                              'array job.')
+        if getattr(self, USE_ROI).get():
+            for axis, (firstParam, lastParam) in ROI_PARAMS.items():
+                last = getattr(self, lastParam).get()
+                if 0 <= last < getattr(self, firstParam).get():
+                    errors.append(f'The last {axis} pixel of the region of interest is lower than the first one.')
+        return errors
 
     # --------------------------- UTILS functions -----------------------------------
+    def getPointsIndex(self, tsId: str, target: TardisSegTargets = None, sweepId: int = None) -> 'PointsIndex':
+        """Returns the spatial index of the points of a tomogram in the output meshes or points, to look for the
+        points in a region, e. g. around a position, without reading all of them, and get the number
+        of points, bounding box and centroid of each instance (group id). The target is only required
+        when several targets were segmented and the sweep id (starting from 1) when several thresholds
+        were swept."""
+        from tardis.spatial import PointsIndex
+        target = self._getTargets()[0] if target is None else target
+        return PointsIndex.load(self._getPointsIndexFile(tsId, target, sweepId))
+
     def _getInTomos(self, returnPointer: bool = False) -> Union[SetOfTomoMasks, Pointer]:
         inTomosPointer = getattr(self, IN_TOMOS)
         return inTomosPointer if returnPointer else inTomosPointer.get()
@@ -276,16 +932,656 @@ class ProtTardisSeg(EMProtocol):
     def _getSegmentationMode(self):
         return getattr(self, SEG_MODE).get()
 
+    def _isPreview(self) -> bool:
+        return getattr(self, PREVIEW).get()
+
+    def _getPreviewTsIdsParam(self) -> List[str]:
+        return getattr(self, PREVIEW_TSIDS).get('').split()
+
+    def _selectPreviewTomos(self, tomos: list, streamOpen: bool) -> list:
+        """Returns the tomograms of the preview sample among the ones that have just arrived: the ones of the
+        tsIds introduced or, if none, a sample of them spread evenly over the tsIds if the input set is closed,
+        or the first ones that arrive if it is being populated, up to the size of the sample."""
+        selectedTsIds = self._getPreviewTsIdsParam()
+        if selectedTsIds:
+            selected = [tomo for tomo in tomos if tomo.getTsId() in selectedTsIds]
+        else:
+            missing = max(0, getattr(self, PREVIEW_SIZE).get() - len(self._previewTsIds))
+            tomos = sorted(tomos, key=lambda tomo: tomo.getTsId())
+            if streamOpen or missing >= len(tomos):
+                selected = tomos[:missing]
+            elif missing == 1:
+                selected = [tomos[len(tomos) // 2]]
+            else:
+                selected = [tomos[round(i * (len(tomos) - 1) / (missing - 1))] for i in range(missing)]
+        self._previewTsIds.update(tomo.getTsId() for tomo in selected)
+        return selected
+
+    def _isPreviewComplete(self) -> bool:
+        selectedTsIds = self._getPreviewTsIdsParam()
+        if selectedTsIds:
+            return self._previewTsIds.issuperset(selectedTsIds)
+        return len(self._previewTsIds) >= getattr(self, PREVIEW_SIZE).get()
+
+    def _isSweep(self) -> bool:
+        return getattr(self, SWEEP).get()
+
+    def _getSweepThresholds(self) -> List[Tuple[float, float]]:
+        """Returns the pairs (semantic threshold, instance threshold) of the sweep."""
+        pairs = getattr(self, SWEEP_THRESHOLDS).get('').split()
+        return [tuple(float(value) for value in pair.split(',')) for pair in pairs]
+
+    def _getSweepIds(self) -> List[Union[int, None]]:
+        """Returns the ids, starting from 1, of the pairs of thresholds of the sweep, or [None] without sweep."""
+        return list(range(1, len(self._getSweepThresholds()) + 1)) if self._isSweep() else [None]
+
+    def _isMultiTarget(self) -> bool:
+        return getattr(self, MULTI_TARGET).get()
+
+    def _getTargets(self) -> List[TardisSegTargets]:
+        if self._isMultiTarget():
+            return [target for target in TardisSegTargets if getattr(self, MULTI_TARGET_PARAMS[target]).get()]
+        return [TardisSegTargets(getattr(self, SEG_TARGET).get())]
+
+    def _convertInputTomo(self, tsId: str):
+        """Converts the input tomogram if Tardis can't read it as it is, e. g. a volume of a stack or a file with
+        another format. The MRC files are converted in chunks, without loading the whole tomogram in memory."""
+        from tardis.utils import getConversionReason, convertMrc
+        index, fileName = self.inTomosDict[tsId].getLocation()
+        fileName = fileName.replace(':mrc', '')
+        convertedFile = self._getConvertedTomoFile(tsId)
+        cleanPath(convertedFile)  # It may come from a previous execution
+        reason = getConversionReason(fileName, index)
+        roi = self._getRoi(tsId)
+        if reason is None and roi is None:
+            return
+        if reason is not None:
+            logger.info(cyanStr(f'tsId = {tsId}: converting the tomogram ({reason})...'))
+        if roi is not None:
+            logger.info(cyanStr(f'tsId = {tsId}: extracting the region of interest {self._formatRoi(roi)}...'))
+        if reason is not None and reason.startswith('not an MRC file'):
+            # The image library of Scipion reads the other formats, loading the whole tomogram
+            from pwem.emlib.image import ImageHandler
+            ImageHandler().convert((index, fileName), convertedFile)
+            if roi is not None:
+                convertMrc(convertedFile, convertedFile, roi=roi)
+        else:
+            convertMrc(fileName, convertedFile, index, roi)
+
+    def _getRoi(self, tsId: str) -> Union['Roi', None]:
+        """Returns the region of a tomogram to be segmented, as ((x0, x1), (y0, y1), (z0, z1)) in pixels, ends
+        excluded, or None if the whole tomogram is segmented."""
+        if tsId not in self._rois:
+            roi = self._computeRoi(tsId) if getattr(self, USE_ROI).get() else None
+            self._rois[tsId] = self._getPreviewRoi(tsId, roi) if self._isPreview() else roi
+        return self._rois[tsId]
+
+    def _computeRoi(self, tsId: str) -> Union['Roi', None]:
+        from tardis.utils import getMaskBoundingBox, getMrcDims
+        dims = self._getInputTomoDims(tsId)
+        roi = []
+        for dim, (firstParam, lastParam) in zip(dims, ROI_PARAMS.values()):
+            last = getattr(self, lastParam).get()
+            last = dim - 1 if last < 0 else min(last, dim - 1)
+            roi.append((getattr(self, firstParam).get(), last + 1))
+        roiMasks = getattr(self, ROI_MASKS).get()
+        if roiMasks is not None:
+            with self._lock:
+                mask = next(iter(roiMasks.iterItems(where=f'_tsId="{tsId}"')), None)
+                maskFile = None if mask is None else mask.getFileName()
+            boundingBox = None if maskFile is None else getMaskBoundingBox(maskFile)
+            if boundingBox is None:
+                logger.warning(redStr(f'tsId = {tsId}: no mask or empty mask, the region of interest is not '
+                                      f'limited by it'))
+            else:
+                # The masks may have a different size, e. g. if they were computed at another sampling rate
+                margin = getattr(self, ROI_MASK_MARGIN).get()
+                maskDims = getMrcDims(maskFile)
+                roi = [(max(first, int((lo * dim) // maskDim) - margin),
+                        min(end, -int((-hi * dim) // maskDim) + margin))
+                       for (first, end), (lo, hi), dim, maskDim in zip(roi, boundingBox, dims, maskDims)]
+        if any(first >= end for first, end in roi):
+            raise ValueError(f'tsId = {tsId}: the region of interest {self._formatRoi(roi)} is empty (tomogram '
+                             f'dimensions {dims})')
+        return None if roi == [(0, dim) for dim in dims] else tuple(roi)
+
+    def _getPreviewRoi(self, tsId: str, roi: Union['Roi', None]) -> Union['Roi', None]:
+        """Returns the central region of the XY plane of the region of interest (or of the whole tomogram)
+        segmented by a preview."""
+        fraction = getattr(self, PREVIEW_FRACTION).get()
+        roi = roi or tuple((0, dim) for dim in self._getInputTomoDims(tsId))
+        previewRoi = []
+        for axis, (first, end) in enumerate(roi):
+            if axis < 2:
+                size = max(1, round((end - first) * fraction))
+                first += (end - first - size) // 2
+                end = first + size
+            previewRoi.append((first, end))
+        return None if previewRoi == [(0, dim) for dim in self._getInputTomoDims(tsId)] else tuple(previewRoi)
+
+    @staticmethod
+    def _formatRoi(roi: 'Roi') -> str:
+        return ', '.join(f'{axis} [{first}, {end - 1}]' for axis, (first, end) in zip('XYZ', roi))
+
+    def _getInputTomoDims(self, tsId: str) -> Tuple[int, int, int]:
+        """Returns the dimensions (x, y, z) of the input tomogram, before extracting the region of interest."""
+        x, y, z = self.inTomosDict[tsId].getDim()
+        return x, y, z
+
+    def _getInputTomoFile(self, tsId: str) -> str:
+        """Returns the file of the input tomogram Tardis can read: the converted one if it had to be converted."""
+        convertedFile = self._getConvertedTomoFile(tsId)
+        return convertedFile if exists(convertedFile) else self.inTomosDict[tsId].getFileName().replace(':mrc', '')
+
+    def _getConvertedTomoFile(self, tsId: str) -> str:
+        return join(self._getCurrentTomoDir(tsId), f'{tsId}_converted.mrc')
+
     def _getCurrentTomoDir(self, tsId: str) -> str:
-        return self._getExtraPath(tsId)
+        return self._getSegmentationPath(tsId)
+
+    def _getSegmentationPath(self, *paths: str) -> str:
+        """Returns a path of the extra directory in which the tomograms are segmented. The previews have their
+        own directory, as they segment a binned part of the tomograms whose results must not be taken as the
+        ones of a full segmentation, and the files of their outputs are kept."""
+        return self._getExtraPath(PREVIEW_DIR, *paths) if self._isPreview() else self._getExtraPath(*paths)
 
     def _getCurrentTomoFile(self, tsId: str) -> str:
         return join(self._getCurrentTomoDir(tsId), f'{tsId}.mrc')
 
-    def _getOutputFormatArg(self) -> str:
+    def _getTargetDir(self, tsId: str, target: TardisSegTargets) -> str:
+        """Directory in which Tardis is executed for a tomogram and target. When several targets are
+        segmented, each one has its own, as Tardis always writes its results in a Predictions directory."""
+        tomoDir = self._getCurrentTomoDir(tsId)
+        return join(tomoDir, target.name) if self._isMultiTarget() else tomoDir
+
+    def _getTargetTomoFile(self, tsId: str, target: TardisSegTargets) -> str:
+        return join(self._getTargetDir(tsId, target), f'{tsId}.mrc')
+
+    def _getOutputName(self, baseName: str, target: TardisSegTargets, sweepId: int = None) -> str:
+        return f'{baseName}{self._getOutputSetSuffix(target, sweepId)}'
+
+    def _getExpectedOutputSets(self) -> List[TardisOutputs]:
+        segMode = self._getSegmentationMode()
+        instances = self._possibleOutputs.points if self._usePointsFiles() else self._possibleOutputs.meshes
+        if segMode == TardisSegModes.both.value:
+            return [self._possibleOutputs.segmentations, instances]
+        elif segMode == TardisSegModes.semantic.value:
+            return [self._possibleOutputs.segmentations]
+        else:  # instance
+            return [instances]
+
+    def _usePointsFiles(self) -> bool:
+        return getattr(self, POINTS_FILES).get()
+
+    def _getProcessedItems(self) -> Dict[TardisSegTargets, set]:
+        """Returns the tsIds already present in the outputs of each target, e. g. when the protocol is
+        continued."""
+        def getTsIds(outputName: str, tsIdAttr: str) -> set:
+            outputSet = getattr(self, outputName, None)
+            return set(outputSet.getUniqueValues(tsIdAttr)) if outputSet else set()
+
+        processed = {}
+        for target in self._getTargets():
+            # With a threshold sweep, a tomogram is processed once it is in the outputs of all the thresholds
+            processed[target] = set.intersection(*[
+                getTsIds(self._getOutputName(self._possibleOutputs.segmentations.name, target, sweepId), '_tsId') |
+                getTsIds(self._getOutputName(self._possibleOutputs.meshes.name, target, sweepId), '_tomoId') |
+                getTsIds(self._getOutputName(self._possibleOutputs.points.name, target, sweepId), TomoPoints.TS_ID_ATTR)
+                for sweepId in self._getSweepIds()])
+            processed[target].update(getTsIds(self._getOutputName(OUTPUT_TOMOS_FAILED_NAME, target), '_tsId'))
+        return processed
+
+    def _getBatchDir(self, batchId: int, target: TardisSegTargets, binFactor: int = 1) -> str:
+        batchDir = self._getSegmentationPath(f'batch_{batchId:03d}')
+        if self._isMultiTarget():
+            batchDir = join(batchDir, target.name)
+        return batchDir if binFactor == 1 else join(batchDir, f'bin{binFactor}')
+
+    def _splitBatchResults(self, batchId: int, batchDir: str, target: TardisSegTargets, tsIds: List[str]):
+        """Moves the results of a batch to the directory of each tomogram, so the output steps
+        can process them as if they were generated by an individual Tardis execution."""
+        batchPredictionsDir = join(batchDir, 'Predictions')
+        expectedOutputs = self._getExpectedOutputs()
+        for tsId in tsIds:
+            batchResults = [join(batchPredictionsDir, f'{tsId}_{suffix}.{ext}') for suffix, ext in expectedOutputs]
+            if all(exists(fn) for fn in batchResults):
+                makePath(join(self._getTargetDir(tsId, target), 'Predictions'))
+                for (suffix, ext), fn in zip(expectedOutputs, batchResults):
+                    moveFile(fn, self._getOutputFileName(tsId, target, suffix, ext))
+            else:
+                self.failedItems.append((tsId, target))
+                logger.error(redStr(f'tsId = {tsId}: Tardis did not generate the expected results in batch '
+                                    f'{batchId} ({target.name})'))
+
+    def _getExpectedOutputs(self) -> List[Tuple[str, str]]:
+        """Returns the suffixes and extensions of the files generated by Tardis for each tomogram."""
+        if self._isSweep():
+            return [PROBABILITY_MAP]
+        segMode = self._getSegmentationMode()
+        semantic = (TardisSegModes.semantic.name, 'mrc')
+        instances = (TardisSegModes.instances.name, 'csv')
+        if segMode == TardisSegModes.both.value:
+            return [semantic, instances]
+        elif segMode == TardisSegModes.semantic.value:
+            return [semantic]
+        else:  # instance
+            return [instances]
+
+    def _getAutoBinningFactor(self, tsId: str) -> int:
+        """Returns the factor by which a tomogram is binned before segmenting it (1 means no binning).
+        It only reads the header of the tomogram. When several targets are segmented, the smallest Tardis
+        pixel size among them is considered, so no target loses resolution."""
+        factor = self._autoBinFactors.get(tsId, None)
+        if factor is None:
+            factor = 1
+            if getattr(self, AUTO_BIN).get():
+                from tardis.utils import getMrcDims, getBinningFactor, estimateTardisMemory
+                tomo = self.inTomosDict[tsId]
+                dims = getMrcDims(self._getInputTomoFile(tsId))
+                sr = tomo.getSamplingRate()
+                tardisPx = min(TARDIS_PIXEL_SIZES[target] for target in self._getTargets())
+                maxMemory = getattr(self, MAX_MEMORY).get()
+                factor = getBinningFactor(dims, sr, tardisPx, maxMemory)
+                memory = estimateTardisMemory(dims, sr, tardisPx)
+                if factor > 1 or memory > maxMemory:
+                    binnedMemory = estimateTardisMemory(tuple(d // factor for d in dims), sr * factor, tardisPx)
+                    logger.info(f'tsId = {tsId}: estimated memory {memory:.1f} GB -> binning factor {factor} '
+                                f'(estimated memory {binnedMemory:.1f} GB)')
+                    if binnedMemory > maxMemory:
+                        logger.warning(redStr(f'tsId = {tsId}: the tomogram may not fit in {maxMemory} GB even '
+                                              f'binned to the Tardis pixel size ({tardisPx} Å/px)'))
+            if self._isPreview():
+                # Not beyond the Tardis pixel size, as Tardis would rescale the tomogram back to it
+                tardisPx = min(TARDIS_PIXEL_SIZES[target] for target in self._getTargets())
+                maxFactor = max(1, int(tardisPx // self.inTomosDict[tsId].getSamplingRate()))
+                factor = max(factor, min(getattr(self, PREVIEW_BIN).get(), maxFactor))
+            self._autoBinFactors[tsId] = factor
+        return factor
+
+    def _getBinningFactor(self, tsId: str, target: TardisSegTargets) -> int:
+        """Returns the factor by which the tomogram segmented for a target is binned, including the
+        binning of the out-of-memory fallbacks."""
+        return self._binFactors.get((tsId, target), None) or self._getAutoBinningFactor(tsId)
+
+    def _getResultsCache(self) -> Union['ResultsCache', None]:
+        cacheDir = Plugin.getCacheDir()
+        if getattr(self, USE_CACHE).get() and cacheDir:
+            from tardis.cache import ResultsCache
+            return ResultsCache(cacheDir, Plugin.getCacheMaxSize())
+        return None
+
+    def _getCacheKey(self, tsId: str, target: TardisSegTargets) -> str:
+        key = self._cacheKeys.get((tsId, target), None)
+        if key is None:
+            from tardis.cache import ResultsCache
+            # Only the contents of the tomogram matter, not its path, and the results on GPU and CPU are the same
+            args = DEVICE_ARG_REGEX.sub('', self._getCmdArgs(tsId, target, path='-'))
+            key = ResultsCache.computeKey(self._getTomoHash(self._getTargetTomoFile(tsId, target)),
+                                          TARGET_PROGRAMS[target], args, TARDIS_VERSION)
+            self._cacheKeys[(tsId, target)] = key
+        return key
+
+    def _getTomoHash(self, tomoFile: str) -> 'hashlib._Hash':
+        """Returns the hash of the contents of a tomogram file (see ResultsCache.hashTomogram). The targets
+        segmented from the same tomogram share its file through links, so it is hashed once for all of them."""
+        from tardis.cache import ResultsCache
+        realFile = realpath(tomoFile)
+        tomoHash = self._tomoHashes.get(realFile, None)
+        if tomoHash is None:
+            tomoHash = ResultsCache.hashTomogram(realFile)
+            self._tomoHashes[realFile] = tomoHash
+        return tomoHash
+
+    def _loadFromCache(self, tsId: str, target: TardisSegTargets) -> bool:
+        """Brings the results of a tomogram from the results cache, if they are there."""
+        cache = self._getResultsCache()
+        entryDir = cache.get(self._getCacheKey(tsId, target)) if cache else None
+        if entryDir is None:
+            return False
+        makePath(join(self._getTargetDir(tsId, target), 'Predictions'))
+        for suffix, ext in self._getExpectedOutputs():
+            cache.fetch(entryDir, f'{suffix}.{ext}', self._getOutputFileName(tsId, target, suffix, ext))
+        logger.info(cyanStr(f'tsId = {tsId}: {target.name} results taken from the cache {entryDir}'))
+        return True
+
+    def _saveInCache(self, tsId: str, target: TardisSegTargets):
+        cache = self._getResultsCache()
+        if cache is None:
+            return
+        files = {f'{suffix}.{ext}': self._getOutputFileName(tsId, target, suffix, ext)
+                 for suffix, ext in self._getExpectedOutputs()}
+        if all(exists(fn) for fn in files.values()):
+            try:
+                cache.put(self._getCacheKey(tsId, target), files)
+            except Exception as e:
+                logger.warning(f'tsId = {tsId}: unable to store the results in the cache -> {e}')
+
+    def _registerSegmentation(self, tsId: str, target: TardisSegTargets, ok: bool):
+        """Stores the results of a tomogram in the cache or records its failure, unless its retry on CPU has
+        been deferred (see _retryWithFallbacks)."""
+        if (tsId, target) in self._deferredFallbacks:
+            return
+        if ok:
+            self._saveInCache(tsId, target)
+        else:
+            self.failedItems.append((tsId, target))
+
+    def _segmentOnce(self, tsId: str, target: TardisSegTargets, device: Union[str, None]) -> Tuple[bool, bool]:
+        """Runs Tardis on a tomogram, on the device held by the step (None for the executions that fell back
+        to CPU in a GPU run). Returns if it succeeded and, if not, if it ran out of memory."""
+        from tardis.utils import isOutOfMemoryError
+        logFile = self._getTardisLogFile(tsId, target)
+        logOffset = getsize(logFile) if exists(logFile) else 0
+        try:
+            self._runTardis(target, self._getCmdArgs(tsId, target), self._getTargetDir(tsId, target), logFile,
+                            device, cpu=(tsId, target) in self._cpuFallbacks)
+            return True, False
+        except Exception as e:
+            logger.error(redStr(f'Tardis execution failed for tsId {tsId} ({target.name}) -> {e}'))
+            return False, isOutOfMemoryError(logFile, logOffset, str(e))
+
+    def _retryWithFallbacks(self, tsId: str, target: TardisSegTargets, device: Union[str, None],
+                            fallbacks: List[str] = None) -> bool:
+        """Segments again a tomogram that ran out of memory, applying the configurations of the fallback
+        ladder one after the other, until one succeeds, another kind of error happens or the maximum
+        number of retries is reached. Returns if the tomogram could be segmented. In a GPU run, the ladder
+        stops at the CPU fallback while the step holds its GPU: the remaining fallbacks are kept in
+        self._deferredFallbacks and applied by _retryOnCpu once the GPU is released, so it is not kept idle."""
+        if fallbacks is None:
+            fallbacks = self._getOomFallbacks()[:getattr(self, OOM_RETRIES).get()]
+        for i, fallback in enumerate(fallbacks):
+            if fallback == FALLBACK_CPU and device is not None and not self._useCpu():
+                self._deferredFallbacks[(tsId, target)] = fallbacks[i:]
+                return False
+            logger.warning(redStr(f'tsId = {tsId}: Tardis ran out of memory ({target.name}). '
+                                  f'Retrying with {fallback}...'))
+            self._applyFallback(tsId, target, fallback)
+            if self._loadFromCache(tsId, target):
+                return True
+            ok, outOfMemory = self._segmentOnce(tsId, target, device)
+            if ok or not outOfMemory:
+                return ok
+        return False
+
+    def _retryOnCpu(self, items: List[Tuple[str, TardisSegTargets]]):
+        """Retries on CPU, without holding any GPU, the tomograms whose fallbacks were deferred by
+        _retryWithFallbacks, and sweeps their thresholds."""
+        deferredItems = [item for item in items if item in self._deferredFallbacks]
+        for tsId, target in deferredItems:
+            fallbacks = self._deferredFallbacks.pop((tsId, target))
+            self._registerSegmentation(tsId, target, self._retryWithFallbacks(tsId, target, None, fallbacks))
+        self._sweepThresholds(deferredItems, None)
+
+    def _sweepThresholds(self, items: List[Tuple[str, TardisSegTargets]], device: Union[str, None]):
+        """Obtains the segmentations of each pair of thresholds of the sweep from the probability maps generated
+        by Tardis, without executing the neural network again. The semantic masks are obtained thresholding the
+        probability maps and the instances are predicted by Tardis from those masks."""
+        if not self._isSweep():
+            return
+        from tardis.utils import thresholdProbabilityMap
+        needsInstances = self._getSegmentationMode() != TardisSegModes.semantic.value
+        for tsId, target in [item for item in items
+                             if item not in self.failedItems and item not in self._deferredFallbacks]:
+            targetDir = self._getTargetDir(tsId, target)
+            logFile = self._getTardisLogFile(tsId, target)
+            voxelSize = self.inTomosDict[tsId].getSamplingRate() * self._getBinningFactor(tsId, target)
+            fnProb = self._getOutputFileName(tsId, target, *PROBABILITY_MAP)
+            try:
+                for sweepId, (cnnThreshold, _) in enumerate(self._getSweepThresholds(), start=1):
+                    logger.info(f'tsId = {tsId}: thresholds sweep {sweepId} ({target.name})')
+                    fnMask = self._getOutputFileName(tsId, target, TardisSegModes.semantic.name, 'mrc', sweepId)
+                    thresholdProbabilityMap(fnProb, fnMask, cnnThreshold, voxelSize)
+                    if needsInstances:
+                        # Tardis names its results after the input file
+                        maskLink = join(targetDir, f'{self._getSweepName(tsId, sweepId)}.mrc')
+                        cleanPath(maskLink)
+                        createLink(fnMask, maskLink)
+                        args = self._getCmdArgs(tsId, target, path=basename(maskLink), sweepId=sweepId)
+                        self._runTardis(target, args, targetDir, logFile, device,
+                                        cpu=(tsId, target) in self._cpuFallbacks)
+            except Exception as e:
+                logger.error(redStr(f'tsId = {tsId}: thresholds sweep failed ({target.name}) -> {e}'))
+                self.failedItems.append((tsId, target))
+
+    def _getMarkerFile(self, tsId: str, target: TardisSegTargets) -> str:
+        return join(self._getTargetDir(tsId, target), SEGMENTATION_MARKER)
+
+    def _getResultFiles(self, tsId: str, target: TardisSegTargets) -> List[str]:
+        """Returns the files generated by the segmentation step for a tomogram and target."""
+        files = [self._getOutputFileName(tsId, target, suffix, ext) for suffix, ext in self._getExpectedOutputs()]
+        if self._isSweep():
+            needsInstances = self._getSegmentationMode() != TardisSegModes.semantic.value
+            for sweepId in self._getSweepIds():
+                files.append(self._getOutputFileName(tsId, target, TardisSegModes.semantic.name, 'mrc', sweepId))
+                if needsInstances:
+                    files.append(self._getOutputFileName(tsId, target, TardisSegModes.instances.name, 'csv',
+                                                         sweepId))
+        return files
+
+    def _saveSegmentationMarker(self, tsId: str, target: TardisSegTargets, prepared: bool = False):
+        """Writes the completion marker of the segmentation of a tomogram, with the integrity data of its
+        results, or its failure, so a later execution does not repeat it. With prepared, it records that the
+        results have already been modified to create the outputs."""
+        from tardis.markers import CompletionMarker, STATUS_DONE, STATUS_FAILED
+        files = self._getResultFiles(tsId, target)
+        failed = (tsId, target) in self.failedItems or not all(exists(fn) for fn in files)
+        info = {**self._getSegmentationState(tsId, target),
+                'binFactor': self._getBinningFactor(tsId, target),
+                'cpuFallback': (tsId, target) in self._cpuFallbacks,
+                'prepared': prepared}
+        CompletionMarker.create(self._getMarkerFile(tsId, target), STATUS_FAILED if failed else STATUS_DONE, info,
+                                [] if failed else files)
+
+    def _loadSegmentationMarker(self, tsId: str, target: TardisSegTargets) -> bool:
+        """Tells if a tomogram was already segmented, or failed, for a target in a previous execution, according to
+        its completion marker. If so, the state the segmentation was done with (binning and device fallbacks) and
+        its failure are restored. The markers whose results are incomplete or whose parameters or input differ
+        from the current ones are discarded."""
+        if (tsId, target) in self._resumedItems:
+            return True
+        from tardis.markers import CompletionMarker
+        markerFile = self._getMarkerFile(tsId, target)
+        marker = CompletionMarker.load(markerFile)
+        if marker is None:
+            return False
+        if not marker.checkFiles(markerFile):
+            logger.info(f'tsId = {tsId}: the results of a previous execution are incomplete ({target.name})')
+            cleanPath(markerFile)
+            return False
+        item = (tsId, target)
+        self._binFactors[item] = marker.info['binFactor']
+        if marker.info['cpuFallback']:
+            self._cpuFallbacks.add(item)
+        if not self._isSameSegmentationState(marker, tsId, target):
+            logger.info(f'tsId = {tsId}: a previous execution used other parameters or input ({target.name})')
+            self._binFactors.pop(item, None)
+            self._cpuFallbacks.discard(item)
+            self._autoBinFactors.pop(tsId, None)  # It may have been computed from a stale converted tomogram
+            cleanPath(markerFile)
+            return False
+        if not marker.isDone() and item not in self.failedItems:
+            self.failedItems.append(item)
+        self._resumedItems.add(item)
+        logger.info(cyanStr(f'tsId = {tsId}: {"segmented" if marker.isDone() else "failed"} by a previous execution '
+                            f'({target.name}), skipping it'))
+        return True
+
+    def _isOutputPrepared(self, tsId: str, target: TardisSegTargets) -> bool:
+        from tardis.markers import CompletionMarker
+        marker = CompletionMarker.load(self._getMarkerFile(tsId, target))
+        return (marker is not None and marker.info.get('prepared', False) and
+                self._isSameSegmentationState(marker, tsId, target))
+
+    def _getSegmentationState(self, tsId: str, target: TardisSegTargets) -> Dict:
+        """Returns what the results of the segmentation of a tomogram depend on besides the Tardis arguments: the
+        region of interest, the preview, the automatic binning and the input file, as stored in its marker."""
+        from tardis.markers import getFileIdentity
+        roi = self._getRoi(tsId)
+        return {'args': self._getCmdArgs(tsId, target),
+                'roi': None if roi is None else [list(axisRange) for axisRange in roi],
+                'preview': self._isPreview(),
+                'autoBinFactor': self._getAutoBinningFactor(tsId),
+                'input': getFileIdentity(self.inTomosDict[tsId].getFileName().replace(':mrc', ''))}
+
+    def _isSameSegmentationState(self, marker: 'CompletionMarker', tsId: str, target: TardisSegTargets) -> bool:
+        """Tells if a marker was written with the same state as the current one (see _getSegmentationState)."""
+        state = self._getSegmentationState(tsId, target)
+        return all(marker.info.get(key, None) == value for key, value in state.items())
+
+    def _getOomFallbacks(self) -> List[str]:
+        return getattr(self, OOM_FALLBACKS).get('').lower().split()
+
+    def _applyFallback(self, tsId: str, target: TardisSegTargets, fallback: str):
+        if fallback == FALLBACK_CPU:
+            self._cpuFallbacks.add((tsId, target))
+        else:
+            from tardis.utils import binMrc
+            factor = self._getBinningFactor(tsId, target) * int(FALLBACK_BIN_REGEX.match(fallback).group(1))
+            targetTomoFile = self._getTargetTomoFile(tsId, target)
+            cleanPath(targetTomoFile)
+            binMrc(self._getInputTomoFile(tsId), targetTomoFile, factor)
+            self._tomoHashes.pop(realpath(targetTomoFile), None)  # A new file, maybe with the path of a previous one
+            self._binFactors[(tsId, target)] = factor
+        self._cacheKeys.pop((tsId, target), None)  # The arguments or the tomogram have changed
+
+    def _runTardis(self, target: TardisSegTargets, args: str, cwd: str, logFile: str, device: Union[str, None],
+                   cpu: bool = False):
+        """Runs Tardis for a target on a device handed out by the device scheduler. With cpu, it is run
+        on CPU whatever the device is."""
+        program = TARGET_PROGRAMS[target]
+        args = self._addWeightsArg(target, args)
+        if cpu and not self._useCpu():
+            # Fallback of a tomogram that does not fit in the GPU
+            logger.info(f'Running Tardis on CPU, output in {logFile}')
+            Plugin.runTardis(self, program, args, cwd=cwd, gpuId='',
+                             numberOfThreads=self._getCpuThreadsPerJob(), logFile=logFile)
+            return
+        gpuId, numberOfThreads = self._getDeviceConfig(device)
+        # Its output is not in the protocol log
+        logger.info(f'Running Tardis on {f"GPU {gpuId}" if gpuId else "CPU"}, output in {logFile}')
+        if getattr(self, USE_WORKER).get():
+            with self._acquireWorker(device) as worker:
+                worker.submit(program, args, cwd, logFile)
+        else:
+            Plugin.runTardis(self, program, args, cwd=cwd, gpuId=gpuId, numberOfThreads=numberOfThreads,
+                             logFile=logFile)
+
+    def _getArrayTask(self, target: TardisSegTargets, args: str, cwd: str, logFile: str,
+                      outputs: List[str]) -> 'ArrayTask':
+        from tardis.cluster import ArrayTask
+        command = Plugin.getTardisCommand(TARGET_PROGRAMS[target], self._addWeightsArg(target, args),
+                                          numberOfThreads=self._getArrayJobThreads() if self._useCpu() else None)
+        return ArrayTask(command, cwd, logFile, outputs)
+
+    def _runArrayJob(self, arrayId: int, tasks: List['ArrayTask']) -> List[bool]:
+        """Submits the Tardis executions as an array job to the queue system of the host of the protocol
+        and waits until they finish. Returns if each one succeeded."""
+        from tardis.cluster import ArrayJob
+        hostConfig = self.getHostConfig()
+        jobDir = self._getSegmentationPath(f'array_{arrayId:03d}')
+        # The same variables Scipion uses to submit a protocol, sized for a single Tardis execution
+        threads = self._getArrayJobThreads()
+        submitDict = dict(hostConfig.getQueuesDefault())
+        submitDict.update(self.getSubmitDict())
+        submitDict.update({'JOB_NAME': f'{self.strId()}_tardis_{arrayId}',
+                           'JOB_LOGS': join(jobDir, 'array'),
+                           'JOB_NODES': 1,
+                           'JOB_THREADS': threads,
+                           'JOB_CORES': threads,
+                           'GPU_COUNT': 0 if self._useCpu() else 1})
+        job = ArrayJob(jobDir, tasks)
+        job.submit(hostConfig, submitDict, Plugin.getArrayOption())
+        try:
+            return job.wait(hostConfig)
+        except BaseException:  # E. g. the protocol is stopped
+            job.cancel(hostConfig)
+            raise
+
+    def _useArrayJob(self) -> bool:
+        return getattr(self, USE_ARRAY_JOB).get()
+
+    def _getArrayJobThreads(self) -> int:
+        """Returns the number of threads requested for each task of an array job, which are the ones its Tardis
+        execution uses on CPU."""
+        return getattr(self, CPU_THREADS_PER_JOB).get() if self._useCpu() else 1
+
+    def _useCpu(self) -> bool:
+        return getattr(self, DEVICE).get() == TardisDevices.cpu.value
+
+    def _getDeviceConfig(self, device: str) -> Tuple[str, Union[int, None]]:
+        """Returns the GPU/s to be made visible and the number of threads of a Tardis execution
+        on a device handed out by the device scheduler."""
+        if self._useCpu():
+            return '', self._getCpuThreadsPerJob()
+        return device, None
+
+    def _getCpuThreadsPerJob(self) -> int:
+        """Returns the number of threads of each Tardis execution on CPU, which never exceeds the threads of
+        the protocol available for them."""
+        return max(1, min(getattr(self, CPU_THREADS_PER_JOB).get(), self.numberOfThreads.get() - 1))
+
+    def _logModelWeightsNote(self):
+        if any(Plugin.getWeightsCheckpoint(TARGET_PROGRAMS[target]) is None for target in self._getTargets()):
+            logger.info(cyanStr('NOTE: The model weights of some targets are not in the Tardis weights cache '
+                                f'({Plugin.getWeightsDir()}), so the first time Tardis is executed for each of '
+                                'them it automatically downloads some model_weights file and place them into a '
+                                'hidden directory named .tardis_em and located in /home/username. Re-installing '
+                                'Tardis fetches them into the cache'))
+
+    @staticmethod
+    def _addWeightsArg(target: TardisSegTargets, args: str) -> str:
+        """Points Tardis at the weights of the target in the Tardis weights cache, if they are there, so it
+        does not download them. It is not part of the arguments that identify the results (completion markers
+        and results cache), which do not depend on where the weights are read from."""
+        checkpoint = Plugin.getWeightsCheckpoint(TARGET_PROGRAMS[target])
+        return args if checkpoint is None else f'{args} --checkpoint "{checkpoint}"'
+
+    def _getTardisLogFile(self, tsId: str, target: TardisSegTargets) -> str:
+        return join(self._getTargetDir(tsId, target), 'tardis.log')
+
+    @contextmanager
+    def _acquireWorker(self, device: str) -> Iterator['TardisWorker']:
+        """Books a Tardis worker of the given device while the context is active, launching a new one if all
+        of them are busy. The device scheduler lets up to jobsPerGpu executions run at once on a device, so each
+        one gets its own worker (and its own copy of the model) instead of waiting for the same one."""
+        from tardis.worker import TardisWorker
+        with self._workersLock:
+            workers = self._workers.setdefault(device, [])
+            for deadWorker in [worker for worker in workers
+                               if worker not in self._busyWorkers and not worker.isAlive()]:
+                deadWorker.stop()
+                workers.remove(deadWorker)
+            worker = next((worker for worker in workers if worker not in self._busyWorkers), None)
+            isNew = worker is None
+            if isNew:
+                gpuId, numberOfThreads = self._getDeviceConfig(device)
+                logFile = self._getLogsPath(f'tardis_worker_{device.replace(",", "_")}_{len(workers) + 1}.log')
+                worker = TardisWorker(gpuId, logFile, numberOfThreads=numberOfThreads)
+                workers.append(worker)
+            self._busyWorkers.add(worker)
+        try:
+            if isNew:
+                worker.start()  # Out of the lock, so the workers of other devices are not blocked
+            yield worker
+        finally:
+            with self._workersLock:
+                self._busyWorkers.discard(worker)
+
+    def _stopWorkers(self):
+        with self._workersLock:
+            for workers in self._workers.values():
+                for worker in workers:
+                    worker.stop()
+            self._workers = {}
+            self._busyWorkers = set()
+
+    def _getOutputFormatArg(self, sweepId: int = None) -> str:
         """Tardis output format argument is composed of two elements -out <format>_<format>.
         The first output format is the semantic mask.  The second output is predicted instances
         of the detected objects."""
+        if self._isSweep():
+            # The probability map first, and then the instances of each pair of thresholds
+            return 'mrc_None' if sweepId is None else 'None_csv'
         segMode = self._getSegmentationMode()
         if segMode == TardisSegModes.both.value:
             return 'mrc_csv'
@@ -294,16 +1590,30 @@ class ProtTardisSeg(EMProtocol):
         else:  # instance
             return 'None_csv'
 
-    def _getCmdArgs(self, tsId: str) -> str:
+    def _getDeviceArg(self, tsId: str, target: TardisSegTargets) -> str:
+        useCpu = self._useCpu() or (tsId, target) in self._cpuFallbacks
+        return TardisDevices.cpu.name if useCpu else TardisDevices.gpu.name
+
+    def _getCmdArgs(self, tsId: str, target: TardisSegTargets, path: str = None, sweepId: int = None) -> str:
+        """Returns the arguments of the Tardis execution of a tomogram. With a threshold sweep, they are the ones
+        of the execution that generates the probability map or, with sweepId, the ones of the execution that
+        generates the instances from the semantic mask obtained with that pair of thresholds."""
         tomo = self.inTomosDict[tsId]
-        args = [f'--path {tsId}.mrc',
-                f'--output_format {self._getOutputFormatArg()}',
-                f'--correct_px {tomo.getSamplingRate():.3f}',
-                '--device gpu']
+        path = f'{tsId}.mrc' if path is None else path
+        args = [f'--path {path}',
+                f'--output_format {self._getOutputFormatArg(sweepId)}',
+                f'--correct_px {tomo.getSamplingRate() * self._getBinningFactor(tsId, target):.3f}',
+                f'--device {self._getDeviceArg(tsId, target)}']
 
         # Segmentation mode specific parameters
         segMode = self._getSegmentationMode()
-        if segMode == TardisSegModes.both.value:
+        if self._isSweep():
+            if sweepId is None:
+                args.append('--cnn_threshold 0')  # Tardis keeps the probability map
+            else:
+                args.extend(['--mask True',
+                             f'--dist_threshold {self._getSweepThresholds()[sweepId - 1][1]:.2f}'])
+        elif segMode == TardisSegModes.both.value:
             args.extend([f'--cnn_threshold {self.cnnThreshold.get():.2f}',
                          f'--dist_threshold {self.distThreshold.get():.2f}'])
         elif segMode == TardisSegModes.semantic.value:
@@ -312,51 +1622,162 @@ class ProtTardisSeg(EMProtocol):
             args.append(f'--dist_threshold {self.distThreshold.get():.2f}')
 
         # Non-membrane specific parameters
-        if getattr(self, SEG_TARGET).get() != TardisSegTargets.membranes.value:
+        if target != TardisSegTargets.membranes:
             args.extend([f'--filter_by_length {self.lenFilter.get()}',
                          f'--connect_splines {self.filamentDistThreshold.get()}',
                          f'--connect_cylinder {self.filamentThk.get()}'])
 
         return ' '.join(args)
 
-    def _createSemanticOutput(self, tsId: str):
+    def _getPostprocessingPool(self) -> 'ProcessPoolExecutor':
+        """Returns the pool of processes in which the results of Tardis are prepared to create the outputs,
+        so the reading, conversion and writing of the masks and points is not bound by the GIL of the
+        protocol process. It has a process per thread of the protocol, excluding the one that generates
+        the steps."""
+        with self._workersLock:
+            if self._postprocessingPool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # Spawned, as forking the protocol process, with its threads, may copy a lock already held
+                self._postprocessingPool = ProcessPoolExecutor(max_workers=max(1, self.numberOfThreads.get() - 1),
+                                                               mp_context=multiprocessing.get_context('spawn'))
+            return self._postprocessingPool
+
+    def _stopPostprocessingPool(self):
+        with self._workersLock:
+            if self._postprocessingPool is not None:
+                self._postprocessingPool.shutdown()
+                self._postprocessingPool = None
+
+    def _submitSemanticPreparation(self, tsId: str, target: TardisSegTargets, sweepId: int = None) -> 'Future':
+        """Submits the preparation of a semantic mask (see tardis.utils.prepareSemanticMask) to the
+        post-processing pool. The result of the job tells if the mask was stored as 8-bit."""
+        from concurrent.futures import Future
+        from tardis.utils import getMrcDims, prepareSemanticMask
+        if self._isOutputPrepared(tsId, target):
+            job = Future()
+            job.set_result(False)
+            return job
+        factor = self._getBinningFactor(tsId, target)
+        return self._getPostprocessingPool().submit(
+            prepareSemanticMask,
+            self._getOutputFileName(tsId, target, TardisSegModes.semantic.name, 'mrc', sweepId),
+            binFactor=factor,
+            binnedDims=getMrcDims(self._getInputTomoFile(tsId)) if factor > 1 else None,
+            dims=self._getInputTomoDims(tsId),
+            roi=self._getRoi(tsId),
+            compact=getattr(self, COMPACT_MASKS).get())
+
+    def _submitInstancesPreparation(self, tsId: str, target: TardisSegTargets, sweepId: int = None) -> 'Future':
+        """Submits the preparation of the instances (see tardis.utils.prepareInstances) to the
+        post-processing pool. The result of the job is the number of points and instances."""
+        from tardis.utils import getScipionShifts, prepareInstances
+        tomo = self.inTomosDict[tsId]
+        shifts = getScipionShifts(tomo, BOTTOM_LEFT_CORNER)
+        roi = self._getRoi(tsId)
+        if roi is not None:  # From the region of interest to the whole tomogram
+            shifts += [first for first, _ in roi]
+        return self._getPostprocessingPool().submit(
+            prepareInstances,
+            self._getOutputFileName(tsId, target, TardisSegModes.instances.name, 'csv', sweepId),
+            self._getPointsFile(tsId, target, sweepId),
+            self._getPointsIndexFile(tsId, target, sweepId),
+            tomo.getSamplingRate(),
+            binFactor=self._getBinningFactor(tsId, target),
+            shifts=tuple(shifts),
+            precise=not self._usePointsFiles())  # The meshes store the coordinates in double precision
+
+    def _prepareSemanticOutput(self, tsId: str, target: TardisSegTargets, compacted: bool,
+                               sweepId: int = None) -> TomoMask:
+        """Returns the output item of a semantic mask already prepared in the post-processing pool."""
         inTomo = self.inTomosDict[tsId]
-        outputSet = self._getOutputMaskSet()
+        fnMask = self._getOutputFileName(tsId, target, TardisSegModes.semantic.name, 'mrc', sweepId)
+        if compacted:
+            logger.info(f'tsId = {tsId}: semantic mask stored as 8-bit')
         tomoMask = TomoMask()
-        tomoMask.setFileName(self._getOutputFileName(tsId, TardisSegModes.semantic.name, 'mrc'))
+        tomoMask.setFileName(fnMask)
         tomoMask.setVolName(inTomo.getFileName())
         tomoMask.copyInfo(inTomo)
+        return tomoMask
+
+    def _prepareInstanceOutput(self, tsId: str, target: TardisSegTargets, counts: Tuple[int, int],
+                               sweepId: int = None) -> Union['np.ndarray', TomoPoints]:
+        """Returns the instances already prepared in the post-processing pool: the points, memory-mapped
+        and ready to be appended to the output meshes or, if the instances are stored as point files, the
+        item of the output points."""
+        fnPoints = self._getPointsFile(tsId, target, sweepId)
+        if not self._usePointsFiles():
+            from tardis.points import loadPoints
+            return loadPoints(fnPoints)
+        nPoints, nInstances = counts
+        tomoPoints = TomoPoints(filename=fnPoints, tsId=tsId)
+        tomoPoints.setVolName(self.inTomosDict[tsId].getFileName())
+        tomoPoints.setNumberOfPoints(nPoints)
+        tomoPoints.setNumberOfInstances(nInstances)
+        return tomoPoints
+
+    def _getPointsIndexFile(self, tsId: str, target: TardisSegTargets, sweepId: int = None) -> str:
+        return join(self._getTargetDir(tsId, target), f'{self._getSweepName(tsId, sweepId)}_points_index.npz')
+
+    def _getPointsFile(self, tsId: str, target: TardisSegTargets, sweepId: int = None) -> str:
+        return join(self._getTargetDir(tsId, target), f'{self._getSweepName(tsId, sweepId)}_points.npy')
+
+    def _createSemanticOutput(self, tomoMask: TomoMask, target: TardisSegTargets, sweepId: int = None):
+        outputSet = self._getOutputMaskSet(target, sweepId)
         outputSet.append(tomoMask)
-        self._store(outputSet)
+        self._uncommittedOutputs.add(self._getOutputName(self._possibleOutputs.segmentations.name, target, sweepId))
+
+    def _createInstanceOutput(self, tsId: str, target: TardisSegTargets, points: Union['np.ndarray', TomoPoints],
+                              sweepId: int = None):
+        if isinstance(points, TomoPoints):
+            self._getOutputPoints(target, sweepId).append(points)
+            self._uncommittedOutputs.add(self._getOutputName(self._possibleOutputs.points.name, target, sweepId))
+            return
+        from tardis.utils import appendPointsToMeshes
+        outMeshes = self._getOutputMeshes(target, sweepId)
+        appendPointsToMeshes(outMeshes, self.inTomosDict[tsId], points)
+        # The points file only takes them to the meshes. If the tomogram has to be processed again, e. g. the
+        # execution dies before the meshes are stored, it is prepared again from the CSV file
+        cleanPath(self._getPointsFile(tsId, target, sweepId))
+        self._uncommittedOutputs.add(self._getOutputName(self._possibleOutputs.meshes.name, target, sweepId))
 
-    def _createInstanceOutput(self, tsId: str):
-        outMeshes = self._getOutputMeshes()
-        self._addMeshPoints(tsId, outMeshes)
-        self._store(outMeshes)
+    def _getOutputFileName(self, tsId: str, target: TardisSegTargets, suffix: str, ext: str,
+                           sweepId: int = None) -> str:
+        fileName = f'{self._getSweepName(tsId, sweepId)}_{suffix}.{ext}'
+        return join(self._getTargetDir(tsId, target), 'Predictions', fileName)
 
-    def _getOutputFileName(self, tsId: str, suffix: str, ext: str) -> str:
-        return join(self._getExtraPath(tsId, 'Predictions'), f'{tsId}_{suffix}.{ext}')
+    @staticmethod
+    def _getSweepName(tsId: str, sweepId: int = None) -> str:
+        """Name of the files of a tomogram segmented with a pair of thresholds of the sweep."""
+        return tsId if sweepId is None else f'{tsId}_sweep{sweepId}'
 
-    def _getOutputMaskSet(self) -> SetOfTomoMasks:
-        outSetSetAttrib = self._possibleOutputs.segmentations.name
+    def _getOutputSetSuffix(self, target: TardisSegTargets, sweepId: int = None) -> str:
+        suffix = target.name.capitalize() if self._isMultiTarget() else ''
+        suffix = suffix if sweepId is None else f'{suffix}Sweep{sweepId}'
+        return f'{suffix}Preview' if self._isPreview() else suffix
+
+    def _getOutputMaskSet(self, target: TardisSegTargets, sweepId: int = None) -> SetOfTomoMasks:
+        outSetSetAttrib = self._getOutputName(self._possibleOutputs.segmentations.name, target, sweepId)
         outputSet = getattr(self, outSetSetAttrib, None)
         if outputSet:
-            outputSet.enableAppend()
+            self._enableAppend(outSetSetAttrib, outputSet)
         else:
-            outputSet = SetOfTomoMasks.create(self._getPath(), template='tomomasks%s.sqlite')
+            outputSet = SetOfTomoMasks.create(self._getPath(), template='tomomasks%s.sqlite',
+                                              suffix=self._getOutputSetSuffix(target, sweepId))
             outputSet.copyInfo(self._getInTomos())
             outputSet.setStreamState(Set.STREAM_OPEN)
             self._defineOutputs(**{outSetSetAttrib: outputSet})
             self._defineSourceRelation(self._getInTomos(returnPointer=True), outputSet)
         return outputSet
 
-    def _getOutputMeshes(self) -> SetOfMeshes:
-        outSetSetAttrib = self._possibleOutputs.meshes.name
+    def _getOutputMeshes(self, target: TardisSegTargets, sweepId: int = None) -> SetOfMeshes:
+        outSetSetAttrib = self._getOutputName(self._possibleOutputs.meshes.name, target, sweepId)
         outputSet = getattr(self, outSetSetAttrib, None)
         if outputSet:
-            outputSet.enableAppend()
+            self._enableAppend(outSetSetAttrib, outputSet)
         else:
-            outputSet = SetOfMeshes.create(self._getPath(), template='meshes%s.sqlite')
+            outputSet = SetOfMeshes.create(self._getPath(), template='meshes%s.sqlite',
+                                           suffix=self._getOutputSetSuffix(target, sweepId))
             inTomosPointer = self._getInTomos(returnPointer=True)
             outputSet.setPrecedents(inTomosPointer)
             outputSet.setBoxSize(self.boxSize.get())
@@ -366,49 +1787,70 @@ class ProtTardisSeg(EMProtocol):
             self._defineSourceRelation(self._getInTomos(returnPointer=True), outputSet)
         return outputSet
 
-    def _addMeshPoints(self, tsId: str, mesh: SetOfMeshes):
-        tomo = self.inTomosDict[tsId]
-        sr = tomo.getSamplingRate()
-        fnCsv = self._getOutputFileName(tsId, TardisSegModes.instances.name, 'csv')
-        data = np.loadtxt(fnCsv, delimiter=',', skiprows=1)  # Skip the header row
-        for row in data:
-            point = MeshPoint()
-            # Lines are [groupId, x, y, z] with coords in angstroms
-            groupId = int(row[0])
-            x = row[1]
-            y = row[2]
-            z = row[3]
-            point.setVolume(tomo)
-            point.setGroupId(groupId)
-            point.setPosition(x / sr,
-                              y / sr,
-                              z / sr,
-                              BOTTOM_LEFT_CORNER)
-            mesh.append(point)
-
-    def _createOutputFailedSet(self, tsId: str):
+    def _getOutputPoints(self, target: TardisSegTargets, sweepId: int = None) -> SetOfTomoPoints:
+        outSetSetAttrib = self._getOutputName(self._possibleOutputs.points.name, target, sweepId)
+        outputSet = getattr(self, outSetSetAttrib, None)
+        if outputSet:
+            self._enableAppend(outSetSetAttrib, outputSet)
+        else:
+            outputSet = SetOfTomoPoints.create(self._getPath(), template='tomopoints%s.sqlite',
+                                               suffix=self._getOutputSetSuffix(target, sweepId))
+            inTomosPointer = self._getInTomos(returnPointer=True)
+            outputSet.setPrecedents(inTomosPointer)
+            outputSet.setBoxSize(self.boxSize.get())
+            outputSet.setSamplingRate(inTomosPointer.get().getSamplingRate())
+            outputSet.setStreamState(Set.STREAM_OPEN)
+            self._defineOutputs(**{outSetSetAttrib: outputSet})
+            self._defineSourceRelation(self._getInTomos(returnPointer=True), outputSet)
+        return outputSet
+
+    def _enableAppend(self, outName: str, outputSet: Set):
+        """The output sets loaded from a previous execution are read-only. Once enabled, they stay
+        appendable in memory, so it is only done once per output and execution."""
+        if outName not in self._appendEnabledOutputs:
+            outputSet.enableAppend()
+            self._appendEnabledOutputs.add(outName)
+
+    def _createOutputFailedSet(self, tsId: str, target: TardisSegTargets):
         """ Just copy input item to the failed output set. """
         logger.info(f'Creating the failed tomo output ---> {tsId}')
         inTomosPointer = self._getInTomos(returnPointer=True)
-        output = self._getOutputFailedSet(inTomosPointer)
+        output = self._getOutputFailedSet(inTomosPointer, target)
         tomo = self.inTomosDict[tsId]  # Already cloned when the dictionary was created
         output.append(tomo)
 
-    def _getOutputFailedSet(self, inputPtr: Pointer) -> SetOfTomograms:
+    def _getOutputFailedSet(self, inputPtr: Pointer, target: TardisSegTargets) -> SetOfTomograms:
         """ Create output set for failed tomograms. """
         inTomos = inputPtr.get()
-        failedTomos = getattr(self, OUTPUT_TOMOS_FAILED_NAME, None)
+        outName = self._getOutputName(OUTPUT_TOMOS_FAILED_NAME, target)
+        failedTomos = getattr(self, outName, None)
         if failedTomos:
-            failedTomos.enableAppend()
+            self._enableAppend(outName, failedTomos)
         else:
-            failedTomos = SetOfTomograms.create(self._getPath(), template='tomograms', suffix='Failed')
+            failedTomos = SetOfTomograms.create(self._getPath(), template='tomograms',
+                                                suffix=f'Failed{self._getOutputSetSuffix(target)}')
             failedTomos.copyInfo(inTomos)
             failedTomos.setStreamState(Set.STREAM_OPEN)
-            self._defineOutputs(**{OUTPUT_TOMOS_FAILED_NAME: failedTomos})
+            self._defineOutputs(**{outName: failedTomos})
             self._defineSourceRelation(inputPtr, failedTomos)
         return failedTomos
 
-    def _createFailedOutput(self, tsId: str):
-        self._createOutputFailedSet(tsId)
-        failedTs = getattr(self, OUTPUT_TOMOS_FAILED_NAME, None)
-        self._store(failedTs)
\ No newline at end of file
+    def _createFailedOutput(self, tsId: str, target: TardisSegTargets):
+        self._createOutputFailedSet(tsId, target)
+        self._uncommittedOutputs.add(self._getOutputName(OUTPUT_TOMOS_FAILED_NAME, target))
+
+    def _commitOutputs(self, force: bool = False):
+        """Stores the output sets with uncommitted items once OUTPUT_COMMIT_TOMOS tomograms have been appended
+        or OUTPUT_COMMIT_SECS seconds have passed since the previous commit, instead of flushing them for each
+        tomogram. It is called after appending each tomogram and in each check of the input set, so the
+        tomograms are not kept out of the outputs while no other one finishes. With force, they are stored
+        right now. It must be called holding self._lock. If the execution dies, the uncommitted tomograms are
+        not in the outputs and so they are processed again when the protocol is continued."""
+        elapsed = time.time() - self._lastCommitTime
+        if self._uncommittedOutputs and (force or
+                                         self._nUncommittedTomos >= OUTPUT_COMMIT_TOMOS or
+                                         elapsed >= OUTPUT_COMMIT_SECS):
+            self._store(*[getattr(self, outName) for outName in self._uncommittedOutputs])
+            self._uncommittedOutputs.clear()
+            self._nUncommittedTomos = 0
+            self._lastCommitTime = time.time()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Union, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceScheduler:
+    """Hands out the devices of a list to the jobs launched from concurrent threads, allowing up to
+    jobsPerDevice simultaneous jobs on each device. The jobs waiting for a free slot are served in
+    arrival order and each one goes to the least loaded device, so all of them are kept busy.
+
+    Usage::
+
+        scheduler = DeviceScheduler(['0', '1'], jobsPerDevice=2)
+        with scheduler.acquire() as device:
+            runJob(..., env={'CUDA_VISIBLE_DEVICES': device})
+    """
+
+    def __init__(self, devices: List[Union[str, int]], jobsPerDevice: int = 1):
+        if not devices:
+            raise ValueError('At least one device is required')
+        if jobsPerDevice < 1:
+            raise ValueError('At least one job per device is required')
+        self.devices = [str(device) for device in devices]
+        self.jobsPerDevice = jobsPerDevice
+        self._running = {device: 0 for device in self.devices}
+        self._waiting = deque()
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def acquire(self):
+        """Blocks until a device slot is free and books it while the context is active.
+        It yields the id of the booked device."""
+        ticket = object()
+        with self._condition:
+            self._waiting.append(ticket)
+            device = None
+            while device is None:
+                if self._waiting[0] is ticket:
+                    device = self._getFreeDevice()
+                if device is None:
+                    self._condition.wait()
+            self._waiting.popleft()
+            self._running[device] += 1
+            self._condition.notify_all()  # The next waiting job may fit in another slot
+        logger.debug(f'Device {device} booked. Load: {self.getLoad()}')
+        try:
+            yield device
+        finally:
+            with self._condition:
+                self._running[device] -= 1
+                self._condition.notify_all()
+
+    def getLoad(self) -> Dict[str, int]:
+        """Returns the number of running jobs per device."""
+        with self._condition:
+            return dict(self._running)
+
+    def _getFreeDevice(self) -> Union[str, None]:
+        device = min(self.devices, key=lambda d: self._running[d])  # Ties are solved by the list order
+        return device if self._running[device] < self.jobsPerDevice else None
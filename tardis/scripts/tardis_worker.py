@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Long-lived Tardis worker. It is executed with the python of the Tardis environment (so it must not
+import anything from Scipion) and it serves segmentation jobs through a local socket, keeping the
+python interpreter, torch, the CUDA context and the built networks alive between tomograms.
+
+Each job is a dictionary with the keys:
+    - program: name of the Tardis command (tardis_mem, tardis_mt or tardis_actin).
+    - args: list with the command line arguments, the same ones accepted by the command.
+    - cwd: working directory of the job.
+    - log: file in which the output of the job will be written.
+The reply is a dictionary with the keys ok (bool) and error (str).
+"""
+import argparse
+import copy
+import importlib
+import os
+import sys
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from multiprocessing.connection import Listener
+
+AUTHKEY_VAR = 'TARDIS_WORKER_AUTHKEY'
+STOP_CMD = 'stop'
+PROGRAMS = {
+    'tardis_mem': 'tardis_em.scripts.predict_mem',
+    'tardis_mt': 'tardis_em.scripts.predict_mt',
+    'tardis_actin': 'tardis_em.scripts.predict_actin',
+}
+# Predictor arguments that may change from one tomogram to another without re-building the networks
+PER_JOB_KWARGS = ('dir_s', 'correct_px')
+# Attributes of the Tardis GeneralPredictor (tardis_em.utils.predictor) that hold the state of the previous
+# tomogram, with the value GeneralPredictor.__init__ gives them. They are private to Tardis, so if any of them
+# is missing, e. g. with another Tardis version, the predictor is built again instead of being re-used
+PER_JOB_STATE = {
+    'transformation': [0, 0, 0],
+    'px': None,
+    'image': None,
+    'log_prediction': [],  # Lines of prediction_log.txt, written again after each tomogram
+    'eta_predict': 'NA',
+    'segments': None,
+    'segments_filter': None,
+}
+
+
+class CachedPredictor:
+    """Replaces the GeneralPredictor class used by a Tardis command. The predictor (and so the networks
+    it builds and loads the weights into) is re-used while the configuration does not change, resetting
+    the state it keeps from the previous tomogram."""
+
+    def __init__(self, predictorClass):
+        self.predictorClass = predictorClass
+        self.key = None
+        self.predictor = None
+
+    def __call__(self, **kwargs):
+        key = repr(sorted((k, v) for k, v in kwargs.items() if k not in PER_JOB_KWARGS))
+        if self.predictor is None or key != self.key or not self._isResettable(self.predictor):
+            self.predictor = self.predictorClass(**kwargs)
+            self.key = key
+        else:
+            predictor = self.predictor
+            predictor.dir = kwargs['dir_s']
+            predictor.correct_px = kwargs.get('correct_px', None)
+            for attr, value in PER_JOB_STATE.items():
+                setattr(predictor, attr, copy.deepcopy(value))
+            predictor.create_headers()  # Headers of the prediction log of the new tomogram
+        return self.predictor
+
+    @staticmethod
+    def _isResettable(predictor):
+        return (all(hasattr(predictor, attr) for attr in tuple(PER_JOB_STATE) + ('dir', 'correct_px')) and
+                callable(getattr(predictor, 'create_headers', None)))
+
+
+def loadProgram(program, loaded):
+    module = loaded.get(program, None)
+    if module is None:
+        module = importlib.import_module(PROGRAMS[program])
+        module.GeneralPredictor = CachedPredictor(module.GeneralPredictor)
+        loaded[program] = module
+    return module
+
+
+def runJob(job, loaded):
+    program = job['program']
+    module = loadProgram(program, loaded)
+    os.chdir(job['cwd'])
+    with open(job['log'], 'a') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            module.main.main(args=job['args'], prog_name=program, standalone_mode=False)
+        except Exception:
+            traceback.print_exc()
+            raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tardis worker serving segmentation jobs.')
+    parser.add_argument('--address', required=True, help='Unix socket the worker will listen to.')
+    args = parser.parse_args()
+
+    authKey = bytes.fromhex(os.environ.pop(AUTHKEY_VAR))
+    loaded = {}
+    with Listener(args.address, family='AF_UNIX', authkey=authKey) as listener:
+        print(f'Tardis worker listening on {args.address}', flush=True)
+        with listener.accept() as conn:
+            while True:
+                try:
+                    job = conn.recv()
+                except EOFError:  # The protocol has gone
+                    break
+                if job == STOP_CMD:
+                    break
+                try:
+                    runJob(job, loaded)
+                    conn.send({'ok': True, 'error': ''})
+                except (Exception, SystemExit) as e:
+                    conn.send({'ok': False, 'error': f'{type(e).__name__}: {e}'})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
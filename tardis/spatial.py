@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from typing import Tuple, Dict, Union
+import numpy as np
+
+DEFAULT_CELL_SIZE = 32  # px
+
+
+class PointsIndex:
+    """Spatial index of the points of a tomogram: a regular grid of cubic cells in which the points are
+    stored sorted by cell, so the points around a position are found by visiting only the cells that
+    overlap the query region. It also keeps the number of points, bounding box and centroid of each
+    instance (group id).
+
+    The coordinates are the same as the ones of the output meshes, in pixels and referred to the
+    Scipion convention (the ones returned by MeshPoint.getPosition(SCIPION)).
+
+    Usage::
+
+        index = PointsIndex.load(fn)
+        groupIds, coords = index.queryRadius((10, 20, -5), 15)
+    """
+
+    def __init__(self, coords: np.ndarray, groupIds: np.ndarray, cellSize: float, origin: np.ndarray,
+                 gridShape: np.ndarray, cellKeys: np.ndarray, cellStarts: np.ndarray, cellCounts: np.ndarray,
+                 instanceIds: np.ndarray, instanceCounts: np.ndarray, instanceMins: np.ndarray,
+                 instanceMaxs: np.ndarray, instanceCentroids: np.ndarray):
+        self.coords = coords  # Sorted by cell
+        self.groupIds = groupIds
+        self.cellSize = float(cellSize)
+        self.origin = origin
+        self.gridShape = gridShape
+        self.cellKeys = cellKeys  # Linear index of the non-empty cells, sorted
+        self.cellStarts = cellStarts  # Position of the first point of each cell
+        self.cellCounts = cellCounts
+        self.instanceIds = instanceIds  # Sorted
+        self.instanceCounts = instanceCounts
+        self.instanceMins = instanceMins
+        self.instanceMaxs = instanceMaxs
+        self.instanceCentroids = instanceCentroids
+
+    @classmethod
+    def build(cls, groupIds: Union[list, np.ndarray], coords: Union[list, np.ndarray],
+              cellSize: float = DEFAULT_CELL_SIZE) -> 'PointsIndex':
+        """Builds the index of a set of points.
+
+        :param groupIds: N group ids.
+        :param coords: N x 3 coordinates.
+        :param cellSize: size of the cells of the grid.
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+        groupIds = np.asarray(groupIds, dtype=np.int64).reshape(-1)
+        if len(coords) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            emptyCoords = np.empty((0, 3))
+            return cls(emptyCoords, empty, cellSize, np.zeros(3), np.ones(3, dtype=np.int64), empty, empty, empty,
+                       empty, empty, emptyCoords, emptyCoords, emptyCoords)
+
+        # Points sorted by cell
+        origin = coords.min(axis=0)
+        cells = np.floor((coords - origin) / cellSize).astype(np.int64)
+        gridShape = cells.max(axis=0) + 1
+        keys = np.ravel_multi_index(tuple(cells.T), tuple(gridShape))
+        order = np.argsort(keys, kind='stable')
+        keys, coords, groupIds = keys[order], coords[order], groupIds[order]
+        cellKeys, cellStarts, cellCounts = np.unique(keys, return_index=True, return_counts=True)
+
+        # Instances metadata
+        byInstance = np.argsort(groupIds, kind='stable')
+        instanceIds, instanceStarts, instanceCounts = np.unique(groupIds[byInstance], return_index=True,
+                                                                return_counts=True)
+        instanceCoords = coords[byInstance]
+        instanceMins = np.minimum.reduceat(instanceCoords, instanceStarts, axis=0)
+        instanceMaxs = np.maximum.reduceat(instanceCoords, instanceStarts, axis=0)
+        instanceCentroids = np.add.reduceat(instanceCoords, instanceStarts, axis=0) / instanceCounts[:, None]
+        return cls(coords, groupIds, cellSize, origin, gridShape, cellKeys, cellStarts, cellCounts,
+                   instanceIds, instanceCounts, instanceMins, instanceMaxs, instanceCentroids)
+
+    def save(self, fn: str):
+        with open(fn, 'wb') as f:  # Through a file object, so numpy does not add the .npz extension
+            np.savez(f, **vars(self))
+
+    @classmethod
+    def load(cls, fn: str) -> 'PointsIndex':
+        with np.load(fn) as data:
+            return cls(**{key: data[key] for key in data.files})
+
+    def __len__(self):
+        return len(self.coords)
+
+    def queryBox(self, minCorner, maxCorner) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the group ids and the coordinates of the points inside a box (borders included)."""
+        minCorner, maxCorner = np.asarray(minCorner, dtype=float), np.asarray(maxCorner, dtype=float)
+        candidates = self._getCandidates(minCorner, maxCorner)
+        coords = self.coords[candidates]
+        inside = np.all((coords >= minCorner) & (coords <= maxCorner), axis=1)
+        return self.groupIds[candidates][inside], coords[inside]
+
+    def queryRadius(self, center, radius: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the group ids and the coordinates of the points at a distance lower than or equal to
+        radius from center."""
+        center = np.asarray(center, dtype=float)
+        candidates = self._getCandidates(center - radius, center + radius)
+        coords = self.coords[candidates]
+        inside = np.sum((coords - center) ** 2, axis=1) <= radius ** 2
+        return self.groupIds[candidates][inside], coords[inside]
+
+    def getInstance(self, groupId: int) -> Union[Dict[str, Union[int, np.ndarray]], None]:
+        """Returns the number of points, bounding box and centroid of an instance, or None if it
+        does not exist."""
+        i = np.searchsorted(self.instanceIds, groupId)
+        if i == len(self.instanceIds) or self.instanceIds[i] != groupId:
+            return None
+        return {'count': int(self.instanceCounts[i]),
+                'min': self.instanceMins[i],
+                'max': self.instanceMaxs[i],
+                'centroid': self.instanceCentroids[i]}
+
+    def _getCandidates(self, minCorner: np.ndarray, maxCorner: np.ndarray) -> np.ndarray:
+        """Returns the positions of the points in the cells that overlap a box."""
+        minCell = np.floor((minCorner - self.origin) / self.cellSize).astype(np.int64)
+        maxCell = np.floor((maxCorner - self.origin) / self.cellSize).astype(np.int64)
+        if len(self) == 0 or np.any(maxCell < 0) or np.any(minCell >= self.gridShape):
+            return np.empty(0, dtype=np.int64)
+        minCell = np.maximum(minCell, 0)
+        maxCell = np.minimum(maxCell, self.gridShape - 1)
+        ranges = [np.arange(lo, hi + 1) for lo, hi in zip(minCell, maxCell)]
+        cells = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+        keys = np.ravel_multi_index(tuple(cells.T), tuple(self.gridShape))
+        pos = self._matchCells(keys)
+        starts, counts = self.cellStarts[pos], self.cellCounts[pos]
+        if len(starts) == 0:
+            return np.empty(0, dtype=np.int64)
+        # Concatenation of the ranges [start, start + count) of the cells
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(counts)[:-1])), counts)
+        return np.arange(counts.sum()) + offsets
+
+    def _matchCells(self, keys: np.ndarray) -> np.ndarray:
+        """Returns the positions in cellKeys of the given cells that are not empty."""
+        pos = np.searchsorted(self.cellKeys, keys)
+        valid = pos < len(self.cellKeys)
+        pos, keys = pos[valid], keys[valid]
+        return pos[self.cellKeys[pos] == keys]
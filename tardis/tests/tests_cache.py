@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import tempfile
+import unittest
+from os.path import join, exists
+from tardis.cache import ResultsCache
+
+
+class TestResultsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.cacheDir = join(self.tmpDir.name, 'cache')
+        self.tomoFile = self._write('tomo.mrc', b'tomogram' * 1000)
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _write(self, name: str, contents: bytes) -> str:
+        fn = join(self.tmpDir.name, name)
+        with open(fn, 'wb') as f:
+            f.write(contents)
+        return fn
+
+    def testKey(self):
+        tomoHash = ResultsCache.hashTomogram(self.tomoFile)
+        key = ResultsCache.computeKey(tomoHash, 'tardis_mem', '--cnn_threshold 0.5', '0.3.10')
+        # The hash of the tomogram is re-used for several keys without being modified
+        self.assertEqual(ResultsCache.computeKey(tomoHash, 'tardis_mem', '--cnn_threshold 0.5', '0.3.10'), key)
+        self.assertNotEqual(ResultsCache.computeKey(tomoHash, 'tardis_mt', '--cnn_threshold 0.5', '0.3.10'), key)
+        self.assertNotEqual(ResultsCache.computeKey(tomoHash, 'tardis_mem', '--cnn_threshold 0.25', '0.3.10'), key)
+        # Only the contents of the tomogram matter
+        otherFile = self._write('other.mrc', b'tomogram' * 1000)
+        self.assertEqual(ResultsCache.computeKey(ResultsCache.hashTomogram(otherFile), 'tardis_mem',
+                                                 '--cnn_threshold 0.5', '0.3.10'), key)
+        otherFile = self._write('other.mrc', b'tomogram' * 999)
+        self.assertNotEqual(ResultsCache.computeKey(ResultsCache.hashTomogram(otherFile), 'tardis_mem',
+                                                    '--cnn_threshold 0.5', '0.3.10'), key)
+
+    def testPutGet(self):
+        cache = ResultsCache(self.cacheDir, 1)
+        key = ResultsCache.computeKey(ResultsCache.hashTomogram(self.tomoFile), 'tardis_mem', '', '0.3.10')
+        self.assertIsNone(cache.get(key))
+        cache.put(key, {'semantic.mrc': self._write('mask.mrc', b'mask')})
+        entryDir = cache.get(key)
+        outFile = join(self.tmpDir.name, 'fetched.mrc')
+        cache.fetch(entryDir, 'semantic.mrc', outFile)
+        with open(outFile, 'rb') as f:
+            self.assertEqual(f.read(), b'mask')
+
+    def testEviction(self):
+        cache = ResultsCache(self.cacheDir, 1.6 / 1024)  # 1.6 MB, it fits 3 entries
+        keys = []
+        for i in range(3):
+            keys.append(f'key{i}')
+            cache.put(keys[-1], {'semantic.mrc': self._write(f'mask{i}.mrc', os.urandom(1024 ** 2 // 2))})
+            os.utime(join(self.cacheDir, keys[-1]), (i, i))  # Ordered by use
+        cache.get(keys[0])  # Recently used
+        cache.put('key3', {'semantic.mrc': self._write('mask3.mrc', os.urandom(1024 ** 2 // 2))})
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertFalse(exists(join(self.cacheDir, keys[1])))
+        self.assertIsNotNone(cache.get('key3'))
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import sys
+import tempfile
+import unittest
+from os.path import join, exists
+from tardis.cluster import ArrayJob, ArrayTask
+
+# Queue system that runs the tasks of an array job as local subprocesses. Submission:
+# fake_queue --array=FIRST-LAST SCRIPT. The job is running while the file JOB_ID.running exists.
+FAKE_QUEUE = f'''#!{sys.executable}
+import os, subprocess, sys
+if sys.argv[1] != 'run':
+    first, last = sys.argv[1].split('=')[1].split('-')
+    script = sys.argv[2]
+    jobId = str(os.getpid())
+    stateFile = os.path.join(os.path.dirname(script), jobId + '.running')
+    open(stateFile, 'w').close()
+    subprocess.Popen([sys.executable, __file__, 'run', script, first, last, stateFile], start_new_session=True)
+    print('Submitted batch job ' + jobId)
+else:
+    script, first, last, stateFile = sys.argv[2:]
+    tasks = [subprocess.Popen(['bash', script], env=dict(os.environ, SLURM_ARRAY_TASK_ID=str(i)))
+             for i in range(int(first), int(last) + 1)]
+    for task in tasks:
+        task.wait()
+    os.remove(stateFile)
+'''
+
+
+class FakeHostConfig:
+    """The part of a Scipion host configuration used by an array job."""
+
+    def __init__(self, fakeQueue: str, stateDir: str):
+        self.fakeQueue = fakeQueue
+        self.stateDir = stateDir
+
+    def getSubmitTemplate(self):
+        return '#!/bin/bash\n#FAKE --job-name=%(JOB_NAME)s\n%(JOB_COMMAND)s'
+
+    def getSubmitCommand(self):
+        return f'{self.fakeQueue} %(JOB_SCRIPT)s'
+
+    def getCheckCommand(self):
+        return f'test -f {self.stateDir}/%(JOB_ID)s.running && echo RUNNING'
+
+    def getCancelCommand(self):
+        return None
+
+    def getJobDoneRegex(self):
+        return None
+
+
+class TestArrayJob(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.jobDir = join(self.tmpDir.name, 'job')
+        fakeQueue = join(self.tmpDir.name, 'fake_queue')
+        with open(fakeQueue, 'w') as f:
+            f.write(FAKE_QUEUE)
+        os.chmod(fakeQueue, 0o755)
+        self.hostConfig = FakeHostConfig(fakeQueue, self.jobDir)
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _getTask(self, name: str, command: str) -> ArrayTask:
+        taskDir = join(self.tmpDir.name, name)
+        os.makedirs(taskDir)
+        return ArrayTask(command, taskDir, join(taskDir, 'tardis.log'), [join(taskDir, 'Predictions', 'result.txt')])
+
+    def _run(self, tasks):
+        job = ArrayJob(self.jobDir, tasks)
+        jobId = job.submit(self.hostConfig, {'JOB_NAME': 'tardis'}, '--array=1-')
+        self.assertTrue(jobId.isdigit())
+        return job.wait(self.hostConfig, checkSecs=0.1)
+
+    def testSucceeded(self):
+        command = 'mkdir -p Predictions && echo $SLURM_ARRAY_TASK_ID > Predictions/result.txt'
+        tasks = [self._getTask(f'tomo{i}', command) for i in range(1, 4)]
+        self.assertEqual(self._run(tasks), [True] * 3)
+        # Each task ran the command of its index, in its directory
+        for i, task in enumerate(tasks, start=1):
+            with open(task.outputs[0]) as f:
+                self.assertEqual(f.read().strip(), str(i))
+        with open(join(self.jobDir, 'array.job')) as f:
+            self.assertIn('--job-name=tardis', f.read())
+
+    def testFailed(self):
+        tasks = [self._getTask('ok', 'mkdir -p Predictions && touch Predictions/result.txt'),
+                 self._getTask('error', 'echo "CUDA out of memory" && exit 3'),
+                 self._getTask('noOutputs', 'true'),
+                 self._getTask('killed', 'kill -KILL $$')]  # As the queue system does, e. g. out of time
+        self.assertEqual(self._run(tasks), [True, False, False, False])
+        with open(tasks[1].logFile) as f:
+            self.assertIn('out of memory', f.read())
+        self.assertFalse(exists(join(self.jobDir, 'task_4.exit')))
+
+    def testSubmissionError(self):
+        self.hostConfig.getSubmitCommand = lambda: 'false %(JOB_SCRIPT)s'
+        with self.assertRaises(RuntimeError):
+            ArrayJob(self.jobDir, [self._getTask('tomo', 'true')]).submit(self.hostConfig, {'JOB_NAME': 'tardis'},
+                                                                          '--array=1-')
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+from tardis import Plugin
+from tardis.environment import resolveEnv, ResolvedEnv
+
+PROGRAMS = ['tardis_mem', 'tardis_mt']
+
+
+class TestResolvedEnv(unittest.TestCase):
+    """The environment activation is emulated with a command that adds a bin directory, with stand-ins
+    for python and the Tardis executables, to the PATH and sets a variable."""
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.binDir = join(self.tmpDir.name, 'bin')
+        os.makedirs(self.binDir)
+        os.symlink(sys.executable, join(self.binDir, 'python'))
+        for program in PROGRAMS:
+            fn = join(self.binDir, program)
+            with open(fn, 'w') as f:
+                f.write('#!/bin/sh\necho "$TARDIS_TEST_VAR"\n')
+            os.chmod(fn, 0o755)
+        self.activationCmd = f'export PATH={self.binDir}:$PATH && export TARDIS_TEST_VAR=activated &&'
+        self.baseEnv = {var: value for var, value in os.environ.items() if var != 'TARDIS_TEST_VAR'}
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testResolve(self):
+        resolvedEnv = resolveEnv(self.activationCmd, PROGRAMS, self.baseEnv)
+        self.assertTrue(resolvedEnv.isValid(self.activationCmd))
+        self.assertEqual(resolvedEnv.pathEntries['PATH'], [self.binDir])
+        self.assertEqual(resolvedEnv.variables['TARDIS_TEST_VAR'], 'activated')
+        for program in PROGRAMS:
+            self.assertEqual(resolvedEnv.getProgram(program), join(self.binDir, program))
+        # The executables are launched directly, with the environment the activation would produce
+        env = resolvedEnv.apply(dict(self.baseEnv))
+        self.assertTrue(env['PATH'].startswith(self.binDir + os.pathsep))
+        output = subprocess.check_output(resolvedEnv.getProgram(PROGRAMS[0]), env=env, text=True)
+        self.assertEqual(output.strip(), 'activated')
+
+    def testStale(self):
+        resolvedEnv = resolveEnv(self.activationCmd, PROGRAMS, self.baseEnv)
+        fn = join(self.tmpDir.name, 'resolved_env.json')
+        resolvedEnv.save(fn)
+        loadedEnv = ResolvedEnv.load(fn)
+        self.assertEqual(vars(loadedEnv), vars(resolvedEnv))
+        self.assertTrue(loadedEnv.isValid(self.activationCmd))
+        # Another activation command
+        self.assertFalse(loadedEnv.isValid(self.activationCmd.replace('activated', 'other')))
+        # Environment re-installed or removed
+        os.remove(join(self.binDir, PROGRAMS[1]))
+        self.assertFalse(loadedEnv.isValid(self.activationCmd))
+
+    def testWrongEnv(self):
+        with self.assertRaises(ValueError):
+            resolveEnv(self.activationCmd, PROGRAMS + ['tardis_missing'], self.baseEnv)
+        with self.assertRaises(subprocess.CalledProcessError):
+            resolveEnv('false &&', PROGRAMS, self.baseEnv)
+
+    def testRunTardisLogFile(self):
+        class FakeProtocol:
+            """Runs the jobs as a Scipion protocol does, through the shell."""
+            def runJob(self, program, args, env=None, cwd=None):
+                subprocess.run(f'{program} {args}', shell=True, env=env, cwd=cwd, check=True)
+
+        resolvedEnv = resolveEnv(self.activationCmd, PROGRAMS, self.baseEnv)
+        logFile = join(self.tmpDir.name, 'tomo 1', 'tardis.log')
+        os.makedirs(os.path.dirname(logFile))
+        with mock.patch.object(Plugin, 'getResolvedEnv', return_value=resolvedEnv):
+            Plugin.runTardis(FakeProtocol(), PROGRAMS[0], '', gpuId='', logFile=logFile)
+        with open(logFile) as f:
+            self.assertEqual(f.read().strip(), 'activated')
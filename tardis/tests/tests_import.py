@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import subprocess
+import sys
+import unittest
+from typing import List
+
+# What Scipion does to discover the plugin and its protocols
+DISCOVERY_CODE = 'import tardis; from tardis.protocols import ProtTardisSeg'
+# Scipion packages the plugin is built on, which are already imported when Scipion discovers it
+DEPENDENCIES_CODE = 'import pwem, pwem.protocols, pyworkflow.protocol, tomo.objects'
+# Modules of the plugin only needed to run the protocol
+LAZY_MODULES = ['tardis.utils', 'tardis.cache', 'tardis.worker', 'tardis.environment', 'tardis.spatial',
+                'tardis.markers', 'tardis.points', 'tardis.cluster', 'tardis.weights']
+# Dependencies only needed to run the protocol
+LAZY_DEPENDENCIES = ['numpy', 'mrcfile', 'scipy', 'sqlite3']
+
+
+class TestTardisImport(unittest.TestCase):
+
+    @staticmethod
+    def _importedModules(code: str, previousCode: str = '') -> List[str]:
+        """Runs code in a new interpreter and returns the modules it imports, excluding the ones already
+        imported by previousCode."""
+        script = '\n'.join(['import json, sys', previousCode, 'before = set(sys.modules)', code,
+                            'print(json.dumps(sorted(set(sys.modules) - before)))'])
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+        return json.loads(result.stdout.splitlines()[-1])
+
+    def testLazyModules(self):
+        modules = self._importedModules(DISCOVERY_CODE)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, modules, msg=f'{module} must not be imported to discover the plugin')
+
+    def testLazyDependencies(self):
+        # Only the modules imported by the plugin itself, since the Scipion packages it is built on may import
+        # some of these dependencies
+        modules = self._importedModules(DISCOVERY_CODE, DEPENDENCIES_CODE)
+        for module in LAZY_DEPENDENCIES:
+            self.assertNotIn(module, modules, msg=f'{module} must not be imported to discover the plugin')
+        self.assertEqual([module for module in modules if module.split('.')[0] != 'tardis'], [])
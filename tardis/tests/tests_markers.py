@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import tempfile
+import unittest
+from os.path import join
+import mrcfile
+import numpy as np
+from tardis.markers import CompletionMarker, STATUS_DONE, STATUS_FAILED, getFileIdentity
+
+
+class TestCompletionMarker(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.markerFile = join(self.tmpDir.name, '.marker.json')
+        self.fnMrc = join(self.tmpDir.name, 'Predictions', 'tomo_semantic.mrc')
+        self.fnCsv = join(self.tmpDir.name, 'Predictions', 'tomo_instances.csv')
+        os.makedirs(join(self.tmpDir.name, 'Predictions'))
+        with mrcfile.new(self.fnMrc, np.ones((4, 5, 6), dtype=np.int8)):
+            pass
+        with open(self.fnCsv, 'w') as f:
+            f.write('IDs,X [A],Y [A],Z [A]\n1,10.0,20.0,30.0\n1,11.0,21.0,31.0\n')
+        self.info = {'args': '--path tomo.mrc', 'binFactor': 2}
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testDone(self):
+        CompletionMarker.create(self.markerFile, STATUS_DONE, self.info, [self.fnMrc, self.fnCsv])
+        marker = CompletionMarker.load(self.markerFile)
+        self.assertTrue(marker.isDone())
+        self.assertEqual(marker.info, self.info)
+        self.assertTrue(marker.checkFiles(self.markerFile))
+
+    def testFailed(self):
+        CompletionMarker.create(self.markerFile, STATUS_FAILED, self.info)
+        marker = CompletionMarker.load(self.markerFile)
+        self.assertFalse(marker.isDone())
+        self.assertTrue(marker.checkFiles(self.markerFile))
+
+    def testIncompleteFiles(self):
+        marker = CompletionMarker.create(self.markerFile, STATUS_DONE, self.info, [self.fnMrc, self.fnCsv])
+        # Truncated mask
+        with open(self.fnMrc, 'r+b') as f:
+            f.truncate(1024 + 50)
+        self.assertFalse(marker.checkFiles(self.markerFile))
+        # Missing file
+        os.remove(self.fnMrc)
+        self.assertFalse(marker.checkFiles(self.markerFile))
+        # A row less, with the same size
+        marker = CompletionMarker.create(self.markerFile, STATUS_DONE, self.info, [self.fnCsv])
+        with open(self.fnCsv) as f:
+            contents = f.read()
+        with open(self.fnCsv, 'w') as f:
+            f.write(contents.replace('\n1,11', ' 1,11'))
+        self.assertFalse(marker.checkFiles(self.markerFile))
+
+    def testNoMarker(self):
+        self.assertIsNone(CompletionMarker.load(self.markerFile))
+        with open(self.markerFile, 'w') as f:
+            f.write('{"status": "done", ')
+        self.assertIsNone(CompletionMarker.load(self.markerFile))
+
+    def testFileIdentity(self):
+        identity = getFileIdentity(self.fnCsv)
+        # It survives the JSON file of the marker
+        CompletionMarker.create(self.markerFile, STATUS_DONE, {'input': identity})
+        self.assertEqual(CompletionMarker.load(self.markerFile).info['input'], identity)
+        self.assertEqual(getFileIdentity(self.fnCsv), identity)
+        os.utime(self.fnCsv, (identity['mtime'] + 10, identity['mtime'] + 10))  # E. g. re-written
+        self.assertNotEqual(getFileIdentity(self.fnCsv), identity)
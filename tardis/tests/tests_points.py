@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import tempfile
+import unittest
+from os.path import join
+import numpy as np
+from tardis.points import POINTS_DTYPE, PRECISE_POINTS_DTYPE, loadPoints, savePoints
+
+
+class TestPoints(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.fn = join(self.tmpDir.name, 'tomo_points.npy')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testSaveLoad(self):
+        rng = np.random.default_rng(0)
+        coords = rng.uniform(-300, 300, size=(1000, 3))
+        groupIds = rng.integers(1, 50, size=len(coords))
+        self.assertEqual(savePoints(self.fn, groupIds.tolist(), coords.tolist()), len(coords))
+        self.assertEqual(POINTS_DTYPE.itemsize, 16)
+        points = loadPoints(self.fn)
+        self.assertIsInstance(points, np.memmap)
+        np.testing.assert_array_equal(points['groupId'], groupIds)
+        np.testing.assert_allclose(points['coords'], coords, rtol=1e-6)
+        # The coordinates and group ids are views of the mapped file, not copies
+        self.assertTrue(np.shares_memory(points['coords'], points))
+        self.assertTrue(np.shares_memory(points['groupId'], points))
+        np.testing.assert_array_equal(loadPoints(self.fn, mmap=False), points)
+
+    def testPrecise(self):
+        coords = np.random.default_rng(0).uniform(-300, 300, size=(1000, 3))
+        savePoints(self.fn, np.ones(len(coords), dtype=int), coords, precise=True)
+        points = loadPoints(self.fn)
+        self.assertEqual(points.dtype, PRECISE_POINTS_DTYPE)
+        self.assertEqual(PRECISE_POINTS_DTYPE.itemsize, 28)
+        np.testing.assert_array_equal(points['coords'], coords)  # Without loss of precision
+
+    def testEmpty(self):
+        self.assertEqual(savePoints(self.fn, [], []), 0)
+        self.assertEqual(len(loadPoints(self.fn)), 0)
+
+    def testNotPoints(self):
+        np.save(self.fn, np.zeros((10, 3)))
+        with self.assertRaises(ValueError):
+            loadPoints(self.fn)
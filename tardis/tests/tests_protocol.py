@@ -0,0 +1,892 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import tempfile
+import threading
+import unittest
+from os.path import join, exists, basename
+from typing import List, Tuple, Callable
+from unittest import mock
+from pyworkflow.object import Set
+from pyworkflow.utils import cleanPath
+import mrcfile
+import numpy as np
+import tifffile
+from tardis import Plugin
+from tardis.cache import ResultsCache
+from tardis.constants import TARDIS_PROGRAMS, TARDIS_WEIGHTS
+from tardis.points import loadPoints
+from tardis.protocols.protocol_tardis_seg import ProtTardisSeg, TardisSegTargets, BATCH_SIZE, MULTI_TARGET, \
+    MULTI_TARGET_PARAMS, IN_TOMOS, USE_CACHE, DEVICE, CPU_THREADS_PER_JOB, TardisDevices, OOM_FALLBACKS, \
+    TARGET_PROGRAMS, USE_ROI, ROI_PARAMS, PREVIEW, PREVIEW_BIN, PREVIEW_SIZE, PREVIEW_TSIDS, TardisSegModes, \
+    AUTO_BIN, MAX_MEMORY, SWEEP, SWEEP_THRESHOLDS, PROBABILITY_MAP, OUTPUT_COMMIT_SECS, \
+    POINTS_FILES, OUTPUT_TOMOS_FAILED_NAME, USE_ARRAY_JOB
+from tardis.scheduler import DeviceScheduler
+from tardis.utils import getScipionShifts
+from tomo.objects import Tomogram, TomoAcquisition, SetOfTomograms
+
+
+class TestProtocolBase(unittest.TestCase):
+    """Runs the steps of the protocol, outside a Scipion project, on small synthetic tomograms. Tardis is
+    replaced by a stand-in that writes the results it would generate for each tomogram of its input path."""
+    dims = (40, 30, 10)  # x, y, z
+    samplingRate = 5
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.tomos = {}
+        self.segmented = []  # Names of the tomograms segmented by each Tardis execution
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _createTomo(self, tsId: str) -> Tomogram:
+        fn = join(self.tmpDir.name, f'{tsId}.mrc')
+        data = np.random.default_rng(0).normal(size=tuple(reversed(self.dims))).astype(np.float32)
+        with mrcfile.new(fn, data, overwrite=True) as mrc:
+            mrc.voxel_size = self.samplingRate
+        tomo = Tomogram(location=fn)
+        tomo.setTsId(tsId)
+        tomo.setSamplingRate(self.samplingRate)
+        tomo.setAcquisition(TomoAcquisition())
+        return tomo
+
+    def _newProtocol(self, tsIds: List[str], **params) -> ProtTardisSeg:
+        """A new execution of the protocol, in the same directory as the previous ones."""
+        prot = ProtTardisSeg()
+        prot.setWorkingDir(join(self.tmpDir.name, 'prot'))
+        for name, value in params.items():
+            getattr(prot, name).set(value)
+        for tsId in tsIds:
+            if tsId not in self.tomos:
+                self.tomos[tsId] = self._createTomo(tsId)
+        prot.inTomosDict = {tsId: self.tomos[tsId] for tsId in tsIds}
+        prot._deviceScheduler = DeviceScheduler(['0'])
+        prot._runTardis = self._fakeTardis
+        prot._defineSourceRelation = lambda *args: None  # No project to store the relations in
+        return prot
+
+    def _setInputSet(self, prot: ProtTardisSeg, tsIds: List[str]) -> SetOfTomograms:
+        """Creates the input set of a protocol, with the tomograms of the tsIds given. Returns it."""
+        inTomos = SetOfTomograms.create(self.tmpDir.name, template='tomograms%s.sqlite')
+        inTomos.setSamplingRate(self.samplingRate)
+        for tsId in tsIds:
+            if tsId not in self.tomos:
+                self.tomos[tsId] = self._createTomo(tsId)
+            inTomos.append(self.tomos[tsId].clone())
+        inTomos.write()
+        getattr(prot, IN_TOMOS).set(inTomos)
+        return inTomos
+
+    @staticmethod
+    def _generateSteps(prot: ProtTardisSeg, checks: List[Callable[[SetOfTomograms], None]]) -> List[tuple]:
+        """Runs the step generator of a protocol. Each function of checks is called with the input set when the
+        generator refreshes it, e. g. to add tomograms or close it. Returns the steps inserted, as tuples of
+        the step function name, its arguments and the indices (starting from 1) of its prerequisites."""
+        steps = []
+
+        def insertStep(func, *args, prerequisites=None, **kwargs):
+            steps.append((func.__name__, args, prerequisites))
+            return len(steps)
+
+        prot._insertFunctionStep = insertStep
+        inTomos = prot._getInTomos()
+        pendingChecks = iter(checks)
+        inTomos.loadAllProperties = lambda: next(pendingChecks)(inTomos)
+        with mock.patch('tardis.protocols.protocol_tardis_seg.STREAMING_CHECK_SECS', 0):
+            prot.stepsGeneratorStep()
+        return steps
+
+    def _fakeTardis(self, target: TardisSegTargets, args: str, cwd: str, logFile: str, device: str, cpu=False):
+        """Writes the results of the output format of the arguments for each tomogram in their path, as Tardis
+        does: the mask (the positive voxels), the instances and, with a CNN threshold of 0, the probability map
+        (see getProbabilities)."""
+        argsDict = dict(zip(args.split()[::2], args.split()[1::2]))
+        path = join(cwd, argsDict['--path'])
+        semanticFormat, instancesFormat = argsDict['--output_format'].split('_')
+        fns = sorted(join(path, fn) for fn in os.listdir(path) if fn.endswith('.mrc')) if os.path.isdir(path) \
+            else [path]
+        os.makedirs(join(cwd, 'Predictions'), exist_ok=True)
+        for fn in fns:
+            name = basename(fn)[:-4]
+            with mrcfile.open(fn, permissive=True) as mrc:
+                data = mrc.data.copy()
+            if semanticFormat == 'mrc':
+                with mrcfile.new(join(cwd, 'Predictions', f'{name}_semantic.mrc'), (data > 0).astype(np.float32),
+                                 overwrite=True):
+                    pass
+            if argsDict.get('--cnn_threshold', None) == '0':
+                tifffile.imwrite(join(cwd, 'Predictions', f'{name}_CNN.tif'), self.getProbabilities(data))
+            if instancesFormat == 'csv':
+                with open(join(cwd, 'Predictions', f'{name}_instances.csv'), 'w') as f:
+                    f.write('IDs,X [A],Y [A],Z [A]\n1,10.0,20.0,30.0\n2,40.0,50.0,20.0\n')
+            self.segmented.append(name)
+
+    def _segment(self, **params) -> ProtTardisSeg:
+        """Segments tomo1 in a new execution of the protocol. Returns it."""
+        self.segmented = []
+        prot = self._newProtocol(['tomo1'], **params)
+        prot.convertInputStep('tomo1')
+        prot.segmentStep('tomo1')
+        return prot
+
+    @staticmethod
+    def getProbabilities(data: np.ndarray) -> np.ndarray:
+        return (1 / (1 + np.exp(-data))).astype(np.float32)
+
+
+class TestPrograms(unittest.TestCase):
+
+    def testPrograms(self):
+        # Each target has its own program, with its model weights
+        self.assertEqual(sorted(TARGET_PROGRAMS[target] for target in TardisSegTargets), sorted(TARDIS_PROGRAMS))
+        self.assertEqual(sorted(TARDIS_WEIGHTS), sorted(TARDIS_PROGRAMS))
+
+
+class TestBatches(TestProtocolBase):
+
+    def testBatch(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{BATCH_SIZE: 2})
+        for tsId in prot.inTomosDict:
+            prot.convertInputStep(tsId)
+        prot.segmentBatchStep(1, ['tomo1', 'tomo2'])
+        self.assertEqual(self.segmented, ['tomo1', 'tomo2'])
+        self.assertEqual(prot.failedItems, [])
+        # The results are moved to the directory of each tomogram
+        target = prot._getTargets()[0]
+        for tsId in ['tomo1', 'tomo2']:
+            for suffix, ext in prot._getExpectedOutputs():
+                self.assertTrue(exists(prot._getOutputFileName(tsId, target, suffix, ext)))
+
+    def testBatchIdReused(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{BATCH_SIZE: 2})
+        for tsId in prot.inTomosDict:
+            prot.convertInputStep(tsId)
+        prot.segmentBatchStep(1, ['tomo1', 'tomo2'])
+        # The batch ids start from 1 in each execution, e. g. when the protocol is continued with more tomograms
+        self.segmented = []
+        prot = self._newProtocol(['tomo3'], **{BATCH_SIZE: 2})
+        prot.convertInputStep('tomo3')
+        prot.segmentBatchStep(1, ['tomo3'])
+        self.assertEqual(self.segmented, ['tomo3'])  # The tomograms of the previous batch are not segmented again
+        self.assertEqual(sorted(fn for fn in os.listdir(prot._getBatchDir(1, TardisSegTargets.membranes))
+                                if fn.endswith('.mrc')), ['tomo3.mrc'])
+
+    def testMissingResults(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{BATCH_SIZE: 2})
+        for tsId in prot.inTomosDict:
+            prot.convertInputStep(tsId)
+        fakeTardis = prot._runTardis
+
+        def failOne(target, args, cwd, *args_, **kwargs):
+            fakeTardis(target, args, cwd, *args_, **kwargs)
+            os.remove(join(cwd, 'Predictions', 'tomo2_instances.csv'))
+
+        prot._runTardis = failOne
+        prot.segmentBatchStep(1, ['tomo1', 'tomo2'])
+        self.assertEqual(prot.failedItems, [('tomo2', TardisSegTargets.membranes)])
+
+
+class TestRoi(TestProtocolBase):
+
+    def testRanges(self):
+        xFirst, xLast = ROI_PARAMS['X']
+        zFirst, zLast = ROI_PARAMS['Z']
+        prot = self._newProtocol(['tomo1'], **{USE_ROI: True, xFirst: 5, xLast: 100, zFirst: 2, zLast: 6})
+        # The last pixels are included and limited to the tomogram
+        self.assertEqual(prot._getRoi('tomo1'), ((5, 40), (0, 30), (2, 7)))
+        # The whole tomogram is not a region
+        prot = self._newProtocol(['tomo1'], **{USE_ROI: True})
+        self.assertIsNone(prot._getRoi('tomo1'))
+
+    def testResults(self):
+        xFirst = ROI_PARAMS['X'][0]
+        zFirst, zLast = ROI_PARAMS['Z']
+        prot = self._newProtocol(['tomo1'], **{USE_ROI: True, xFirst: 5, zFirst: 2, zLast: 6})
+        prot.convertInputStep('tomo1')
+        target = prot._getTargets()[0]
+        with mrcfile.open(prot._getTargetTomoFile('tomo1', target)) as mrc:
+            self.assertEqual(mrc.data.shape, (5, 30, 35))
+            regionData = mrc.data.copy()
+        prot.segmentStep('tomo1')
+        try:
+            semanticJob = prot._submitSemanticPreparation('tomo1', target)
+            instancesJob = prot._submitInstancesPreparation('tomo1', target)
+            semanticJob.result()
+            self.assertEqual(instancesJob.result(), (2, 2))
+        finally:
+            prot._stopPostprocessingPool()
+        # The mask is placed back in the whole tomogram
+        expected = np.zeros(tuple(reversed(self.dims)), dtype=np.float32)
+        expected[2:7, :, 5:] = regionData > 0
+        fnMask = prot._getOutputFileName('tomo1', target, TardisSegModes.semantic.name, 'mrc')
+        with mrcfile.open(fnMask) as mrc:
+            np.testing.assert_array_equal(mrc.data, expected)
+        # The coordinates are referred to the whole tomogram: the ones written by the fake Tardis, in angstroms,
+        # plus the origin of the region, plus the shift of the Scipion convention
+        shifts = getScipionShifts(self.tomos['tomo1'])
+        points = loadPoints(prot._getPointsFile('tomo1', target))
+        np.testing.assert_allclose(points['coords'],
+                                      np.array([[10., 20., 30.], [40., 50., 20.]]) / self.samplingRate
+                                      + [5, 0, 2] + shifts)
+
+
+class TestSweep(TestProtocolBase):
+
+    def testSweep(self):
+        prot = self._newProtocol(['tomo1'], **{SWEEP: True, SWEEP_THRESHOLDS: '0.3,0.5 0.6,0.9'})
+        prot.convertInputStep('tomo1')
+        prot.segmentStep('tomo1')
+        self.assertEqual(prot.failedItems, [])
+        # The network is run once, and then Tardis predicts the instances from the mask of each threshold
+        self.assertEqual(self.segmented, ['tomo1', 'tomo1_sweep1', 'tomo1_sweep2'])
+        target = prot._getTargets()[0]
+        probabilities = tifffile.imread(prot._getOutputFileName('tomo1', target, *PROBABILITY_MAP))
+        for sweepId, threshold in [(1, 0.3), (2, 0.6)]:
+            fnMask = prot._getOutputFileName('tomo1', target, TardisSegModes.semantic.name, 'mrc', sweepId)
+            with mrcfile.open(fnMask) as mrc:
+                np.testing.assert_array_equal(mrc.data, probabilities >= threshold)
+                self.assertEqual(float(mrc.voxel_size.x), self.samplingRate)
+            self.assertTrue(exists(prot._getOutputFileName('tomo1', target, TardisSegModes.instances.name, 'csv',
+                                                           sweepId)))
+        self.assertTrue(prot._loadSegmentationMarker('tomo1', target))
+
+
+class TestConversion(TestProtocolBase):
+
+    def testVolumeStack(self):
+        fn = join(self.tmpDir.name, 'stack.mrc')
+        data = np.random.default_rng(0).normal(size=(2,) + tuple(reversed(self.dims))).astype(np.float32)
+        with mrcfile.new(fn, data) as mrc:
+            mrc.voxel_size = self.samplingRate
+        tomo = Tomogram(location=(2, fn))
+        tomo.setTsId('tomo1')
+        tomo.setSamplingRate(self.samplingRate)
+        self.tomos['tomo1'] = tomo
+        prot = self._newProtocol(['tomo1'])
+        prot.convertInputStep('tomo1')
+        # Tardis segments the second volume of the stack, extracted to a plain MRC file
+        tomoFile = prot._getTargetTomoFile('tomo1', prot._getTargets()[0])
+        with mrcfile.open(tomoFile) as mrc:
+            np.testing.assert_array_equal(mrc.data, data[1])
+        prot.segmentStep('tomo1')
+        self.assertEqual(self.segmented, ['tomo1'])
+
+
+class TestAutoBinning(TestProtocolBase):
+
+    def testBinned(self):
+        # So little memory that the tomograms are binned up to the Tardis pixel size of membranes (15 Å/px)
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{AUTO_BIN: True, MAX_MEMORY: 1e-9, BATCH_SIZE: 2})
+        for tsId in prot.inTomosDict:
+            prot.convertInputStep(tsId)
+        target = prot._getTargets()[0]
+        self.assertEqual(prot._getBinningFactor('tomo1', target), 3)
+        with mrcfile.open(prot._getTargetTomoFile('tomo1', target)) as mrc:
+            self.assertEqual(mrc.data.shape, (3, 10, 13))
+            self.assertEqual(float(mrc.voxel_size.x), 15)
+        self.assertIn('--correct_px 15.000', prot._getCmdArgs('tomo1', target))
+        # The tomograms binned by the same factor are segmented together
+        prot.segmentBatchStep(1, ['tomo1', 'tomo2'])
+        self.assertEqual(self.segmented, ['tomo1', 'tomo2'])
+        self.assertTrue(exists(join(prot._getBatchDir(1, target, 3), 'tomo1.mrc')))
+        self.assertEqual(prot.failedItems, [])
+
+
+class TestMarkers(TestProtocolBase):
+
+    def testReused(self):
+        self._segment()
+        self.assertEqual(self.segmented, ['tomo1'])
+        self._segment()
+        self.assertEqual(self.segmented, [])  # Segmented by the previous execution
+
+    def testRoiChanged(self):
+        zFirst = ROI_PARAMS['Z'][0]
+        self._segment(**{USE_ROI: True, zFirst: 2})
+        self._segment(**{USE_ROI: True, zFirst: 2})
+        self.assertEqual(self.segmented, [])
+        # The results of another region are not valid, even with the same Tardis arguments
+        self._segment(**{USE_ROI: True, zFirst: 3})
+        self.assertEqual(self.segmented, ['tomo1'])
+        self._segment()
+        self.assertEqual(self.segmented, ['tomo1'])
+
+    def testInputChanged(self):
+        self._segment()
+        fn = self.tomos['tomo1'].getFileName()
+        mtime = os.stat(fn).st_mtime
+        os.utime(fn, (mtime + 10, mtime + 10))  # E. g. the tomogram was reconstructed again
+        self._segment()
+        self.assertEqual(self.segmented, ['tomo1'])
+
+    def testOutputPrepared(self):
+        zFirst = ROI_PARAMS['Z'][0]
+        prot = self._segment(**{USE_ROI: True, zFirst: 2})
+        target = prot._getTargets()[0]
+        self.assertFalse(prot._isOutputPrepared('tomo1', target))
+        prot._saveSegmentationMarker('tomo1', target, prepared=True)
+        self.assertTrue(prot._isOutputPrepared('tomo1', target))
+        prot = self._newProtocol(['tomo1'], **{USE_ROI: True, zFirst: 3})
+        self.assertFalse(prot._isOutputPrepared('tomo1', target))
+
+
+class TestPreview(TestProtocolBase):
+
+    def _getMaskShape(self, prot: ProtTardisSeg) -> Tuple[int, int, int]:
+        fn = prot._getOutputFileName('tomo1', prot._getTargets()[0], TardisSegModes.semantic.name, 'mrc')
+        with mrcfile.open(fn) as mrc:
+            return mrc.data.shape
+
+    def testPromoteToFull(self):
+        # Without binning, the preview runs Tardis with the same arguments as the full segmentation
+        previewParams = {PREVIEW: True, PREVIEW_BIN: 1}
+        prot = self._segment(**previewParams)
+        self.assertEqual(self.segmented, ['tomo1'])
+        self.assertEqual(prot._getRoi('tomo1'), ((10, 30), (7, 22), (0, 10)))
+        self.assertEqual(self._getMaskShape(prot), (10, 15, 20))
+        # Continued preview
+        self._segment(**previewParams)
+        self.assertEqual(self.segmented, [])
+        # Promoted to a full segmentation: the central region segmented by the preview is not reused
+        prot = self._segment()
+        self.assertEqual(self.segmented, ['tomo1'])
+        self.assertEqual(self._getMaskShape(prot), (10, 30, 40))
+        # The files of the preview outputs are kept
+        self.assertEqual(self._getMaskShape(self._newProtocol(['tomo1'], **previewParams)), (10, 15, 20))
+
+    @staticmethod
+    def _select(prot: ProtTardisSeg, tsIds: List[str], streamOpen: bool) -> List[str]:
+        """The tsIds of the sample selected among the tomograms of the tsIds given, as they arrive."""
+        tomos = []
+        for tsId in tsIds:
+            tomo = Tomogram()
+            tomo.setTsId(tsId)
+            tomos.append(tomo)
+        return [tomo.getTsId() for tomo in prot._selectPreviewTomos(tomos, streamOpen)]
+
+    def testEvenSample(self):
+        tsIds = [f'tomo{i}' for i in reversed(range(10))]
+        prot = self._newProtocol([], **{PREVIEW: True, PREVIEW_SIZE: 3})
+        self.assertEqual(self._select(prot, tsIds, False), ['tomo0', 'tomo4', 'tomo9'])
+        self.assertTrue(prot._isPreviewComplete())
+        prot = self._newProtocol([], **{PREVIEW: True, PREVIEW_SIZE: 1})
+        self.assertEqual(self._select(prot, tsIds, False), ['tomo5'])
+        # A sample larger than the set has all its tomograms
+        prot = self._newProtocol([], **{PREVIEW: True, PREVIEW_SIZE: 20})
+        self.assertEqual(self._select(prot, tsIds, False), sorted(tsIds))
+        self.assertFalse(prot._isPreviewComplete())
+
+    def testStreamingSample(self):
+        # The first tomograms that arrive
+        prot = self._newProtocol([], **{PREVIEW: True, PREVIEW_SIZE: 3})
+        self.assertEqual(self._select(prot, ['tomo5', 'tomo2'], True), ['tomo2', 'tomo5'])
+        self.assertFalse(prot._isPreviewComplete())
+        self.assertEqual(self._select(prot, ['tomo9', 'tomo1'], True), ['tomo1'])
+        self.assertTrue(prot._isPreviewComplete())
+        self.assertEqual(self._select(prot, ['tomo0'], True), [])
+
+    def testTsIds(self):
+        prot = self._newProtocol([], **{PREVIEW: True, PREVIEW_SIZE: 1, PREVIEW_TSIDS: 'tomo3 tomo7'})
+        self.assertEqual(self._select(prot, ['tomo1', 'tomo3'], True), ['tomo3'])
+        self.assertFalse(prot._isPreviewComplete())
+        self.assertEqual(self._select(prot, ['tomo8', 'tomo7'], False), ['tomo7'])
+        self.assertTrue(prot._isPreviewComplete())
+
+    def testContinued(self):
+        tsIds = [f'tomo{i}' for i in range(1, 6)]
+        prot = self._newProtocol([], **{PREVIEW: True, PREVIEW_SIZE: 1})
+        self._setInputSet(prot, tsIds)
+        steps = self._generateSteps(prot, [])
+        self.assertEqual(steps, [('convertInputStep', ('tomo3',), []),
+                                 ('segmentStep', ('tomo3',), [1]),
+                                 ('createOutputStep', ('tomo3',), 2),
+                                 ('closeOutputSetStep', (), [3])])
+        prot.convertInputStep('tomo3')
+        prot.segmentStep('tomo3')
+        prot.createOutputStep('tomo3')
+        prot._stopPostprocessingPool()
+        # A larger sample keeps the tomogram previewed and is topped up with the rest, spread over them
+        getattr(prot, PREVIEW_SIZE).set(3)
+        steps = self._generateSteps(prot, [])
+        self.assertEqual([args for funcName, args, _ in steps if funcName == 'segmentStep'],
+                         [('tomo1',), ('tomo5',)])
+
+
+class TestOomFallbacks(TestProtocolBase):
+
+    def _newProtocol(self, tsIds: List[str], **params) -> ProtTardisSeg:
+        prot = super()._newProtocol(tsIds, **{OOM_FALLBACKS: 'cpu'}, **params)
+        self.loads = []  # Load of the devices during each execution on CPU
+
+        def gpuOom(target, args, cwd, logFile, device, cpu=False):
+            if not cpu:
+                raise Exception('torch.OutOfMemoryError: CUDA out of memory')
+            self.loads.append(prot._deviceScheduler.getLoad())
+            self._fakeTardis(target, args, cwd, logFile, device, cpu)
+
+        prot._runTardis = gpuOom
+        return prot
+
+    def testCpuReleasesGpu(self):
+        prot = self._newProtocol(['tomo1'])
+        prot.convertInputStep('tomo1')
+        prot.segmentStep('tomo1')
+        self.assertEqual(prot.failedItems, [])
+        self.assertEqual(self.loads, [{'0': 0}])
+
+    def testBatchCpuReleasesGpu(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{BATCH_SIZE: 2})
+        for tsId in prot.inTomosDict:
+            prot.convertInputStep(tsId)
+        prot.segmentBatchStep(1, ['tomo1', 'tomo2'])
+        self.assertEqual(prot.failedItems, [])
+        self.assertEqual(self.segmented, ['tomo1', 'tomo2'])
+        self.assertEqual(self.loads, [{'0': 0}] * 2)
+
+
+class TestDevices(TestProtocolBase):
+
+    def _newProtocol(self, tsIds: List[str], **params) -> ProtTardisSeg:
+        params.update({MULTI_TARGET: True,
+                       MULTI_TARGET_PARAMS[TardisSegTargets.membranes]: True,
+                       MULTI_TARGET_PARAMS[TardisSegTargets.microtubules]: True})
+        prot = super()._newProtocol(tsIds, **params)
+        prot._deviceScheduler = DeviceScheduler(['0', '1'])
+        self.devices = []  # Device of each Tardis execution
+
+        def recordDevice(target, args, cwd, logFile, device, cpu=False):
+            self.devices.append(device)
+            self._fakeTardis(target, args, cwd, logFile, device, cpu)
+
+        prot._runTardis = recordDevice
+        return prot
+
+    def _checkAcquisitions(self, prot: ProtTardisSeg, segment, nExecutions: int):
+        scheduler = prot._deviceScheduler
+        with mock.patch.object(scheduler, 'acquire', wraps=scheduler.acquire) as acquire:
+            segment()
+        self.assertEqual(prot.failedItems, [])
+        self.assertEqual(acquire.call_count, 1)
+        self.assertEqual(len(self.devices), nExecutions)
+        self.assertEqual(len(set(self.devices)), 1)
+        self.assertEqual(scheduler.getLoad(), {'0': 0, '1': 0})
+
+    def testTomogram(self):
+        # All the targets and thresholds of a tomogram run on the device booked for it
+        prot = self._newProtocol(['tomo1'], **{SWEEP: True, SWEEP_THRESHOLDS: '0.3,0.5 0.6,0.9'})
+        prot.convertInputStep('tomo1')
+        self._checkAcquisitions(prot, lambda: prot.segmentStep('tomo1'), nExecutions=2 * 3)
+
+    def testBatch(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{BATCH_SIZE: 2})
+        for tsId in prot.inTomosDict:
+            prot.convertInputStep(tsId)
+        self._checkAcquisitions(prot, lambda: prot.segmentBatchStep(1, ['tomo1', 'tomo2']), nExecutions=2)
+
+
+class TestCommits(TestProtocolBase):
+
+    def _newProtocol(self, tsIds: List[str], **params) -> ProtTardisSeg:
+        prot = super()._newProtocol(tsIds, **params)
+        self._setInputSet(prot, tsIds)
+        prot._processedItems = prot._getProcessedItems()
+        self.commits = []  # Size of the outputs stored by each commit
+
+        def recordCommit(*objs):
+            self.commits.append({name: output.getSize() for name, output in prot.iterOutputAttributes()
+                                 if any(output is obj for obj in objs)})
+
+        prot._store = recordCommit
+        return prot
+
+    def _createOutputs(self, prot: ProtTardisSeg, tsId: str):
+        prot.convertInputStep(tsId)
+        prot.segmentStep(tsId)
+        prot.createOutputStep(tsId)
+
+    def testTomograms(self):
+        prot = self._newProtocol(['tomo1', 'tomo2', 'tomo3'])
+        with mock.patch('tardis.protocols.protocol_tardis_seg.OUTPUT_COMMIT_TOMOS', 2):
+            self._createOutputs(prot, 'tomo1')
+            self.assertEqual(self.commits, [])
+            self._createOutputs(prot, 'tomo2')
+            self.assertEqual(self.commits, [{'segmentations': 2, 'meshes': 4}])
+            self._createOutputs(prot, 'tomo3')
+            self.assertEqual(len(self.commits), 1)
+            # The last tomograms are stored when the outputs are closed
+            prot.closeOutputSetStep()
+            self.assertEqual(self.commits[1], {'segmentations': 3, 'meshes': 6})
+            self.assertFalse(prot.segmentations.isStreamOpen())
+
+    def testSeconds(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'])
+        self._createOutputs(prot, 'tomo1')
+        self.assertEqual(self.commits, [])
+        # A check of the input set stores them once the time is up, without waiting for another tomogram
+        with prot._lock:
+            prot._commitOutputs()
+        self.assertEqual(self.commits, [])
+        prot._lastCommitTime -= OUTPUT_COMMIT_SECS
+        with prot._lock:
+            prot._commitOutputs()
+        self.assertEqual(self.commits, [{'segmentations': 1, 'meshes': 2}])
+        # The time is counted again from that commit
+        self._createOutputs(prot, 'tomo2')
+        self.assertEqual(len(self.commits), 1)
+        prot._stopPostprocessingPool()
+
+    def testInputChecks(self):
+        prot = self._newProtocol(['tomo1'])
+        prot._getInTomos().setStreamState(Set.STREAM_OPEN)
+        self._createOutputs(prot, 'tomo1')
+        prot._stopPostprocessingPool()
+        prot._lastCommitTime -= OUTPUT_COMMIT_SECS
+        # No other tomogram arrives, but the outputs are stored by the next check of the input set
+        steps = self._generateSteps(prot, [lambda inTomos: inTomos.setStreamState(Set.STREAM_CLOSED)])
+        self.assertEqual(self.commits, [{'segmentations': 1, 'meshes': 2}])
+        self.assertEqual(steps, [('closeOutputSetStep', (), [])])
+
+
+class TestStreaming(TestProtocolBase):
+
+    def _addTomos(self, *tsIds: str) -> Callable[[SetOfTomograms], None]:
+        def addTomos(inTomos: SetOfTomograms):
+            for tsId in tsIds:
+                self.tomos[tsId] = self._createTomo(tsId)
+                inTomos.append(self.tomos[tsId].clone())
+            inTomos.write()
+        return addTomos
+
+    @staticmethod
+    def _close(inTomos: SetOfTomograms):
+        inTomos.setStreamState(Set.STREAM_CLOSED)
+
+    def testNewTomograms(self):
+        prot = self._newProtocol([], **{BATCH_SIZE: 2})
+        self._setInputSet(prot, ['tomo1']).setStreamState(Set.STREAM_OPEN)
+        steps = self._generateSteps(prot, [self._addTomos('tomo2', 'tomo3'), self._close])
+        # A batch is launched once it is complete and the last one, incomplete, once the input set is closed
+        self.assertEqual(steps, [('convertInputStep', ('tomo1',), []),
+                                 ('convertInputStep', ('tomo2',), []),
+                                 ('segmentBatchStep', (1, ['tomo1', 'tomo2']), [1, 2]),
+                                 ('createOutputStep', ('tomo1',), 3),
+                                 ('createOutputStep', ('tomo2',), 3),
+                                 ('convertInputStep', ('tomo3',), []),
+                                 ('segmentBatchStep', (2, ['tomo3']), [6]),
+                                 ('createOutputStep', ('tomo3',), 7),
+                                 ('closeOutputSetStep', (), [4, 5, 8])])
+
+    def testContinued(self):
+        prot = self._newProtocol(['tomo1'])
+        self._setInputSet(prot, ['tomo1', 'tomo2', 'tomo3'])
+        prot._processedItems = prot._getProcessedItems()
+        prot.convertInputStep('tomo1')
+        prot.segmentStep('tomo1')
+        prot.createOutputStep('tomo1')
+        prot._stopPostprocessingPool()
+        # The tomograms already in the outputs are not segmented again
+        steps = self._generateSteps(prot, [])
+        self.assertEqual(steps, [('convertInputStep', ('tomo2',), []),
+                                 ('segmentStep', ('tomo2',), [1]),
+                                 ('createOutputStep', ('tomo2',), 2),
+                                 ('convertInputStep', ('tomo3',), []),
+                                 ('segmentStep', ('tomo3',), [4]),
+                                 ('createOutputStep', ('tomo3',), 5),
+                                 ('closeOutputSetStep', (), [3, 6])])
+
+
+class TestOutputs(TestProtocolBase):
+
+    def _newProtocol(self, tsIds: List[str], **params) -> ProtTardisSeg:
+        prot = super()._newProtocol(tsIds, **params)
+        self._setInputSet(prot, tsIds)
+        prot._processedItems = prot._getProcessedItems()
+        return prot
+
+    def _run(self, prot: ProtTardisSeg):
+        """Runs all the steps of the protocol after the step generator, for each tomogram."""
+        for tsId in prot.inTomosDict:
+            prot.convertInputStep(tsId)
+            prot.segmentStep(tsId)
+            prot.createOutputStep(tsId)
+        prot.closeOutputSetStep()
+
+    def testPointsFiles(self):
+        # The points files of the meshes are removed once they are appended, but not the ones of the points
+        prot = self._newProtocol(['tomo1'])
+        self._run(prot)
+        target = prot._getTargets()[0]
+        self.assertEqual(prot.meshes.getSize(), 2)
+        self.assertFalse(exists(prot._getPointsFile('tomo1', target)))
+        self.assertTrue(exists(prot._getPointsIndexFile('tomo1', target)))
+        prot = self._newProtocol(['tomo2'], **{POINTS_FILES: True})
+        self._run(prot)
+        self.assertEqual(prot.points.getSize(), 1)
+        self.assertTrue(exists(prot._getPointsFile('tomo2', target)))
+
+    def _failTardis(self, prot: ProtTardisSeg, tsId: str, target: TardisSegTargets):
+        """Makes the Tardis executions of a tomogram and target fail."""
+        def runTardis(runTarget, args, cwd, *args_, **kwargs):
+            if runTarget == target and tsId in args:
+                raise Exception('Tardis failed')
+            self._fakeTardis(runTarget, args, cwd, *args_, **kwargs)
+
+        prot._runTardis = runTardis
+
+    def _checkOutput(self, prot: ProtTardisSeg, outName: str, size: int):
+        output = getattr(prot, outName, None)
+        self.assertIsNotNone(output, outName)
+        self.assertEqual(output.getSize(), size, outName)
+        self.assertFalse(output.isStreamOpen(), outName)
+
+    def testOutputs(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'])
+        self._failTardis(prot, 'tomo2', TardisSegTargets.membranes)
+        self._run(prot)
+        self._checkOutput(prot, 'segmentations', 1)
+        self._checkOutput(prot, 'meshes', 2)  # Two points per tomogram
+        self._checkOutput(prot, OUTPUT_TOMOS_FAILED_NAME, 1)
+        self.assertEqual(getattr(prot, OUTPUT_TOMOS_FAILED_NAME).getUniqueValues('_tsId'), ['tomo2'])
+        self.assertEqual(prot.segmentations.getUniqueValues('_tsId'), ['tomo1'])
+
+    def testTargetsAndSweep(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{MULTI_TARGET: True,
+                                                        MULTI_TARGET_PARAMS[TardisSegTargets.membranes]: True,
+                                                        MULTI_TARGET_PARAMS[TardisSegTargets.microtubules]: True,
+                                                        SWEEP: True,
+                                                        SWEEP_THRESHOLDS: '0.3,0.5 0.6,0.9'})
+        # A failed target does not prevent the outputs of the other ones
+        self._failTardis(prot, 'tomo2', TardisSegTargets.microtubules)
+        self._run(prot)
+        for sweepId in [1, 2]:
+            self._checkOutput(prot, f'segmentationsMembranesSweep{sweepId}', 2)
+            self._checkOutput(prot, f'meshesMembranesSweep{sweepId}', 4)
+            self._checkOutput(prot, f'segmentationsMicrotubulesSweep{sweepId}', 1)
+            self._checkOutput(prot, f'meshesMicrotubulesSweep{sweepId}', 2)
+        self._checkOutput(prot, f'{OUTPUT_TOMOS_FAILED_NAME}Microtubules', 1)
+        self.assertIsNone(getattr(prot, f'{OUTPUT_TOMOS_FAILED_NAME}Membranes', None))
+
+    def testLock(self):
+        # The results are prepared out of the lock of the outputs, which is only held to append them
+        prot = self._newProtocol(['tomo1'])
+        lockHeld = {}
+
+        def isLockHeld() -> bool:
+            """Tells if the lock is held by the step, trying to acquire it from another thread."""
+            acquired = []
+
+            def tryAcquire():
+                acquired.append(prot._lock.acquire(blocking=False))
+                if acquired[0]:
+                    prot._lock.release()
+
+            thread = threading.Thread(target=tryAcquire)
+            thread.start()
+            thread.join()
+            return not acquired[0]
+
+        for methodName in ['_submitSemanticPreparation', '_submitInstancesPreparation', '_prepareSemanticOutput',
+                           '_prepareInstanceOutput', '_createSemanticOutput', '_createInstanceOutput']:
+            method = getattr(prot, methodName)
+
+            def recordLock(*args, method=method, methodName=methodName, **kwargs):
+                lockHeld[methodName] = isLockHeld()
+                return method(*args, **kwargs)
+
+            setattr(prot, methodName, recordLock)
+        self._run(prot)
+        self.assertEqual(lockHeld, {'_submitSemanticPreparation': False,
+                                    '_submitInstancesPreparation': False,
+                                    '_prepareSemanticOutput': False,
+                                    '_prepareInstanceOutput': False,
+                                    '_createSemanticOutput': True,
+                                    '_createInstanceOutput': True})
+
+
+class TestCpuSlots(TestProtocolBase):
+
+    def _checkSlots(self, threads: int, threadsPerJob: int, nJobs: int, jobThreads: int):
+        prot = self._newProtocol([], **{DEVICE: TardisDevices.cpu.value, CPU_THREADS_PER_JOB: threadsPerJob})
+        prot.numberOfThreads.set(threads)
+        prot._initialize()
+        self.assertEqual(len(prot._deviceScheduler.devices), nJobs)
+        self.assertEqual(prot._getDeviceConfig(prot._deviceScheduler.devices[0]), ('', jobThreads))
+
+    def testSlots(self):
+        self._checkSlots(9, 4, 2, 4)
+        self._checkSlots(8, 4, 1, 4)
+        # The executions never have more threads than the protocol
+        self._checkSlots(2, 4, 1, 1)
+        self._checkSlots(4, 4, 1, 3)
+        self._checkSlots(1, 4, 1, 1)
+
+
+class TestArrayJobs(TestProtocolBase):
+
+    def _newProtocol(self, tsIds: List[str], **params) -> ProtTardisSeg:
+        prot = super()._newProtocol(tsIds, **{USE_ARRAY_JOB: True}, **params)
+        hostConfig = mock.Mock()
+        hostConfig.getQueuesDefault.return_value = {}
+        prot.getHostConfig = lambda: hostConfig
+        prot.getSubmitDict = lambda: {'JOB_QUEUE': 'tardis'}  # No project to take the queue parameters from
+        return prot
+
+    def _createTomo(self, tsId: str) -> Tomogram:
+        # Different data for each tomogram, so they don't share the entries of the results cache
+        tomo = super()._createTomo(tsId)
+        with mrcfile.open(tomo.getFileName(), 'r+') as mrc:
+            mrc.data[:] += int(tsId[len('tomo'):])
+        return tomo
+
+    def _segmentArray(self, prot: ProtTardisSeg, batches: List[Tuple[int, List[str]]], failedTsIds=(),
+                      submitError=False) -> Tuple[list, dict]:
+        """Runs the array job step of the batches given, after converting their tomograms, submitting the job
+        to a fake queue that runs the fake Tardis for each task, except the ones with results of the tsIds in
+        failedTsIds. Returns the tasks and the submission variables of the job."""
+        job = {}
+
+        class FakeArrayJob:
+            def __init__(self, jobDir: str, tasks: list):
+                job['tasks'] = tasks
+
+            def submit(self, hostConfig, submitDict: dict, arrayOption: str):
+                job['submitDict'] = submitDict
+                if submitError:
+                    raise RuntimeError('Unable to submit the array job')
+
+            def wait(fakeJob, hostConfig) -> List[bool]:
+                for task in job['tasks']:
+                    if any(basename(fn).startswith(f'{tsId}_') for fn in task.outputs for tsId in failedTsIds):
+                        continue
+                    target, program = next((target, program) for target, program in TARGET_PROGRAMS.items()
+                                           if f' {program} ' in task.command)
+                    self._fakeTardis(target, task.command.split(f' {program} ', 1)[1], task.cwd, task.logFile,
+                                     None)
+                return [all(exists(fn) for fn in task.outputs) for task in job['tasks']]
+
+        for _, tsIds in batches:
+            for tsId in tsIds:
+                prot.convertInputStep(tsId)
+        with mock.patch('tardis.cluster.ArrayJob', FakeArrayJob):
+            prot.segmentArrayStep(batches)
+        return job.get('tasks', []), job.get('submitDict', {})
+
+    def testTaskPerTomogram(self):
+        prot = self._newProtocol(['tomo1', 'tomo2'], **{DEVICE: TardisDevices.cpu.value, CPU_THREADS_PER_JOB: 4})
+        target = prot._getTargets()[0]
+        tasks, submitDict = self._segmentArray(prot, [(1, ['tomo1']), (2, ['tomo2'])])
+        self.assertEqual([task.cwd for task in tasks],
+                         [prot._getTargetDir('tomo1', target), prot._getTargetDir('tomo2', target)])
+        # The threads requested for each task are the ones Tardis uses
+        for task in tasks:
+            self.assertIn('OMP_NUM_THREADS=4 MKL_NUM_THREADS=4 ', task.command)
+        self.assertEqual((submitDict['JOB_QUEUE'], submitDict['JOB_THREADS'], submitDict['GPU_COUNT']),
+                         ('tardis', 4, 0))
+        self.assertEqual(self.segmented, ['tomo1', 'tomo2'])
+        self.assertEqual(prot.failedItems, [])
+
+    def testTaskPerBatchGroup(self):
+        prot = self._newProtocol(['tomo1', 'tomo2', 'tomo3'], **{BATCH_SIZE: 3})
+        prot._getBinningFactor = lambda tsId, target: 2 if tsId == 'tomo2' else 1
+        target = prot._getTargets()[0]
+        tasks, submitDict = self._segmentArray(prot, [(1, ['tomo1', 'tomo2', 'tomo3'])])
+        # A task per binning factor in the batch
+        self.assertEqual([task.cwd for task in tasks],
+                         [prot._getBatchDir(1, target, 1), prot._getBatchDir(1, target, 2)])
+        for task in tasks:
+            self.assertNotIn('OMP_NUM_THREADS', task.command)
+        self.assertEqual((submitDict['JOB_THREADS'], submitDict['GPU_COUNT']), (1, 1))
+        self.assertEqual(sorted(self.segmented), ['tomo1', 'tomo2', 'tomo3'])
+        self.assertEqual(prot.failedItems, [])
+        # The results are moved to the directory of each tomogram
+        for tsId in prot.inTomosDict:
+            for suffix, ext in prot._getExpectedOutputs():
+                self.assertTrue(exists(prot._getOutputFileName(tsId, target, suffix, ext)))
+
+    def testFailures(self):
+        cacheDir = join(self.tmpDir.name, 'cache')
+        with mock.patch.object(Plugin, 'getCacheDir', return_value=cacheDir), \
+                mock.patch.object(Plugin, 'getCacheMaxSize', return_value=1):
+            prot = self._newProtocol(['tomo1', 'tomo2'], **{USE_CACHE: True})
+            target = prot._getTargets()[0]
+            self._segmentArray(prot, [(1, ['tomo1']), (2, ['tomo2'])], failedTsIds=['tomo2'])
+            self.assertEqual(prot.failedItems, [('tomo2', target)])
+            # A new execution: only the failed tomogram is submitted, the other one comes from the cache
+            cleanPath(prot._getExtraPath())
+            self.segmented = []
+            prot = self._newProtocol(['tomo1', 'tomo2'], **{USE_CACHE: True})
+            tasks, _ = self._segmentArray(prot, [(1, ['tomo1']), (2, ['tomo2'])])
+            self.assertEqual([task.cwd for task in tasks], [prot._getTargetDir('tomo2', target)])
+            self.assertEqual(self.segmented, ['tomo2'])
+            self.assertEqual(prot.failedItems, [])
+        # All the tomograms of a job that can't be submitted fail, also the ones of a batch
+        cleanPath(prot._getExtraPath())
+        prot = self._newProtocol(['tomo1', 'tomo2', 'tomo3'], **{BATCH_SIZE: 2})
+        self._segmentArray(prot, [(1, ['tomo1', 'tomo2']), (2, ['tomo3'])], submitError=True)
+        self.assertEqual(sorted(prot.failedItems), [('tomo1', target), ('tomo2', target), ('tomo3', target)])
+
+
+class TestCache(TestProtocolBase):
+
+    def _newProtocol(self, tsIds: List[str], **params) -> ProtTardisSeg:
+        params.update({MULTI_TARGET: True, USE_CACHE: True,
+                       MULTI_TARGET_PARAMS[TardisSegTargets.membranes]: True,
+                       MULTI_TARGET_PARAMS[TardisSegTargets.microtubules]: True})
+        return super()._newProtocol(tsIds, **params)
+
+    def testDeviceNotInKey(self):
+        # The results of a tomogram segmented on GPU are reused on CPU, also by a fallback, and vice versa
+        target = TardisSegTargets.membranes
+        prot = self._newProtocol(['tomo1'])
+        prot.convertInputStep('tomo1')
+        key = prot._getCacheKey('tomo1', target)
+        self.assertIn('--device gpu', prot._getCmdArgs('tomo1', target))
+        prot._applyFallback('tomo1', target, 'cpu')
+        self.assertIn('--device cpu', prot._getCmdArgs('tomo1', target))
+        self.assertEqual(prot._getCacheKey('tomo1', target), key)
+        prot = self._newProtocol(['tomo1'], **{DEVICE: TardisDevices.cpu.value})
+        self.assertEqual(prot._getCacheKey('tomo1', target), key)
+
+    def testHashOncePerTomogram(self):
+        cacheDir = join(self.tmpDir.name, 'cache')
+        with mock.patch.object(Plugin, 'getCacheDir', return_value=cacheDir), \
+                mock.patch.object(Plugin, 'getCacheMaxSize', return_value=1), \
+                mock.patch.object(ResultsCache, 'hashTomogram', wraps=ResultsCache.hashTomogram) as hashTomogram:
+            prot = self._newProtocol(['tomo1'])
+            prot.convertInputStep('tomo1')
+            prot.segmentStep('tomo1')
+            self.assertEqual(hashTomogram.call_count, 1)
+            self.assertEqual(len(self.segmented), 2)
+            # The same tomogram in a new execution: both targets come from the cache
+            self.segmented = []
+            cleanPath(prot._getExtraPath())
+            prot = self._newProtocol(['tomo1'])
+            prot.convertInputStep('tomo1')
+            prot.segmentStep('tomo1')
+            self.assertEqual(self.segmented, [])
+            self.assertEqual(hashTomogram.call_count, 2)
@@ -0,0 +1,85 @@
+# ***************************************************************************
+# *
+# * Authors:     Scipion Team ()
+# *
+# * Unidad de Bioinformatica of Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import subprocess
+import sys
+import threading
+import unittest
+from collections import Counter
+from typing import Tuple
+from tardis.scheduler import DeviceScheduler
+
+# Stand-in for the Tardis executables: it just reports the device it was launched on
+STAND_IN_CMD = [sys.executable, '-c',
+                'import os, time; time.sleep(0.3); print(os.environ["CUDA_VISIBLE_DEVICES"])']
+
+
+class TestDeviceScheduler(unittest.TestCase):
+
+    @staticmethod
+    def _runJobs(scheduler: DeviceScheduler, nJobs: int) -> Tuple[Counter, Counter]:
+        """Launches nJobs stand-in executions from concurrent threads. Returns the number of jobs
+        executed and the maximum number of simultaneous jobs per device."""
+        lock = threading.Lock()
+        running, maxRunning, executed = Counter(), Counter(), Counter()
+
+        def job():
+            with scheduler.acquire() as device:
+                with lock:
+                    running[device] += 1
+                    maxRunning[device] = max(maxRunning[device], running[device])
+                env = dict(os.environ, CUDA_VISIBLE_DEVICES=device)
+                reportedDevice = subprocess.check_output(STAND_IN_CMD, env=env, text=True).strip()
+                with lock:
+                    running[device] -= 1
+                    executed[reportedDevice] += 1
+
+        threads = [threading.Thread(target=job) for _ in range(nJobs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return executed, maxRunning
+
+    def testAllDevicesBusy(self):
+        devices = ['0', '1', '2']
+        executed, maxRunning = self._runJobs(DeviceScheduler(devices, jobsPerDevice=1), nJobs=9)
+        self.assertEqual(sum(executed.values()), 9)
+        self.assertEqual(set(executed), set(devices))
+        self.assertEqual(set(maxRunning.values()), {1})
+
+    def testJobsPerDevice(self):
+        devices = ['0', '1']
+        executed, maxRunning = self._runJobs(DeviceScheduler(devices, jobsPerDevice=2), nJobs=8)
+        self.assertEqual(sum(executed.values()), 8)
+        self.assertEqual(set(executed), set(devices))
+        self.assertEqual(maxRunning, Counter({'0': 2, '1': 2}))
+
+    def testWrongConfiguration(self):
+        with self.assertRaises(ValueError):
+            DeviceScheduler([])
+        with self.assertRaises(ValueError):
+            DeviceScheduler(['0'], jobsPerDevice=0)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import tempfile
+import unittest
+from os.path import join
+import numpy as np
+from tardis.spatial import PointsIndex
+
+
+class TestPointsIndex(unittest.TestCase):
+    """The results of the queries are compared with the ones of a brute force search."""
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.coords = rng.uniform(-300, 300, size=(20000, 3))
+        cls.groupIds = rng.integers(1, 50, size=len(cls.coords))
+        cls.index = PointsIndex.build(cls.groupIds, cls.coords, cellSize=25)
+
+    def _checkSameResults(self, result, mask):
+        groupIds, coords = result
+        expected = np.column_stack((self.groupIds[mask], self.coords[mask]))
+        obtained = np.column_stack((groupIds, coords))
+        self.assertEqual(len(obtained), len(expected))
+        # Same rows, whatever the order
+        np.testing.assert_array_equal(np.unique(obtained, axis=0), np.unique(expected, axis=0))
+
+    def testQueryRadius(self):
+        for center, radius in [((0, 0, 0), 40), ((-290, 100, 280), 75.5), ((1000, 0, 0), 10), ((0, 0, 0), 1000)]:
+            mask = np.sum((self.coords - center) ** 2, axis=1) <= radius ** 2
+            self._checkSameResults(self.index.queryRadius(center, radius), mask)
+
+    def testQueryBox(self):
+        boxes = [((-10, -20, -30), (50, 60, 70)),
+                 ((-400, -400, 250), (400, 400, 400)),
+                 ((500, 500, 500), (600, 600, 600))]
+        for lo, hi in boxes:
+            mask = np.all((self.coords >= lo) & (self.coords <= hi), axis=1)
+            self._checkSameResults(self.index.queryBox(lo, hi), mask)
+
+    def testInstances(self):
+        for groupId in np.unique(self.groupIds):
+            instanceCoords = self.coords[self.groupIds == groupId]
+            instance = self.index.getInstance(groupId)
+            self.assertEqual(instance['count'], len(instanceCoords))
+            np.testing.assert_allclose(instance['min'], instanceCoords.min(axis=0))
+            np.testing.assert_allclose(instance['max'], instanceCoords.max(axis=0))
+            np.testing.assert_allclose(instance['centroid'], instanceCoords.mean(axis=0))
+        self.assertIsNone(self.index.getInstance(1000))
+
+    def testSaveLoad(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            fn = join(tmpDir, 'index.npz')
+            self.index.save(fn)
+            loaded = PointsIndex.load(fn)
+        self._checkSameResults(loaded.queryRadius((10, 10, 10), 60),
+                               np.sum((self.coords - 10) ** 2, axis=1) <= 60 ** 2)
+
+    def testEmpty(self):
+        index = PointsIndex.build([], [])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(index.queryRadius((0, 0, 0), 10)[0]), 0)
+        self.assertIsNone(index.getInstance(1))
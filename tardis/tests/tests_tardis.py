@@ -31,7 +31,8 @@ from imod.protocols.protocol_base_preprocess import NO_ADJUST
 from pyworkflow.tests import setupTestProject, DataSet
 from pyworkflow.utils import magentaStr, cyanStr
 from tardis.protocols.protocol_tardis_seg import TardisSegModes, TardisSegTargets, ProtTardisSeg, IN_TOMOS, SEG_TARGET, \
-    SEG_MODE
+    SEG_MODE, MULTI_TARGET, MULTI_TARGET_PARAMS, BATCH_SIZE, USE_ROI, ROI_PARAMS, PREVIEW, PREVIEW_SIZE
+from tomo.constants import BOTTOM_LEFT_CORNER
 from tomo.objects import SetOfTomoMasks, SetOfMeshes
 from tomo.protocols import ProtImportTomograms
 from tomo.tests.test_base_centralized_layer import TestBaseCentralizedLayer
@@ -102,9 +103,21 @@ class TestTardisBase(TestBaseCentralizedLayer):
                    segTarget: int,
                    segMode: int,
                    cnnThreshold: float = 0.5,
-                   distThreshold: float = 0.9)\
+                   distThreshold: float = 0.9,
+                   outputSuffix: str = '',
+                   **kwargs)\
             -> Tuple[Union[SetOfTomoMasks, None], Union[SetOfMeshes, None]]:
+        """Runs the protocol with the given parameters plus the ones in kwargs. Returns the outputs whose
+        names end with outputSuffix, e. g. the ones of a target when several are segmented."""
+        protTardis = self._launchTardis(segTarget, segMode, cnnThreshold, distThreshold, **kwargs)
+        return self._getTardisOutputs(protTardis, outputSuffix)
 
+    def _launchTardis(self,
+                      segTarget: int,
+                      segMode: int,
+                      cnnThreshold: float = 0.5,
+                      distThreshold: float = 0.9,
+                      **kwargs) -> ProtTardisSeg:
         infoStr, objLabel = self._getInfoStrs(segTarget, segMode)
         print(magentaStr(infoStr))
         tardisInputDict = {
@@ -114,11 +127,17 @@ class TestTardisBase(TestBaseCentralizedLayer):
             'cnnThreshold': cnnThreshold,
             'distThreshold': distThreshold
         }
+        tardisInputDict.update(kwargs)
         protTardis = self.newProtocol(ProtTardisSeg, **tardisInputDict)
         self.launchProtocol(protTardis)
         protTardis.setObjLabel(objLabel)
-        segmentations = getattr(protTardis, protTardis._possibleOutputs.segmentations.name, None)
-        meshes = getattr(protTardis, protTardis._possibleOutputs.meshes.name, None)
+        return protTardis
+
+    @staticmethod
+    def _getTardisOutputs(protTardis: ProtTardisSeg, outputSuffix: str = '') \
+            -> Tuple[Union[SetOfTomoMasks, None], Union[SetOfMeshes, None]]:
+        segmentations = getattr(protTardis, f'{protTardis._possibleOutputs.segmentations.name}{outputSuffix}', None)
+        meshes = getattr(protTardis, f'{protTardis._possibleOutputs.meshes.name}{outputSuffix}', None)
         return segmentations, meshes
 
     @staticmethod
@@ -171,6 +190,41 @@ class TestTardisMembraneSeg(TestTardisBase):
                               expectedSRate=self.unbinnedSRate * self.binFactor,
                               orientedParticles=False)
 
+    def testMembraneSegRoi(self):
+        dims = DataSetEmd10439.getBinnedDims(self.binFactor)
+        zFirst, zLast = int(dims[2]) // 4, 3 * int(dims[2]) // 4 - 1
+        segmentations, meshes = self._runTardis(self.segTarget, TardisSegModes.both.value,
+                                                **{USE_ROI: True,
+                                                   ROI_PARAMS['Z'][0]: zFirst,
+                                                   ROI_PARAMS['Z'][1]: zLast})
+        # The masks are referred back to the whole tomogram
+        self.checkTomoMasks(segmentations,
+                            expectedSetSize=1,
+                            expectedSRate=self.unbinnedSRate * self.binFactor,
+                            expectedDimensions=dims)
+        # And the instances are within the region
+        self.checkCoordinates(meshes,
+                              expectedBoxSize=20,
+                              expectedSRate=self.unbinnedSRate * self.binFactor,
+                              orientedParticles=False)
+        for point in meshes.iterCoordinates():
+            self.assertTrue(zFirst - 1 <= point.getZ(BOTTOM_LEFT_CORNER) <= zLast + 1)
+
+    def testMultiTargetSeg(self):
+        # Membranes and microtubules of the same tomogram in a single execution
+        params = {MULTI_TARGET: True,
+                  MULTI_TARGET_PARAMS[TardisSegTargets.membranes]: True,
+                  MULTI_TARGET_PARAMS[TardisSegTargets.microtubules]: True}
+        protTardis = self._launchTardis(self.segTarget, TardisSegModes.semantic.value, **params)
+        for target in [TardisSegTargets.membranes, TardisSegTargets.microtubules]:
+            segmentations, meshes = self._getTardisOutputs(protTardis, outputSuffix=target.name.capitalize())
+            self.checkTomoMasks(segmentations,
+                                expectedSetSize=1,
+                                expectedSRate=self.unbinnedSRate * self.binFactor,
+                                expectedDimensions=DataSetEmd10439.getBinnedDims(self.binFactor))
+            self.assertIsNone(meshes)
+
+
 class TestTardisMicrotubuleSeg(TestTardisBase):
 
     @classmethod
@@ -195,6 +249,31 @@ class TestTardisMicrotubuleSeg(TestTardisBase):
         # Check the meshes
         self.assertIsNone(meshes)
 
+    def testBatchSeg(self):
+        # All the tomograms segmented by a single Tardis execution
+        segmentations, meshes = self._runTardis(self.segTarget, TardisSegModes.semantic.value,
+                                                cnnThreshold=0.25,
+                                                distThreshold=0.5,
+                                                **{BATCH_SIZE: DataSet_MicrotubulesTomos.nTomos.value})
+        self.checkTomoMasks(segmentations,
+                            expectedSetSize=DataSet_MicrotubulesTomos.nTomos.value,
+                            expectedSRate=self.unbinnedSRate * self.binFactor,
+                            expectedDimensions=DataSet_MicrotubulesTomos.getBinnedDims(self.binFactor))
+        self.assertIsNone(meshes)
+
+    def testPreviewSeg(self):
+        # A sample of a tomogram, with its outputs named with the suffix Preview
+        segmentations, meshes = self._runTardis(self.segTarget, TardisSegModes.semantic.value,
+                                                cnnThreshold=0.25,
+                                                distThreshold=0.5,
+                                                outputSuffix='Preview',
+                                                **{PREVIEW: True, PREVIEW_SIZE: 1})
+        self.checkTomoMasks(segmentations,
+                            expectedSetSize=1,
+                            expectedSRate=self.unbinnedSRate * self.binFactor,
+                            expectedDimensions=DataSet_MicrotubulesTomos.getBinnedDims(self.binFactor))
+        self.assertIsNone(meshes)
+
 
 class TestTardisActinSeg(TestTardisBase):
 
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import sqlite3
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+import mrcfile
+import numpy as np
+import tifffile
+from tardis.utils import readInstancesCsv, appendMeshPoints, appendPointsToMeshes, compactMask, \
+    isOutOfMemoryError, prepareInstances, getScipionShifts, binMrc, upscaleMrc, getBinningFactor, \
+    estimateTardisMemory, getMrcDims, getConversionReason, convertMrc, padMrc, getMaskBoundingBox, \
+    prepareSemanticMask, thresholdProbabilityMap
+from tomo.constants import SCIPION, BOTTOM_LEFT_CORNER
+from tomo.objects import SetOfMeshes, MeshPoint, Tomogram
+
+
+class TestUtilsBase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _getPath(self, fileName: str) -> str:
+        return join(self.tmpDir.name, fileName)
+
+
+class TestInstances(TestUtilsBase):
+
+    def setUp(self):
+        super().setUp()
+        self.tomo = Tomogram()
+        self.tomo.setObjId(1)
+        self.tomo.setTsId('tomo')
+        self.tomo.setSamplingRate(10)
+        rng = np.random.default_rng(0)
+        self.groupIds = rng.integers(1, 20, size=1000)
+        self.coords = rng.uniform(0, 300, size=(1000, 3))
+
+    def _writeCsv(self, fnCsv: str, groupIds: np.ndarray, coords: np.ndarray):
+        with open(fnCsv, 'w') as f:
+            f.write('IDs,X [A],Y [A],Z [A]\n')
+            for groupId, (x, y, z) in zip(groupIds, coords):
+                f.write(f'{groupId},{x!r},{y!r},{z!r}\n')
+
+    def _createMeshes(self, fileName: str) -> SetOfMeshes:
+        meshes = SetOfMeshes(filename=self._getPath(fileName))
+        meshes.setSamplingRate(10)
+        return meshes
+
+    @staticmethod
+    def _readRows(fnSqlite: str) -> list:
+        connection = sqlite3.connect(fnSqlite)
+        try:
+            cursor = connection.execute('SELECT * FROM Objects ORDER BY id')
+            columns = [description[0] for description in cursor.description]
+            return [tuple(value for column, value in zip(columns, row) if column != 'creation') for row in cursor]
+        finally:
+            connection.close()
+
+    def testReadInstancesCsv(self):
+        fnCsv = self._getPath('tomo_instances.csv')
+        self._writeCsv(fnCsv, self.groupIds, self.coords)
+        groupIds, coords = readInstancesCsv(fnCsv)
+        np.testing.assert_array_equal(groupIds, self.groupIds)
+        np.testing.assert_array_equal(coords, self.coords)
+        # A single row and no rows
+        self._writeCsv(fnCsv, self.groupIds[:1], self.coords[:1])
+        groupIds, coords = readInstancesCsv(fnCsv)
+        self.assertEqual(coords.shape, (1, 3))
+        self._writeCsv(fnCsv, [], [])
+        groupIds, coords = readInstancesCsv(fnCsv)
+        self.assertEqual((len(groupIds), coords.shape), (0, (0, 3)))
+
+    def testAppendMeshPoints(self):
+        self._checkAppendMeshPoints('meshes_bulk.sqlite')
+
+    def testAppendMeshPointsFallback(self):
+        # Without the internals of pyworkflow the bulk insert relies on, the points are appended one by one
+        class PublicMapper:
+            def __init__(self, mapper):
+                self.mapper = mapper
+
+            def __getattr__(self, name):
+                if name == '_getValuesFromObject':
+                    raise AttributeError(name)
+                return getattr(self.mapper, name)
+
+        getMapper = SetOfMeshes._getMapper
+        with mock.patch.object(SetOfMeshes, '_getMapper', lambda mesh: PublicMapper(getMapper(mesh))), \
+                self.assertLogs('tardis.utils', 'WARNING'):
+            self._checkAppendMeshPoints('meshes_fallback.sqlite')
+
+    def _checkAppendMeshPoints(self, fnSqlite: str):
+        # The same rows as appending a MeshPoint per point
+        fnBaseline = self._getPath('meshes_baseline.sqlite')
+        meshes = self._createMeshes(fnBaseline)
+        for groupId, (x, y, z) in zip(self.groupIds.tolist(), self.coords.tolist()):
+            point = MeshPoint()
+            point.setVolume(self.tomo)
+            point.setGroupId(groupId)
+            point.setPosition(x, y, z, SCIPION)
+            meshes.append(point)
+        meshes.write()
+        meshes.close()
+
+        fnBulk = self._getPath(fnSqlite)
+        meshes = self._createMeshes(fnBulk)
+        self.assertEqual(appendMeshPoints(meshes, self.tomo, self.groupIds[:400], self.coords[:400]), 400)
+        self.assertEqual(appendMeshPoints(meshes, self.tomo, self.groupIds[400:401], self.coords[400:401]), 1)
+        self.assertEqual(appendMeshPoints(meshes, self.tomo, [], []), 0)
+        self.assertEqual(appendMeshPoints(meshes, self.tomo, self.groupIds[401:], self.coords[401:]), 599)
+        self.assertEqual(meshes.getSize(), len(self.groupIds))
+        meshes.write()
+        meshes.close()
+
+        baselineRows = self._readRows(fnBaseline)
+        self.assertEqual(len(baselineRows), len(self.groupIds))
+        self.assertEqual(self._readRows(fnBulk), baselineRows)
+
+    def testAppendPointsToMeshes(self):
+        from tardis.points import savePoints, loadPoints
+        fnPoints = self._getPath('tomo_points.npy')
+        savePoints(fnPoints, self.groupIds, self.coords)
+        meshes = self._createMeshes('meshes.sqlite')
+        self.assertEqual(appendPointsToMeshes(meshes, self.tomo, loadPoints(fnPoints)), len(self.groupIds))
+        meshes.write()
+        coords = np.array([point.getPosition(SCIPION) for point in meshes.iterItems(orderBy='id')])
+        groupIds = [point.getGroupId() for point in meshes.iterItems(orderBy='id')]
+        meshes.close()
+        np.testing.assert_array_equal(coords, loadPoints(fnPoints)['coords'])
+        np.testing.assert_array_equal(groupIds, self.groupIds)
+
+    def testPrepareInstances(self):
+        # The meshes generated from the points files are the same as the ones of reading the CSV file and
+        # appending a MeshPoint per point
+        from tardis.points import loadPoints
+        fnTomo = self._getPath('tomo.mrc')
+        with mrcfile.new(fnTomo, np.zeros((11, 30, 41), dtype=np.float32)):
+            pass
+        tomo = Tomogram(location=fnTomo)
+        tomo.setObjId(1)
+        tomo.setTsId('tomo')
+        tomo.setSamplingRate(3.37)
+        fnCsv = self._getPath('tomo_instances.csv')
+        self._writeCsv(fnCsv, self.groupIds, self.coords)
+
+        fnBaseline = self._getPath('meshes_baseline.sqlite')
+        meshes = self._createMeshes(fnBaseline)
+        sr = tomo.getSamplingRate()
+        for groupId, x, y, z in np.loadtxt(fnCsv, delimiter=',', skiprows=1):
+            point = MeshPoint()
+            point.setVolume(tomo)
+            point.setGroupId(int(groupId))
+            point.setPosition(x / sr, y / sr, z / sr, BOTTOM_LEFT_CORNER)
+            meshes.append(point)
+        meshes.write()
+        meshes.close()
+
+        fnPoints = self._getPath('tomo_points.npy')
+        nPoints, nInstances = prepareInstances(fnCsv, fnPoints, self._getPath('tomo_points_index.npz'), sr,
+                                               shifts=getScipionShifts(tomo, BOTTOM_LEFT_CORNER), precise=True)
+        self.assertEqual((nPoints, nInstances), (len(self.groupIds), len(np.unique(self.groupIds))))
+        fnMeshes = self._getPath('meshes.sqlite')
+        meshes = self._createMeshes(fnMeshes)
+        appendPointsToMeshes(meshes, tomo, loadPoints(fnPoints))
+        meshes.write()
+        meshes.close()
+        self.assertEqual(self._readRows(fnMeshes), self._readRows(fnBaseline))
+
+
+class TestCompactMask(TestUtilsBase):
+
+    def _writeMask(self, data: np.ndarray) -> str:
+        fn = self._getPath('mask.mrc')
+        with mrcfile.new(fn, data, overwrite=True) as mrc:
+            mrc.voxel_size = (10, 10, 10)
+            mrc.header.origin = (1, 2, 3)
+        return fn
+
+    def testCompact(self):
+        data = np.random.default_rng(0).integers(0, 128, size=(7, 20, 30)).astype(np.float32)
+        fn = self._writeMask(data)
+        self.assertTrue(compactMask(fn, chunkSlices=3))  # The last chunk has a single slice
+        with mrcfile.open(fn) as mrc:
+            self.assertEqual(mrc.header.mode, 0)
+            np.testing.assert_array_equal(mrc.data, data)
+            self.assertEqual(mrc.voxel_size.tolist(), (10, 10, 10))
+            self.assertEqual(mrc.header.origin.tolist(), (1, 2, 3))
+            self.assertEqual(mrc.header.dmax, data.max())
+        self.assertFalse(compactMask(fn))  # Already 8-bit
+
+    def testLabelsOutOfRange(self):
+        # Labels of instances above 127 don't fit in int8, so they must be kept as they are
+        data = np.zeros((4, 20, 30), dtype=np.float32)
+        data[0, 0, :3] = [1, 127, 128]
+        data[3, 19, :2] = [255, 1000]
+        fn = self._writeMask(data)
+        self.assertFalse(compactMask(fn, chunkSlices=2))
+        with mrcfile.open(fn) as mrc:
+            self.assertEqual(mrc.data.dtype, np.float32)
+            np.testing.assert_array_equal(mrc.data, data)
+        self.assertFalse(any(fn.endswith('.tmp') for fn in os.listdir(self.tmpDir.name)))
+
+
+class TestOutOfMemory(TestUtilsBase):
+
+    def testMessages(self):
+        logFile = self._getPath('tardis.log')
+        self.assertFalse(isOutOfMemoryError(logFile))  # No log yet
+        with open(logFile, 'w') as f:
+            f.write('torch.OutOfMemoryError: CUDA out of memory. Tried to allocate 2.00 GiB\n')
+        offset = os.path.getsize(logFile)
+        self.assertTrue(isOutOfMemoryError(logFile))
+        # Only the part of the log written by the last execution is inspected
+        self.assertFalse(isOutOfMemoryError(logFile, offset))
+        self.assertTrue(isOutOfMemoryError(logFile, offset, 'RuntimeError: CUDA error: out of memory'))
+        self.assertTrue(isOutOfMemoryError(logFile, offset, 'CUBLAS_STATUS_ALLOC_FAILED when calling cublasCreate'))
+        # Failures that running on CPU or binning would not fix are not retried
+        for errorMsg in ['Killed', 'Command failed with exit status 137', 'FileNotFoundError: tomo.mrc',
+                         'numpy.core._exceptions._ArrayMemoryError: Unable to allocate 8.00 GiB']:
+            self.assertFalse(isOutOfMemoryError(logFile, offset, errorMsg), errorMsg)
+
+
+class TestBinning(TestUtilsBase):
+
+    def _writeMrc(self, fileName: str, data: np.ndarray, voxelSize: float = 5) -> str:
+        fn = self._getPath(fileName)
+        with mrcfile.new(fn, data, overwrite=True) as mrc:
+            mrc.voxel_size = voxelSize
+        return fn
+
+    def testBinMrc(self):
+        data = np.random.default_rng(0).normal(size=(9, 14, 21)).astype(np.float32)
+        fnIn = self._writeMrc('tomo.mrc', data)
+        fnOut = self._getPath('tomo_bin2.mrc')
+        binMrc(fnIn, fnOut, 2, chunkSlices=3)  # The last chunk is incomplete
+        # The last slice, row and column don't fill a block, so they are cropped
+        expected = data[:8, :14, :20].reshape(4, 2, 7, 2, 10, 2).mean(axis=(1, 3, 5))
+        with mrcfile.open(fnOut) as mrc:
+            np.testing.assert_allclose(mrc.data, expected, rtol=1e-6)
+            self.assertEqual(mrc.voxel_size.tolist(), (10, 10, 10))
+            self.assertAlmostEqual(float(mrc.header.dmean), float(expected.mean()), places=5)
+        self.assertEqual(getMrcDims(fnOut), (10, 7, 4))
+
+    def testUpscaleMrc(self):
+        # A mask segmented from a binned tomogram is taken back to the dimensions of the original one
+        binned = np.random.default_rng(0).integers(0, 3, size=(4, 7, 10)).astype(np.int8)
+        fn = self._writeMrc('mask.mrc', binned, voxelSize=10)
+        dims = (21, 14, 9)  # x, y, z
+        upscaleMrc(fn, 2, dims, chunkSlices=3)
+        expected = np.zeros((9, 14, 21), dtype=np.int8)
+        expected[:8, :14, :20] = binned.repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+        with mrcfile.open(fn) as mrc:
+            self.assertEqual(mrc.data.dtype, np.int8)
+            np.testing.assert_array_equal(mrc.data, expected)
+            self.assertEqual(mrc.voxel_size.tolist(), (5, 5, 5))
+
+    def testBinningFactor(self):
+        dims = (1000, 1000, 300)
+        # It fits without binning
+        self.assertEqual(getBinningFactor(dims, 5, 15, estimateTardisMemory(dims, 5, 15)), 1)
+        # The lowest factor that fits
+        memory = estimateTardisMemory(tuple(dim // 2 for dim in dims), 10, 15)
+        self.assertEqual(getBinningFactor(dims, 5, 15, memory), 2)
+        # Never beyond the Tardis pixel size, even if it does not fit
+        self.assertEqual(getBinningFactor(dims, 5, 15, 0), 3)
+        self.assertEqual(getBinningFactor(dims, 20, 15, 0), 1)
+
+
+class TestConversion(TestUtilsBase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = np.random.default_rng(0).normal(size=(6, 8, 10)).astype(np.float32)
+        self.fn = self._getPath('tomo.mrc')
+        with mrcfile.new(self.fn, self.data) as mrc:
+            mrc.voxel_size = 5
+            mrc.header.origin = (1, 2, 3)
+
+    def _checkConverted(self, fn: str, expected: np.ndarray):
+        self.assertIsNone(getConversionReason(fn))
+        with mrcfile.open(fn) as mrc:
+            np.testing.assert_array_equal(mrc.data, expected)
+            self.assertEqual(mrc.voxel_size.tolist(), (5, 5, 5))
+            self.assertEqual(mrc.header.origin.tolist(), (1, 2, 3))
+
+    def testPlainMrc(self):
+        self.assertIsNone(getConversionReason(self.fn))
+
+    def testNotMrc(self):
+        fn = self._getPath('tomo.em')
+        with open(fn, 'wb') as f:
+            f.write(b'\0' * 2048)
+        self.assertTrue(getConversionReason(fn).startswith('not an MRC file'))
+
+    def testTrailingData(self):
+        with open(self.fn, 'ab') as f:
+            f.write(b'\0' * 100)
+        self.assertEqual(getConversionReason(self.fn), 'unexpected file size')
+        fnOut = self._getPath('tomo_converted.mrc')
+        convertMrc(self.fn, fnOut, chunkSlices=4)
+        self._checkConverted(fnOut, self.data)
+
+    def testMode(self):
+        # Complex volumes are converted to float32
+        with mrcfile.new(self.fn, self.data.astype(np.complex64), overwrite=True) as mrc:
+            mrc.voxel_size = 5
+            mrc.header.origin = (1, 2, 3)
+        self.assertEqual(getConversionReason(self.fn), 'MRC mode 4')
+        fnOut = self._getPath('tomo_converted.mrc')
+        convertMrc(self.fn, fnOut, chunkSlices=4)
+        self._checkConverted(fnOut, self.data)
+        with mrcfile.open(fnOut) as mrc:
+            self.assertEqual(mrc.header.mode, 2)
+
+    def testVolumeStack(self):
+        stack = np.stack([self.data, 2 * self.data])
+        with mrcfile.new(self.fn, stack, overwrite=True) as mrc:
+            mrc.voxel_size = 5
+            mrc.header.origin = (1, 2, 3)
+        self.assertEqual(getConversionReason(self.fn, 2), 'volume stack')
+        fnOut = self._getPath('tomo_converted.mrc')
+        convertMrc(self.fn, fnOut, 2, chunkSlices=4)
+        self._checkConverted(fnOut, 2 * self.data)
+
+    def testRoi(self):
+        # In place, as done with the tomograms converted from other formats
+        convertMrc(self.fn, self.fn, roi=((2, 9), (0, 8), (1, 4)), chunkSlices=2)
+        self._checkConverted(self.fn, self.data[1:4, 0:8, 2:9])
+        self.assertFalse(os.path.exists(f'{self.fn}.tmp'))
+
+
+class TestRoi(TestUtilsBase):
+
+    def setUp(self):
+        super().setUp()
+        self.dims = (21, 14, 9)  # x, y, z
+        self.roi = ((3, 19), (2, 12), (1, 7))
+        self.mask = np.zeros((6, 10, 16), dtype=np.int8)  # Mask of the region
+        self.mask[1:5, 3:8, 2:15] = 1
+        self.fn = self._getPath('mask.mrc')
+        with mrcfile.new(self.fn, self.mask) as mrc:
+            mrc.voxel_size = 5
+
+    def _getExpectedMask(self) -> np.ndarray:
+        (x0, x1), (y0, y1), (z0, z1) = self.roi
+        expected = np.zeros(tuple(reversed(self.dims)), dtype=np.int8)
+        expected[z0:z1, y0:y1, x0:x1] = self.mask
+        return expected
+
+    def testPadMrc(self):
+        padMrc(self.fn, self.dims, self.roi, chunkSlices=4)
+        with mrcfile.open(self.fn) as mrc:
+            np.testing.assert_array_equal(mrc.data, self._getExpectedMask())
+            self.assertEqual(mrc.voxel_size.tolist(), (5, 5, 5))
+
+    def testMaskBoundingBox(self):
+        self.assertEqual(getMaskBoundingBox(self.fn, chunkSlices=4), ((2, 15), (3, 8), (1, 5)))
+        with mrcfile.new(self.fn, np.zeros_like(self.mask), overwrite=True):
+            pass
+        self.assertIsNone(getMaskBoundingBox(self.fn))
+
+    def testPrepareSemanticMask(self):
+        # A region of a tomogram binned by 2: upscaled to the region and placed in the whole tomogram
+        binned = self.mask[::2, ::2, ::2]
+        with mrcfile.new(self.fn, binned, overwrite=True) as mrc:
+            mrc.voxel_size = 10
+        regionDims = (16, 10, 6)
+        prepareSemanticMask(self.fn, binFactor=2, binnedDims=regionDims, dims=self.dims, roi=self.roi)
+        self.mask = binned.repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+        with mrcfile.open(self.fn) as mrc:
+            np.testing.assert_array_equal(mrc.data, self._getExpectedMask())
+            self.assertEqual(mrc.voxel_size.tolist(), (5, 5, 5))
+
+
+class TestThresholdProbabilityMap(TestUtilsBase):
+
+    def setUp(self):
+        super().setUp()
+        self.probabilities = np.random.default_rng(0).uniform(size=(7, 8, 10)).astype(np.float32)
+        self.probabilities[0, 0, :2] = [0.5, np.nextafter(np.float32(0.5), np.float32(0))]
+        self.fnMask = self._getPath('mask.mrc')
+
+    def _check(self, fnProb: str):
+        thresholdProbabilityMap(fnProb, self.fnMask, 0.5, 15, chunkSlices=3)
+        with mrcfile.open(self.fnMask) as mrc:
+            self.assertEqual(mrc.header.mode, 0)
+            np.testing.assert_array_equal(mrc.data, self.probabilities >= 0.5)  # As Tardis does
+            self.assertEqual(mrc.data[0, 0, :2].tolist(), [1, 0])
+            self.assertEqual(mrc.voxel_size.tolist(), (15, 15, 15))
+
+    def testThreshold(self):
+        fnProb = self._getPath('tomo_CNN.tif')
+        tifffile.imwrite(fnProb, self.probabilities)
+        self._check(fnProb)
+
+    def testCompressed(self):
+        # It can't be memory-mapped, so it is read at once
+        fnProb = self._getPath('tomo_CNN.tif')
+        tifffile.imwrite(fnProb, self.probabilities, compression='zlib')
+        self._check(fnProb)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import hashlib
+import tempfile
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from os.path import exists
+from tardis.weights import WeightsCache, WeightsError
+
+MODEL = 'fnet_attn_32/membrane_3d'
+WEIGHTS = {'V_1': b'old weights' * 1000, 'V_2': b'new weights' * 1000}
+
+
+class FakeBucket(BaseHTTPRequestHandler):
+    """Serves the listing of the versions of MODEL and their weights, counting the downloads."""
+    downloads = 0
+    corrupted = False
+
+    def do_GET(self):
+        if self.path.startswith('/?'):
+            keys = ''.join(f'<Contents><Key>tardis_em/{MODEL}/{version}/model_weights.pth</Key></Contents>'
+                           for version in WEIGHTS)
+            self._reply(f'<ListBucketResult>{keys}</ListBucketResult>'.encode())
+        else:
+            version = self.path.split('/')[-2]
+            data = WEIGHTS[version]
+            FakeBucket.downloads += 1
+            etag = hashlib.md5(data).hexdigest()
+            self._reply(data[:-1] + b'x' if self.corrupted else data, etag)
+
+    def _reply(self, data, etag=None):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        if etag:
+            self.send_header('ETag', f'"{etag}"')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWeightsCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), FakeBucket)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.cache = WeightsCache(self.tmpDir.name, self.url)
+        FakeBucket.downloads = 0
+        FakeBucket.corrupted = False
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def testFetch(self):
+        self.assertFalse(self.cache.isReady(MODEL))
+        fn = self.cache.fetch(MODEL)
+        with open(fn, 'rb') as f:
+            self.assertEqual(f.read(), WEIGHTS['V_2'])  # The latest version
+        self.assertEqual(self.cache.getRecord(MODEL)['version'], 'V_2')
+        self.assertTrue(self.cache.isReady(MODEL, checksum=True))
+        # Already in the cache
+        self.cache.fetch(MODEL)
+        self.assertEqual(FakeBucket.downloads, 1)
+        # Modified after being fetched
+        with open(fn, 'r+b') as f:
+            f.write(b'x')
+        self.assertFalse(self.cache.isReady(MODEL, checksum=True))
+        self.cache.fetch(MODEL)
+        self.assertEqual(FakeBucket.downloads, 2)
+        self.assertTrue(self.cache.isReady(MODEL, checksum=True))
+
+    def testConcurrentFetches(self):
+        threads = [threading.Thread(target=self.cache.fetch, args=(MODEL,)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(FakeBucket.downloads, 1)
+        self.assertTrue(self.cache.isReady(MODEL, checksum=True))
+
+    def testCorrupted(self):
+        FakeBucket.corrupted = True
+        with self.assertRaises(WeightsError):
+            self.cache.fetch(MODEL)
+        self.assertFalse(exists(self.cache.getWeightsFile(MODEL)))
+        self.assertIsNone(self.cache.getRecord(MODEL))
+
+    def testOffline(self):
+        fn = self.cache.fetch(MODEL)
+        offlineCache = WeightsCache(self.tmpDir.name, 'http://127.0.0.1:1/')
+        self.assertEqual(offlineCache.fetch(MODEL), fn)
+        with self.assertRaises(WeightsError):
+            WeightsCache(tempfile.mkdtemp(dir=self.tmpDir.name), 'http://127.0.0.1:1/').fetch(MODEL)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from os.path import join, dirname, exists
+from unittest import mock
+import tardis
+from tardis import Plugin
+from tardis.worker import TardisWorker, TardisWorkerError
+
+SCRIPTS_DIR = join(dirname(tardis.__file__), 'scripts')
+# Stand-in for a Tardis command module: its main builds a GeneralPredictor, as the Tardis scripts do
+FAKE_TARDIS = '''
+import os
+
+nBuilt = 0
+
+
+class GeneralPredictor:
+
+    def __init__(self, dir_s, correct_px, cnn_threshold):
+        global nBuilt
+        nBuilt += 1
+        self.dir, self.correct_px, self.cnn_threshold = dir_s, correct_px, cnn_threshold
+        self.transformation, self.px, self.image = [0, 0, 0], None, None
+        self.eta_predict, self.segments, self.segments_filter = 'NA', None, None
+        self.create_headers()
+
+    def create_headers(self):
+        self.log_prediction = ['header']
+
+    def __call__(self):
+        self.log_prediction.append(os.path.basename(self.dir))
+        with open('prediction_log.txt', 'w') as f:
+            f.write(' '.join(self.log_prediction))
+
+
+class _Main:
+    def main(self, args, prog_name, standalone_mode):
+        if '--fail' in args:
+            raise RuntimeError('CUDA out of memory')
+        predictor = GeneralPredictor(dir_s=os.getcwd(), correct_px=float(args[1]), cnn_threshold=float(args[3]))
+        predictor()
+        print(f'{prog_name} built {nBuilt}')
+
+
+main = _Main()
+'''
+WORKER_LAUNCHER = '''
+import sys
+sys.path[:0] = [%r, %r]
+import tardis_worker
+tardis_worker.PROGRAMS['tardis_fake'] = 'fake_tardis'
+sys.exit(tardis_worker.main())
+'''
+
+
+def loadWorkerScript():
+    spec = importlib.util.spec_from_file_location('tardis_worker', join(SCRIPTS_DIR, 'tardis_worker.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakePredictor:
+    nBuilt = 0
+
+    def __init__(self, dir_s, correct_px, cnn_threshold):
+        FakePredictor.nBuilt += 1
+        self.dir, self.correct_px, self.cnn_threshold = dir_s, correct_px, cnn_threshold
+        self.transformation, self.px, self.image = [0, 0, 0], None, None
+        self.eta_predict, self.segments, self.segments_filter = 'NA', None, None
+        self.create_headers()
+
+    def create_headers(self):
+        self.log_prediction = self.log_prediction if hasattr(self, 'log_prediction') else []
+        self.log_prediction.append('header')
+
+
+class TestCachedPredictor(unittest.TestCase):
+
+    def setUp(self):
+        self.script = loadWorkerScript()
+        FakePredictor.nBuilt = 0
+
+    def testReuse(self):
+        cached = self.script.CachedPredictor(FakePredictor)
+        predictor = cached(dir_s='tomo1', correct_px=10, cnn_threshold=0.5)
+        predictor.transformation, predictor.px, predictor.segments = [1, 2, 3], 10, [[0, 1, 2, 3]]
+        predictor.log_prediction.append('tomo1 segmented')
+        # Only the per-job arguments change: same predictor, with the state of the previous tomogram reset
+        self.assertIs(cached(dir_s='tomo2', correct_px=20, cnn_threshold=0.5), predictor)
+        self.assertEqual(FakePredictor.nBuilt, 1)
+        self.assertEqual((predictor.dir, predictor.correct_px), ('tomo2', 20))
+        self.assertEqual((predictor.transformation, predictor.px, predictor.segments), ([0, 0, 0], None, None))
+        self.assertEqual(predictor.log_prediction, ['header'])
+        # The reset state is not shared between tomograms
+        predictor.transformation[0] = 5
+        cached(dir_s='tomo3', correct_px=20, cnn_threshold=0.5)
+        self.assertEqual(predictor.transformation, [0, 0, 0])
+        # Another configuration builds another predictor
+        self.assertIsNot(cached(dir_s='tomo4', correct_px=20, cnn_threshold=0.25), predictor)
+        self.assertEqual(FakePredictor.nBuilt, 2)
+
+    def testUnknownState(self):
+        # E. g. another Tardis version, without some of the attributes reset between tomograms
+        cached = self.script.CachedPredictor(FakePredictor)
+        predictor = cached(dir_s='tomo1', correct_px=10, cnn_threshold=0.5)
+        del predictor.log_prediction
+        self.assertIsNot(cached(dir_s='tomo2', correct_px=10, cnn_threshold=0.5), predictor)
+        self.assertEqual(FakePredictor.nBuilt, 2)
+
+
+class TestTardisWorker(unittest.TestCase):
+    """The worker script is run with a stand-in Tardis command, tardis_fake."""
+
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        with open(join(self.tmpDir.name, 'fake_tardis.py'), 'w') as f:
+            f.write(FAKE_TARDIS)
+        self.launcher = join(self.tmpDir.name, 'launcher.py')
+        with open(self.launcher, 'w') as f:
+            f.write(WORKER_LAUNCHER % (SCRIPTS_DIR, self.tmpDir.name))
+        patcher = mock.patch.object(Plugin, 'startTardisWorker', self._startWorker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def _startWorker(self, address, gpuId, logFile, env=None):
+        with open(logFile, 'a') as log:
+            return subprocess.Popen([sys.executable, self.launcher, '--address', address], stdout=log,
+                                    stderr=subprocess.STDOUT, env=env)
+
+    def _makeTomoDir(self, name: str) -> str:
+        tomoDir = join(self.tmpDir.name, name)
+        os.makedirs(tomoDir)
+        return tomoDir
+
+    def _read(self, fn: str) -> str:
+        with open(fn) as f:
+            return f.read()
+
+    def testJobs(self):
+        worker = TardisWorker('', join(self.tmpDir.name, 'worker.log'))
+        worker.start()
+        try:
+            self.assertTrue(worker.isAlive())
+            for name, cnnThreshold, nBuilt in [('tomo1', 0.5, 1), ('tomo2', 0.5, 1), ('tomo3', 0.25, 2)]:
+                tomoDir = self._makeTomoDir(name)
+                logFile = join(tomoDir, 'tardis.log')
+                worker.submit('tardis_fake', f'--correct_px 10 --cnn_threshold {cnnThreshold}', tomoDir, logFile)
+                self.assertEqual(self._read(logFile).strip(), f'tardis_fake built {nBuilt}')
+                # The prediction log of each tomogram only has its own entries
+                self.assertEqual(self._read(join(tomoDir, 'prediction_log.txt')), f'header {name}')
+            # A failed job is reported with its output, and the worker keeps serving jobs
+            tomoDir = self._makeTomoDir('tomo4')
+            with self.assertRaises(TardisWorkerError):
+                worker.submit('tardis_fake', '--fail', tomoDir, join(tomoDir, 'tardis.log'))
+            self.assertIn('CUDA out of memory', self._read(join(tomoDir, 'tardis.log')))
+            self.assertTrue(worker.isAlive())
+        finally:
+            worker.stop()
+        self.assertFalse(worker.isAlive())
+        self.assertFalse(exists(worker.address))
+        with self.assertRaises(TardisWorkerError):
+            worker.submit('tardis_fake', '--correct_px 10 --cnn_threshold 0.5', self.tmpDir.name,
+                          join(self.tmpDir.name, 'tardis.log'))
+
+    def testWorkerExits(self):
+        with open(self.launcher, 'w') as f:
+            f.write('import sys\nsys.exit(3)\n')
+        worker = TardisWorker('', join(self.tmpDir.name, 'worker.log'))
+        with self.assertRaises(TardisWorkerError):
+            worker.start()
+        worker.stop()
@@ -0,0 +1,560 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import os
+from itertools import repeat
+from typing import Tuple, Union
+import mrcfile
+import numpy as np
+import tifffile
+from tomo.constants import BOTTOM_LEFT_CORNER, SCIPION
+from tomo.objects import SetOfMeshes, MeshPoint, Tomogram, Coordinate3D
+
+logger = logging.getLogger(__name__)
+
+# Number of mesh points inserted at once and between two consecutive commits of the meshes sqlite
+MESH_POINTS_COMMIT_BATCH = 200000
+# Number of slices read and written at once when compacting a mask
+MASK_CHUNK_SLICES = 32
+# Messages of CUDA and torch that identify an execution that ran out of GPU memory
+OOM_PATTERNS = ('CUDA out of memory', 'CUDA error: out of memory', 'OutOfMemoryError', 'CUBLAS_STATUS_ALLOC_FAILED')
+# Region of a tomogram: ((x0, x1), (y0, y1), (z0, z1)) in pixels, ends excluded
+Roi = Tuple[Tuple[int, int], Tuple[int, int], Tuple[int, int]]
+# MRC modes Tardis reads: 8-bit and 16-bit integers, float32 and float16
+TARDIS_MRC_MODES = (0, 1, 2, 6, 12)
+
+
+def readInstancesCsv(fnCsv: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Reads a Tardis instances CSV file in a single vectorized pass. Lines are
+    [groupId, x, y, z], with the coordinates in angstroms.
+
+    :param fnCsv: path of the CSV file generated by Tardis.
+    :return: an array of N group ids and an (N, 3) array with the coordinates.
+    """
+    data = np.loadtxt(fnCsv, delimiter=',', skiprows=1, usecols=(0, 1, 2, 3), ndmin=2)  # Skip the header row
+    if data.size == 0:
+        return np.empty(0, dtype=int), np.empty((0, 3), dtype=float)
+    return data[:, 0].astype(int), data[:, 1:4]
+
+
+def toScipionCoords(tomo: Tomogram, coords: np.ndarray, originFunction=BOTTOM_LEFT_CORNER) -> np.ndarray:
+    """Refers a block of coordinates, all of them belonging to the same tomogram, to the Scipion convention,
+    applying the same shift Coordinate3D.setPosition would apply to each of them. That shift only depends on
+    the tomogram, so it is computed once.
+
+    :param tomo: tomogram the coordinates belong to.
+    :param coords: (N, 3) array with the coordinates in pixels.
+    :param originFunction: convention the coordinates are referred to.
+    """
+    return coords + getScipionShifts(tomo, originFunction)
+
+
+def getScipionShifts(tomo: Tomogram, originFunction=BOTTOM_LEFT_CORNER) -> np.ndarray:
+    """Returns the (x, y, z) shift that refers the coordinates of a tomogram, in pixels, to the Scipion
+    convention, the same one Coordinate3D.setPosition would apply to each of them: the Scipion position of
+    the origin."""
+    point = MeshPoint()
+    point.setVolume(tomo)
+    point.setPosition(0, 0, 0, originFunction)
+    return np.array(point.getPosition(SCIPION), dtype=float)
+
+
+def appendMeshPoints(mesh: SetOfMeshes, tomo: Tomogram, groupIds: Union[list, np.ndarray],
+                     coords: Union[list, np.ndarray]) -> int:
+    """Appends a block of points, all of them belonging to the same tomogram, to a set of meshes.
+    The first point is appended as usual, which creates the tables of the set if needed, and the
+    rest of them are inserted at once (see _insertMeshPointRows), re-using the values of the first
+    one for the columns shared by all the points. The rows stored are the same as the ones appending
+    a MeshPoint per point would store, which is what is done if they can't be inserted at once.
+
+    :param mesh: set of meshes in which the points will be appended.
+    :param tomo: tomogram the points belong to.
+    :param groupIds: N group ids.
+    :param coords: N [x, y, z] coordinates, in pixels and referred to the Scipion convention
+        (see toScipionCoords).
+    :return: the number of points appended.
+    """
+    groupIds = np.asarray(groupIds).reshape(-1)
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    nPoints = len(groupIds)
+    if nPoints == 0:
+        return 0
+    point = _newMeshPoint(tomo, groupIds[0], coords[0])
+    mesh.append(point)
+    if nPoints == 1:
+        return 1
+    # The same conversions Integer.set and Float.set apply to each value
+    pointValues = {Coordinate3D.GROUP_ID_ATTR: groupIds[1:].astype(int).tolist(),
+                   '_x': coords[1:, 0].tolist(),
+                   '_y': coords[1:, 1].tolist(),
+                   '_z': coords[1:, 2].tolist()}
+    if not _insertMeshPointRows(mesh, point, pointValues, nPoints - 1):
+        logger.warning('The mesh points can not be inserted at once with this version of pyworkflow, '
+                       'appending them one by one')
+        for groupId, xyz in zip(groupIds[1:], coords[1:]):
+            mesh.append(_newMeshPoint(tomo, groupId, xyz))
+    return nPoints
+
+
+def _newMeshPoint(tomo: Tomogram, groupId: int, xyz: np.ndarray) -> MeshPoint:
+    point = MeshPoint()
+    point.setVolume(tomo)
+    point.setGroupId(int(groupId))
+    point.setPosition(*xyz.tolist(), SCIPION)
+    return point
+
+
+def _insertMeshPointRows(mesh: SetOfMeshes, point: MeshPoint, pointValues: dict, nPoints: int) -> bool:
+    """Inserts the rows of nPoints mesh points with a single executemany, after the one of point, the last
+    item appended to the set, and updates the id counter and the size of the set as Set.append does for
+    each item. The columns not in pointValues (attribute name -> values of the points) take the values of
+    point.
+
+    It relies on internals of pyworkflow: the mapper of the set (_getMapper, _getValuesFromObject and the
+    INSERT_OBJECT command and cursor of its db) and the _idCount and _size attributes of the set. They are
+    checked first, as well as the columns of the insert command, and if anything is not as expected nothing
+    is inserted and False is returned, so the caller can append the points one by one. The rows must be the
+    same as the ones Set.append stores, which TestInstances.testAppendMeshPoints (tests_utils) checks.
+
+    :return: if the rows were inserted.
+    """
+    getMapper = getattr(mesh, '_getMapper', None)
+    mapper = getMapper() if callable(getMapper) else None
+    db = getattr(mapper, 'db', None)
+    insertCmd = getattr(db, 'INSERT_OBJECT', None)
+    if (not callable(getattr(mapper, '_getValuesFromObject', None)) or
+            not isinstance(insertCmd, str) or
+            not callable(getattr(getattr(db, 'cursor', None), 'executemany', None)) or
+            not isinstance(getattr(mesh, '_idCount', None), int) or
+            not callable(getattr(getattr(mesh, '_size', None), 'sum', None))):
+        return False
+    values = mapper._getValuesFromObject(point)
+    # The id, enabled, label and comment columns, followed by the ones of the attributes
+    if insertCmd.count('?') != 4 + len(values) or not set(pointValues).issubset(values):
+        return False
+    firstId = point.getObjId() + 1
+    columns = [range(firstId, firstId + nPoints),
+               repeat(point.isEnabled()), repeat(point.getObjLabel()), repeat(point.getObjComment())]
+    columns.extend(pointValues.get(key, repeat(value)) for key, value in values.items())
+    db.cursor.executemany(insertCmd, zip(*columns))
+    mesh._idCount = max(mesh._idCount, firstId + nPoints - 1)
+    mesh._size.sum(nPoints)
+    return True
+
+
+def appendPointsToMeshes(mesh: SetOfMeshes, tomo: Tomogram, points: np.ndarray) -> int:
+    """Appends the points of a tomogram, as returned by tardis.points.loadPoints, to a set of meshes
+    (see appendMeshPoints). They are converted and appended in blocks of MESH_POINTS_COMMIT_BATCH
+    points, so a memory-mapped file is never loaded completely in memory.
+
+    :return: the number of points appended.
+    """
+    nPoints = len(points)
+    for start in range(0, nPoints, MESH_POINTS_COMMIT_BATCH):
+        block = points[start:start + MESH_POINTS_COMMIT_BATCH]
+        appendMeshPoints(mesh, tomo, block['groupId'], block['coords'])
+        if start + MESH_POINTS_COMMIT_BATCH < nPoints:
+            mesh.write(properties=False)
+    return nPoints
+
+
+def getMrcDims(fnMrc: str) -> Tuple[int, int, int]:
+    """Returns the dimensions (x, y, z) of an MRC file, reading only its header."""
+    with mrcfile.open(fnMrc, header_only=True, permissive=True) as mrc:
+        return int(mrc.header.nx), int(mrc.header.ny), int(mrc.header.nz)
+
+
+def estimateTardisMemory(dims: Tuple[int, int, int], samplingRate: float, tardisPx: float) -> float:
+    """Estimates the memory, in GB, required by Tardis to segment a tomogram. Tardis loads the
+    tomogram and normalizes it, keeping two float32 copies, and then rescales it to the pixel size
+    its models were trained at (tardisPx), on which it keeps the image, the stitched probability map
+    and the mask.
+
+    :param dims: dimensions (x, y, z) of the tomogram.
+    :param samplingRate: sampling rate of the tomogram (Å/px).
+    :param tardisPx: pixel size at which Tardis segments the tomogram (Å/px).
+    """
+    nVoxels = float(np.prod(dims))
+    nScaledVoxels = nVoxels * (samplingRate / tardisPx) ** 3
+    return (2 * 4 * nVoxels + 3 * 4 * nScaledVoxels) / 1024 ** 3
+
+
+def getBinningFactor(dims: Tuple[int, int, int], samplingRate: float, tardisPx: float, maxMemory: float) -> int:
+    """Returns the lowest integer binning factor that makes the segmentation of a tomogram fit in maxMemory
+    GB. Tardis rescales the tomograms to tardisPx anyway, so the factor is capped to not go beyond that
+    pixel size, as further binning would only remove information. 1 means no binning.
+
+    :param dims: dimensions (x, y, z) of the tomogram.
+    :param samplingRate: sampling rate of the tomogram (Å/px).
+    :param tardisPx: pixel size at which Tardis segments the tomogram (Å/px).
+    :param maxMemory: memory available for a Tardis execution, in GB.
+    """
+    maxFactor = max(1, int(tardisPx // samplingRate))
+    for factor in range(1, maxFactor + 1):
+        binnedDims = tuple(dim // factor for dim in dims)
+        if estimateTardisMemory(binnedDims, samplingRate * factor, tardisPx) <= maxMemory:
+            return factor
+    return maxFactor
+
+
+def binMrc(fnIn: str, fnOut: str, factor: int, chunkSlices: int = MASK_CHUNK_SLICES):
+    """Bins a volume by an integer factor, averaging each block of factor^3 voxels. Both files are
+    memory-mapped and chunkSlices output slices are computed at once, so the volume is never loaded
+    completely in memory. The dimensions that are not multiple of the factor are cropped at the end, so
+    the origin of both volumes is the same. The output is float32 and its voxel size is multiplied by
+    the factor.
+    """
+    with mrcfile.mmap(fnIn, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        outShape = tuple(dim // factor for dim in data.shape)
+        nz, ny, nx = outShape
+        with mrcfile.new_mmap(fnOut, shape=outShape, mrc_mode=2, overwrite=True) as mrcOut:
+            stats = _ChunkStats()
+            for start in range(0, nz, chunkSlices):
+                k = min(chunkSlices, nz - start)
+                block = data[start * factor:(start + k) * factor, :ny * factor, :nx * factor].astype(np.float32)
+                binned = block.reshape(k, factor, ny, factor, nx, factor).mean(axis=(1, 3, 5))
+                mrcOut.data[start:start + k] = binned
+                stats.update(binned)
+            voxelSize = mrcIn.voxel_size
+            mrcOut.voxel_size = (voxelSize.x * factor, voxelSize.y * factor, voxelSize.z * factor)
+            stats.setHeader(mrcOut.header)
+
+
+def getConversionReason(fnMrc: str, index: int = 0) -> Union[str, None]:
+    """Tells if a tomogram has to be converted before being segmented by Tardis, reading only its
+    header. Tardis reads the MRC files as plain arrays located at the end of the file, so the tomograms
+    with other formats or modes, the volumes of a stack and the files with trailing data can't be linked.
+
+    :param fnMrc: path of the tomogram file.
+    :param index: position of the tomogram in a volume stack, starting from 1 (0 if it is not a stack).
+    :return: the reason why the tomogram must be converted, or None if it can be linked.
+    """
+    try:
+        with mrcfile.open(fnMrc, header_only=True, permissive=True) as mrc:
+            header = mrc.header
+            if header.map != mrcfile.constants.MAP_ID:
+                return 'not an MRC file'
+            mode = int(header.mode)
+            itemSize = np.dtype(mrcfile.utils.dtype_from_mode(mode)).itemsize
+            nVoxels = int(header.nx) * int(header.ny) * int(header.nz)
+            dataOffset = header.nbytes + int(header.nsymbt)
+            isVolumeStack = int(header.ispg) >= 401
+    except (OSError, ValueError) as e:
+        return f'not an MRC file ({e})'
+    if isVolumeStack or index > 1:
+        return 'volume stack'
+    if mode not in TARDIS_MRC_MODES:
+        return f'MRC mode {mode}'
+    if os.path.getsize(fnMrc) != dataOffset + nVoxels * itemSize:
+        return 'unexpected file size'
+    return None
+
+
+def convertMrc(fnIn: str, fnOut: str, index: int = 0, roi: Roi = None, chunkSlices: int = MASK_CHUNK_SLICES):
+    """Writes a tomogram as a plain MRC file Tardis can read, e. g. a volume of a stack, an MRC file with
+    a mode Tardis does not support or a region of the tomogram. Both files are memory-mapped and processed
+    in chunks of chunkSlices slices, so the volume is never loaded completely in memory. The data is kept
+    as is if its mode is supported by Tardis and converted to float32 otherwise. The voxel size and the
+    origin are preserved. The output is written in a temporary file and renamed at the end, so it is never
+    left incomplete, and fnOut may be fnIn.
+
+    :param fnIn: path of the input MRC file.
+    :param fnOut: path of the output MRC file.
+    :param index: position of the tomogram in a volume stack, starting from 1 (0 if it is not a stack).
+    :param roi: region to extract, as ((x0, x1), (y0, y1), (z0, z1)) in pixels, ends excluded.
+    :param chunkSlices: number of slices processed at once.
+    """
+    fnTmp = f'{fnOut}.tmp'
+    with mrcfile.mmap(fnIn, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        if data.ndim == 4:  # Volume stack
+            data = data[max(index, 1) - 1]
+        if roi is not None:  # A view of the memory-mapped file, nothing is read yet
+            (x0, x1), (y0, y1), (z0, z1) = roi
+            data = data[z0:z1, y0:y1, x0:x1]
+        mrcMode = int(mrcIn.header.mode)
+        outMode = mrcMode if mrcMode in TARDIS_MRC_MODES else 2
+        outDtype = mrcfile.utils.dtype_from_mode(outMode)
+        with mrcfile.new_mmap(fnTmp, shape=data.shape, mrc_mode=outMode, overwrite=True) as mrcOut:
+            stats = _ChunkStats()
+            for start in range(0, data.shape[0], chunkSlices):
+                chunk = np.asarray(data[start:start + chunkSlices], dtype=outDtype)
+                mrcOut.data[start:start + chunkSlices] = chunk
+                stats.update(chunk)
+            mrcOut.voxel_size = mrcIn.voxel_size
+            mrcOut.header.origin = mrcIn.header.origin
+            stats.setHeader(mrcOut.header)
+    os.replace(fnTmp, fnOut)
+
+
+def padMrc(fnMrc: str, dims: Tuple[int, int, int], roi: Roi, chunkSlices: int = MASK_CHUNK_SLICES):
+    """Places a volume obtained from a region of a tomogram, e. g. a mask, back in the full tomogram,
+    in place. The voxels out of the region are set to 0. The volume is processed in chunks of chunkSlices
+    slices through memory-mapped files.
+
+    :param fnMrc: path of the MRC file.
+    :param dims: dimensions (x, y, z) of the full tomogram.
+    :param roi: region the volume comes from, as ((x0, x1), (y0, y1), (z0, z1)) in pixels, ends excluded.
+    :param chunkSlices: number of slices processed at once.
+    """
+    fnTmp = f'{fnMrc}.tmp'
+    outShape = tuple(reversed(dims))
+    (x0, x1), (y0, y1), (z0, z1) = roi
+    with mrcfile.mmap(fnMrc, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        with mrcfile.new_mmap(fnTmp, shape=outShape, mrc_mode=int(mrcIn.header.mode), overwrite=True) as mrcOut:
+            stats = _ChunkStats()
+            for start in range(0, outShape[0], chunkSlices):
+                end = min(start + chunkSlices, outShape[0])
+                chunk = np.zeros((end - start,) + outShape[1:], dtype=data.dtype)
+                first, last = max(start, z0), min(end, z1)
+                if first < last:
+                    chunk[first - start:last - start, y0:y1, x0:x1] = data[first - z0:last - z0]
+                mrcOut.data[start:end] = chunk
+                stats.update(chunk)
+            mrcOut.voxel_size = mrcIn.voxel_size
+            mrcOut.header.origin = mrcIn.header.origin
+            stats.setHeader(mrcOut.header)
+    os.replace(fnTmp, fnMrc)
+
+
+def getMaskBoundingBox(fnMask: str, chunkSlices: int = MASK_CHUNK_SLICES) -> Union[Roi, None]:
+    """Returns the bounding box of the non-zero voxels of a mask, as ((x0, x1), (y0, y1), (z0, z1)) in
+    pixels, ends excluded, or None if the mask is empty. The mask is read in chunks of chunkSlices slices."""
+    with mrcfile.mmap(fnMask, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        zs, ys, xs = [], [], []
+        for start in range(0, data.shape[0], chunkSlices):
+            nonZero = data[start:start + chunkSlices] != 0
+            z = np.flatnonzero(nonZero.any(axis=(1, 2)))
+            if len(z):
+                zs.extend((start + z[0], start + z[-1]))
+                ys.append(np.flatnonzero(nonZero.any(axis=(0, 2)))[[0, -1]])
+                xs.append(np.flatnonzero(nonZero.any(axis=(0, 1)))[[0, -1]])
+    if not zs:
+        return None
+    return tuple((int(np.min(values)), int(np.max(values)) + 1) for values in (xs, ys, zs))
+
+
+def upscaleMrc(fnMrc: str, factor: int, dims: Tuple[int, int, int], chunkSlices: int = MASK_CHUNK_SLICES):
+    """Upscales a volume, e. g. a mask obtained from a binned tomogram, by an integer factor, in place.
+    Each voxel is repeated factor times along each axis (nearest neighbour, so the values of a mask are
+    kept) and the result is padded with zeros up to dims, undoing the cropping done by binMrc. The
+    volume is processed in chunks of chunkSlices input slices through memory-mapped files.
+
+    :param fnMrc: path of the MRC file.
+    :param factor: upscaling factor.
+    :param dims: dimensions (x, y, z) of the upscaled volume.
+    :param chunkSlices: number of slices processed at once.
+    """
+    fnTmp = f'{fnMrc}.tmp'
+    outShape = tuple(reversed(dims))
+    with mrcfile.mmap(fnMrc, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        mrcMode = int(mrcIn.header.mode)
+        with mrcfile.new_mmap(fnTmp, shape=outShape, mrc_mode=mrcMode, overwrite=True) as mrcOut:
+            stats = _ChunkStats()
+            upscaledSlices = 0
+            for start in range(0, data.shape[0], chunkSlices):
+                block = data[start:start + chunkSlices]
+                for axis in range(3):
+                    block = np.repeat(block, factor, axis=axis)
+                block = block[:outShape[0] - upscaledSlices, :outShape[1], :outShape[2]]
+                chunk = np.zeros((block.shape[0],) + outShape[1:], dtype=data.dtype)
+                chunk[:, :block.shape[1], :block.shape[2]] = block
+                mrcOut.data[upscaledSlices:upscaledSlices + chunk.shape[0]] = chunk
+                upscaledSlices += chunk.shape[0]
+                stats.update(chunk)
+            for start in range(upscaledSlices, outShape[0], chunkSlices):  # Padding slices
+                chunk = np.zeros((min(chunkSlices, outShape[0] - start),) + outShape[1:], dtype=data.dtype)
+                mrcOut.data[start:start + chunk.shape[0]] = chunk
+                stats.update(chunk)
+            voxelSize = mrcIn.voxel_size
+            mrcOut.voxel_size = (voxelSize.x / factor, voxelSize.y / factor, voxelSize.z / factor)
+            mrcOut.header.origin = mrcIn.header.origin
+            stats.setHeader(mrcOut.header)
+    os.replace(fnTmp, fnMrc)
+
+
+def compactMask(fnMask: str, chunkSlices: int = MASK_CHUNK_SLICES) -> bool:
+    """Re-writes a mask MRC file as 8-bit integers (MRC mode 0, signed), in place. Both files are memory-mapped and
+    processed in chunks of chunkSlices slices, so the volume is never loaded completely in memory.
+    The voxel size and the origin are preserved. The file is left untouched if it is already 8-bit
+    or if any of its values can't be represented as int8 without loss.
+
+    :param fnMask: path of the MRC file of the mask.
+    :param chunkSlices: number of slices processed at once.
+    :return: True if the file was compacted.
+    """
+    fnTmp = f'{fnMask}.tmp'
+    with mrcfile.mmap(fnMask, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        if data.dtype in (np.int8, np.uint8):
+            return False
+        try:
+            with mrcfile.new_mmap(fnTmp, shape=data.shape, mrc_mode=0, overwrite=True) as mrcOut:
+                stats = _ChunkStats()
+                for start in range(0, data.shape[0], chunkSlices):
+                    chunk = data[start:start + chunkSlices]
+                    compactChunk = chunk.astype(np.int8)
+                    if not np.array_equal(chunk, compactChunk):
+                        raise ValueError('the mask has values out of the int8 range')
+                    mrcOut.data[start:start + chunkSlices] = compactChunk
+                    stats.update(compactChunk)
+                mrcOut.voxel_size = mrcIn.voxel_size
+                mrcOut.header.origin = mrcIn.header.origin
+                stats.setHeader(mrcOut.header)
+        except ValueError as e:
+            logger.warning(f'{fnMask} was not compacted -> {e}')
+            os.remove(fnTmp)
+            return False
+    os.replace(fnTmp, fnMask)
+    return True
+
+
+class _ChunkStats:
+    """Accumulates the statistics of the MRC header chunk by chunk, as computing them at once
+    would load the whole volume."""
+
+    def __init__(self):
+        self.min, self.max = np.inf, -np.inf
+        self.sum, self.sqSum, self.n = 0., 0., 0
+
+    def update(self, chunk: np.ndarray):
+        if chunk.size == 0:
+            return
+        self.min = min(self.min, float(chunk.min()))
+        self.max = max(self.max, float(chunk.max()))
+        self.sum += float(chunk.sum(dtype=np.float64))
+        self.sqSum += float(np.square(chunk, dtype=np.float64).sum())
+        self.n += chunk.size
+
+    def setHeader(self, header):
+        if self.n == 0:
+            return
+        mean = self.sum / self.n
+        header.dmin, header.dmax, header.dmean = self.min, self.max, mean
+        header.rms = np.sqrt(max(self.sqSum / self.n - mean ** 2, 0))
+
+
+def thresholdProbabilityMap(fnProb: str, fnMask: str, threshold: float, voxelSize: float,
+                            chunkSlices: int = MASK_CHUNK_SLICES):
+    """Writes the semantic mask obtained from a probability map saved by Tardis (a float32 TIFF file, written
+    when it is executed with a CNN threshold of 0) as Tardis does: the voxels whose probability is greater than
+    or equal to the threshold are set to 1. The probability map is memory-mapped, if possible, and processed in
+    chunks of chunkSlices slices. The mask is stored as 8-bit integers (MRC mode 0).
+
+    :param fnProb: path of the TIFF file of the probability map.
+    :param fnMask: path of the MRC file of the mask.
+    :param threshold: CNN threshold, between 0 and 1.
+    :param voxelSize: voxel size of the mask (Å/px).
+    :param chunkSlices: number of slices processed at once.
+    """
+    fnTmp = f'{fnMask}.tmp'
+    try:
+        data = tifffile.memmap(fnProb, mode='r')
+    except ValueError:  # Not memory-mappable, e. g. compressed
+        data = tifffile.imread(fnProb)
+    with mrcfile.new_mmap(fnTmp, shape=data.shape, mrc_mode=0, overwrite=True) as mrcOut:
+        stats = _ChunkStats()
+        for start in range(0, data.shape[0], chunkSlices):
+            chunk = (data[start:start + chunkSlices] >= threshold).astype(np.int8)
+            mrcOut.data[start:start + chunkSlices] = chunk
+            stats.update(chunk)
+        mrcOut.voxel_size = voxelSize
+        stats.setHeader(mrcOut.header)
+    del data
+    os.replace(fnTmp, fnMask)
+
+
+def prepareSemanticMask(fnMask: str, binFactor: int = 1, binnedDims: Tuple[int, int, int] = None,
+                        dims: Tuple[int, int, int] = None, roi: Roi = None, compact: bool = False) -> bool:
+    """Takes a semantic mask generated by Tardis back to the tomogram it was segmented from, in place:
+    upscales it if the tomogram was binned (see upscaleMrc), places it back in the whole tomogram if only
+    a region of interest was segmented (see padMrc) and, with compact, stores it as 8-bit (see
+    compactMask). It only depends on files, so it can be run in a process pool.
+
+    :param fnMask: path of the mask.
+    :param binFactor: factor by which the tomogram was binned.
+    :param binnedDims: dimensions of the tomogram before binning, or of its region of interest.
+    :param dims: dimensions of the whole tomogram.
+    :param roi: region of interest segmented, if any.
+    :param compact: whether to store the mask as 8-bit.
+    :return: whether the mask was stored as 8-bit.
+    """
+    if binFactor > 1:
+        upscaleMrc(fnMask, binFactor, binnedDims)
+    if roi is not None:
+        padMrc(fnMask, dims, roi)
+    return compact and compactMask(fnMask)
+
+
+def prepareInstances(fnCsv: str, fnPoints: str, fnIndex: str, samplingRate: float, binFactor: int = 1,
+                     shifts: Tuple[float, float, float] = (0, 0, 0), precise: bool = False) -> Tuple[int, int]:
+    """Reads the instances generated by Tardis, refers their coordinates to the tomogram they were
+    segmented from and writes them in a points file (see tardis.points.savePoints) and its spatial index
+    (see tardis.spatial.PointsIndex). It only depends on files, so it can be run in a process pool.
+
+    :param fnCsv: path of the instances CSV file, with the coordinates in angstroms.
+    :param fnPoints: path of the .npy file the points are written to.
+    :param fnIndex: path of the spatial index of the points.
+    :param samplingRate: sampling rate of the tomogram (Å/px).
+    :param binFactor: factor by which the tomogram was binned.
+    :param shifts: (x, y, z) shift added to the coordinates in pixels, e. g. the origin of the region of
+        interest segmented and the one of the Scipion convention (see getScipionShifts).
+    :param precise: if True, the coordinates are written in double precision, e. g. to append them to a set
+        of meshes (see tardis.points.PRECISE_POINTS_DTYPE).
+    :return: the number of points and the number of instances.
+    """
+    from tardis.points import savePoints
+    from tardis.spatial import PointsIndex
+    groupIds, coords = readInstancesCsv(fnCsv)
+    coords = coords / samplingRate
+    if binFactor > 1:
+        # The coordinates in angstroms are already at the original scale, they only need to be moved
+        # from the first to the center of the voxels each binned voxel comes from
+        coords += (binFactor - 1) / 2
+    coords += shifts
+    PointsIndex.build(groupIds, coords).save(fnIndex)
+    return savePoints(fnPoints, groupIds, coords, precise=precise), len(np.unique(groupIds))
+
+
+def isOutOfMemoryError(logFile: str, logOffset: int = 0, errorMsg: str = '') -> bool:
+    """Tells if a failed execution ran out of GPU memory, looking for the messages that identify it in the
+    error message and in the part of the log file written by the execution.
+
+    :param logFile: log file of the execution.
+    :param logOffset: size of the log file before the execution started.
+    :param errorMsg: message of the exception raised by the execution.
+    """
+    text = errorMsg
+    if os.path.exists(logFile):
+        with open(logFile, 'rb') as f:
+            f.seek(logOffset)
+            text += f.read().decode(errors='replace')
+    return any(pattern in text for pattern in OOM_PATTERNS)
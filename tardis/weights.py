@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from os.path import join, exists, getsize
+from typing import Dict, List, Union
+
+logger = logging.getLogger(__name__)
+
+# Bucket from which Tardis downloads its model weights (see tardis_em.utils.aws)
+WEIGHTS_URL = 'https://tardis-weigths.s3.dualstack.us-east-1.amazonaws.com/'
+WEIGHTS_PREFIX = 'tardis_em'
+WEIGHTS_FILE = 'model_weights.pth'
+RECORD_FILE = 'model_weights.json'
+LOCK_FILE = '.lock'
+DOWNLOAD_CHUNK_SIZE = 16 * 1024 * 1024  # Bytes
+DOWNLOAD_TIMEOUT = 60  # Seconds without receiving data
+VERSION_REGEX = re.compile(r'^V_(\d+)$')
+
+
+class WeightsError(Exception):
+    pass
+
+
+class WeightsCache:
+    """Cache of the Tardis model weights shared by all the users and runs, e.g. in the software
+    directory of Scipion. The weights are fetched once, when Tardis is installed, and the protocols
+    point Tardis at them instead of letting it download them to the home directory of each user on
+    the first execution, which fails on compute nodes without internet access.
+
+    Each model, named <network>_<subtype>/<dataset> as in the bucket (e.g. fnet_attn_32/membrane_3d),
+    has its own directory with the weights and a record of the version fetched and its checksum. The
+    downloads are serialized with a lock per model, so concurrent fetches of the same weights download
+    them only once, and a file is only recorded once its size and checksum have been verified."""
+
+    def __init__(self, cacheDir: str, url: str = WEIGHTS_URL):
+        """
+        :param cacheDir: directory in which the weights are stored.
+        :param url: URL of the bucket the weights are downloaded from.
+        """
+        self.cacheDir = cacheDir
+        self.url = url
+
+    def getWeightsFile(self, model: str) -> str:
+        return join(self.cacheDir, model, WEIGHTS_FILE)
+
+    def getRecord(self, model: str) -> Union[Dict, None]:
+        """Returns the record of the weights of a model: their version, size and sha256 checksum,
+        or None if they have not been fetched."""
+        fn = join(self.cacheDir, model, RECORD_FILE)
+        if not exists(fn):
+            return None
+        try:
+            with open(fn) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Unable to read the record of the weights {fn} -> {e}')
+            return None
+
+    def isReady(self, model: str, checksum: bool = False) -> bool:
+        """Tells if the weights of a model have been fetched and are still as they were recorded:
+        the same size or, with checksum, the same contents."""
+        record = self.getRecord(model)
+        fn = self.getWeightsFile(model)
+        if record is None or not exists(fn) or getsize(fn) != record['size']:
+            return False
+        return not checksum or computeChecksum(fn) == record['sha256']
+
+    def fetch(self, model: str) -> str:
+        """Downloads the latest version of the weights of a model, unless it is already in the cache,
+        and returns the weights file. If the bucket can't be reached, the weights in the cache, if any,
+        are kept."""
+        os.makedirs(join(self.cacheDir, model), exist_ok=True)
+        with self._locked(model):
+            record = self.getRecord(model)
+            try:
+                version = self._getLatestVersion(model)
+            except OSError as e:
+                if self.isReady(model, checksum=True):
+                    logger.warning(f'{model}: unable to check the latest version of the weights, keeping '
+                                   f'the ones in the cache ({record["version"]}) -> {e}')
+                    return self.getWeightsFile(model)
+                raise WeightsError(f'{model}: unable to list the versions of the weights -> {e}')
+            if record is not None and record['version'] == version and self.isReady(model, checksum=True):
+                logger.info(f'{model}: the weights ({version}) are already in the cache')
+            else:
+                self._download(model, version)
+        return self.getWeightsFile(model)
+
+    def _getLatestVersion(self, model: str) -> Union[str, None]:
+        """Returns the latest version of the weights of a model, V_<n>, or None if they are not
+        versioned."""
+        prefix = f'{WEIGHTS_PREFIX}/{model}/'
+        query = urllib.parse.urlencode({'prefix': prefix})
+        with urllib.request.urlopen(f'{self.url}?{query}', timeout=DOWNLOAD_TIMEOUT) as response:
+            listing = response.read().decode()
+        versions = []
+        for key in re.findall(r'<Key>([^<]+)</Key>', listing):
+            match = VERSION_REGEX.match(key[len(prefix):].split('/')[0]) if key.startswith(prefix) else None
+            if match:
+                versions.append(int(match.group(1)))
+        return f'V_{max(versions)}' if versions else None
+
+    def _download(self, model: str, version: Union[str, None]):
+        """Downloads the weights of a model to a temporary file and moves them to the cache once their
+        size and, if the bucket provides it, MD5 checksum (the ETag of the files not uploaded in parts)
+        have been verified."""
+        path = '/'.join(part for part in (WEIGHTS_PREFIX, model, version, WEIGHTS_FILE) if part)
+        url = f'{self.url}{path}'
+        fn = self.getWeightsFile(model)
+        tmpFn = f'{fn}.tmp'
+        logger.info(f'{model}: downloading the weights ({version or "not versioned"}) from {url}...')
+        md5, sha256 = hashlib.md5(), hashlib.sha256()
+        size = 0
+        try:
+            with urllib.request.urlopen(url, timeout=DOWNLOAD_TIMEOUT) as response, open(tmpFn, 'wb') as f:
+                expectedSize = response.headers.get('Content-Length', None)
+                etag = response.headers.get('ETag', '').strip('"')
+                lastModified = response.headers.get('Last-Modified', '')
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                while chunk:
+                    f.write(chunk)
+                    md5.update(chunk)
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+        except OSError as e:
+            _remove(tmpFn)
+            raise WeightsError(f'{model}: unable to download the weights from {url} -> {e}')
+        error = None
+        if expectedSize is not None and size != int(expectedSize):
+            error = f'{model}: incomplete download, {size} of {expectedSize} bytes'
+        elif re.fullmatch(r'[0-9a-f]{32}', etag) and md5.hexdigest() != etag:
+            error = f'{model}: the checksum of the weights does not match the one of the bucket'
+        if error is not None:
+            _remove(tmpFn)
+            raise WeightsError(error)
+        os.replace(tmpFn, fn)
+        record = {'version': version, 'size': size, 'sha256': sha256.hexdigest(), 'url': url,
+                  'lastModified': lastModified}
+        recordFn = join(self.cacheDir, model, RECORD_FILE)
+        with open(f'{recordFn}.tmp', 'w') as f:
+            json.dump(record, f, indent=2)
+        os.replace(f'{recordFn}.tmp', recordFn)  # The record is written last, so it only lists verified files
+        logger.info(f'{model}: {size / 1024 ** 2:.1f} MB downloaded and verified')
+
+    @contextmanager
+    def _locked(self, model: str):
+        """Serializes the fetches of the weights of a model among the processes that share the cache."""
+        with open(join(self.cacheDir, model, LOCK_FILE), 'w') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+
+def computeChecksum(fn: str) -> str:
+    digest = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def _remove(fn: str):
+    if exists(fn):
+        os.remove(fn)
+
+
+def main(argv: List[str] = None) -> int:
+    """Fetches the weights of the given models into a weights cache. It is run when Tardis is
+    installed, and it can be run again to update the weights:
+
+        python -m tardis.weights --dir <TARDIS_WEIGHTS_DIR> fnet_attn_32/membrane_3d dist_triang/3d
+    """
+    parser = argparse.ArgumentParser(description='Fetch the Tardis model weights into a shared cache.')
+    parser.add_argument('--dir', required=True, help='Directory of the weights cache.')
+    parser.add_argument('--url', default=WEIGHTS_URL, help='URL of the bucket of the weights.')
+    parser.add_argument('models', nargs='+', help='Models, as <network>_<subtype>/<dataset>.')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    cache = WeightsCache(args.dir, args.url)
+    failed = False
+    for model in args.models:
+        try:
+            cache.fetch(model)
+        except WeightsError as e:
+            logger.error(str(e))
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# **************************************************************************
+# *
+# * Authors:    Scipion Team (scipion@cnb.csic.es)
+# *
+# *  BCU, Centro Nacional de Biotecnologia, CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import os
+import secrets
+import shlex
+import subprocess
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client
+from os.path import exists, join
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+AUTHKEY_VAR = 'TARDIS_WORKER_AUTHKEY'  # Must match the one in scripts/tardis_worker.py
+STOP_CMD = 'stop'
+WORKER_START_TIMEOUT = 600  # Seconds (the first start may include the conda activation and the torch import)
+
+
+class TardisWorkerError(Exception):
+    pass
+
+
+class TardisWorker:
+    """Client side of a long-lived Tardis process (see scripts/tardis_worker.py) bound to a GPU. A worker
+    runs a job at a time, so the jobs submitted from different threads are served one after the other. To
+    run several jobs at once on the same GPU, a worker per job is needed."""
+
+    def __init__(self, gpuId: Union[str, int], logFile: str, numberOfThreads: int = None):
+        """
+        :param gpuId: GPU/s visible for the worker. Empty for a CPU worker.
+        :param logFile: file in which the output of the worker will be written.
+        :param numberOfThreads: threads used by torch, mainly for CPU workers.
+        """
+        self.gpuId = str(gpuId)
+        self.deviceStr = f'GPU {self.gpuId}' if self.gpuId else 'CPU'
+        self.logFile = logFile
+        self.numberOfThreads = numberOfThreads
+        # Unix socket paths are limited to ~100 characters, so the protocol path can't be used
+        self.address = join(tempfile.gettempdir(), f'tardis-worker-{secrets.token_hex(8)}.sock')
+        self._authKey = secrets.token_bytes(32)
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        from tardis import Plugin
+        logger.info(f'Starting a Tardis worker on {self.deviceStr}...')
+        env = Plugin.getEnviron(self.numberOfThreads)
+        env[AUTHKEY_VAR] = self._authKey.hex()
+        self._process = Plugin.startTardisWorker(self.address, self.gpuId, self.logFile, env=env)
+        startTime = time.time()
+        while self._conn is None:
+            try:
+                self._conn = Client(self.address, family='AF_UNIX', authkey=self._authKey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if self._process.poll() is not None:
+                    raise TardisWorkerError(f'The Tardis worker on {self.deviceStr} exited with code '
+                                            f'{self._process.returncode}. Check {self.logFile}')
+                if time.time() - startTime > WORKER_START_TIMEOUT:
+                    self.stop()
+                    raise TardisWorkerError(f'The Tardis worker on {self.deviceStr} did not start in '
+                                            f'{WORKER_START_TIMEOUT} seconds. Check {self.logFile}')
+                time.sleep(0.5)
+
+    def isAlive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def submit(self, program: str, args: str, cwd: str, logFile: str):
+        """Runs a Tardis command in the worker and waits until it finishes. The output of the
+        command is written in logFile."""
+        job = {'program': program,
+               'args': shlex.split(args),
+               'cwd': os.path.abspath(cwd),
+               'log': os.path.abspath(logFile)}
+        with self._lock:
+            if not self.isAlive():
+                raise TardisWorkerError(f'The Tardis worker on {self.deviceStr} is not running')
+            try:
+                self._conn.send(job)
+                reply = self._conn.recv()
+            except (EOFError, OSError) as e:
+                raise TardisWorkerError(f'The Tardis worker on {self.deviceStr} died -> {e}')
+        if not reply['ok']:
+            raise TardisWorkerError(f'{program} failed -> {reply["error"]}. Check {logFile}')
+
+    def stop(self):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.send(STOP_CMD)
+                    self._conn.close()
+                except OSError:
+                    pass
+                self._conn = None
+            if self._process is not None:
+                try:
+                    self._process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+                self._process = None
+            if exists(self.address):
+                os.remove(self.address)